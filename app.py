@@ -1,17 +1,32 @@
 import os
+import sys
+import json
 import time
+import signal
 import logging
 
-from flask import Flask, request, jsonify, render_template
+from flask import (Flask, Response, request, jsonify, render_template,
+                   send_file)
 from argparse import ArgumentParser
+from werkzeug.serving import make_server
+from archive import SUFFIXES, default_compression, import_tree, stream_export
+from artifacts import PREFIX, parse_ref
 from database import Database, Project, Task, Config, Result
+from metrics import not_modified, response_bytes
+from prefork import bind, serve_workers
+from retention import RetentionPolicy
 from utils import format_time
+from wire import TYPED, decode_body, encode_response, negotiate, \
+    representation_tag
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
 cur_dir = os.path.dirname(__file__)
 
+# Seconds between keep-alive comments on idle event streams
+STREAM_KEEPALIVE = 15
+
 # Parse command line arguments
 parser = ArgumentParser()
 parser.add_argument('--localhost', action='store_true')
@@ -19,9 +34,85 @@ parser.add_argument('--host', default=None)
 parser.add_argument('--port', default=8000, type=int)
 parser.add_argument('--dbpath', default=os.path.join(cur_dir, 'database'),
                     help='Path to the database')
+parser.add_argument('--backend', default='file', choices=['file', 'sqlite'],
+                    help='Storage backend of the database')
+parser.add_argument('--cache-size', default=1024, type=int,
+                    help='Maximum number of cached projects/tasks')
+parser.add_argument('--file-locks', action='store_true',
+                    help='Lock nodes with fcntl file locks so that multiple '
+                         'server processes can share the database')
+parser.add_argument('--server', default='flask', choices=['flask', 'asgi'],
+                    help='Serve with the Flask development server, or only '
+                         'serve /api/<op> with the ASGI app (needs uvicorn)')
+parser.add_argument('--workers', default=1, type=int,
+                    help='Number of server processes sharing the port, which '
+                         'share the database with file locks and a journal '
+                         'of their changes')
+parser.add_argument('--io-workers', default=16, type=int,
+                    help='Database threads of the asgi server')
+parser.add_argument('--max-pending', default=1024, type=int,
+                    help='Maximum number of requests waiting for a database '
+                         'thread in the asgi server')
+parser.add_argument('--write-behind', action='store_true',
+                    help='Buffer result and config writes in memory and '
+                         'write them in groups from a background thread')
+parser.add_argument('--flush-interval', default=0.05, type=float,
+                    help='Seconds between flushes of buffered writes')
+parser.add_argument('--flush-writes', default=1000, type=int,
+                    help='Number of buffered writes that triggers a flush')
+parser.add_argument('--durability', default='buffer',
+                    choices=['buffer', 'fsync'],
+                    help='Acknowledge buffered writes at once, or only once '
+                         'they are synced to disk')
+parser.add_argument('--profile-op', default=None,
+                    help='Profile every call of an op with cProfile, see the '
+                         'get_profiles op')
+parser.add_argument('--reap-rate', default=64, type=float,
+                    help='MB per second removed from the trash of deleted '
+                         'projects and tasks (0 for no limit)')
+parser.add_argument('--retention-interval', default=0, type=float,
+                    help='Seconds between retention passes, which roll up '
+                         'and compress old results (0 to disable)')
+parser.add_argument('--rollup-points', default=1000, type=int,
+                    help='Number of rows kept by a rollup')
+parser.add_argument('--rollup-min-rows', default=10000, type=int,
+                    help='Only roll up results with more rows than this')
+parser.add_argument('--rollup-after', default=None, type=float,
+                    help='Also roll up running tasks created this many hours '
+                         'ago')
 args = parser.parse_args()
+if args.workers > 1 and args.write_behind:
+    parser.error('--write-behind can not be used with --workers')
+
+
+def open_database(worker: int = 0) -> Database:
+    """Open the database of a serving process and start its background
+    work, in the given worker process with --workers. Only the first worker
+    runs retention passes.
+    """
+    journal = args.workers > 1
+    db = Database(args.dbpath, cache_size=args.cache_size,
+                  file_locks=args.file_locks or journal,
+                  backend=args.backend, write_behind=args.write_behind,
+                  flush_interval=args.flush_interval,
+                  flush_writes=args.flush_writes, durability=args.durability,
+                  retention=RetentionPolicy(
+                      args.rollup_points, args.rollup_min_rows,
+                      args.rollup_after * 3600
+                      if args.rollup_after is not None else None),
+                  retention_interval=args.retention_interval
+                  if worker == 0 else 0,
+                  reap_rate=args.reap_rate * 1024 * 1024, journal=journal)
+    if args.profile_op:
+        db.profile_op(args.profile_op, -1)
+    db.start()
+    return db
+
 
-db = Database(args.dbpath)
+# Opened by the serving process only, see __main__
+db = None
+# Exit normally on SIGTERM so that buffered writes are flushed
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 # IP address
 host = '0.0.0.0'
@@ -66,15 +157,175 @@ def task(identifier):
         return render_template('task_view.html')
 
 
+def request_args():
+    """Get the arguments of an API request from its query string and its
+    body, which may be a typed or compressed body (see wire.py).
+    """
+    if request.mimetype not in TYPED and not request.content_encoding:
+        return request.values
+    args = request.args.to_dict()
+    args.update(decode_body(request.get_data(), request.mimetype,
+                            request.content_encoding))
+    return args
+
+
 @app.route('/api/<op>', methods=['GET', 'POST'])
 def api(op):
-    args = request.values
+    try:
+        args = request_args()
+    except Exception as e:
+        return jsonify({'msg': str(e)}), 500
+    content_type, coding = negotiate(request.headers.get('Accept'),
+                                     request.headers.get('Accept-Encoding'))
+    etag = db.etag(op, args)
+    if etag is not None:
+        etag = representation_tag(etag, content_type, coding)
+        if request.if_none_match.contains(etag):
+            not_modified.inc(op=op)
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.vary.update(['Accept', 'Accept-Encoding'])
+            return response
     success, msg = db.api(op, args)
-    if success:
-        return jsonify({'data': msg}), 200
-    else:
-        return jsonify({'msg': msg}), 500
+    body, coding = encode_response({'data': msg} if success else {'msg': msg},
+                                   content_type, coding)
+    response = Response(body, status=200 if success else 500,
+                        content_type=content_type)
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    if etag is not None and success:
+        response.set_etag(etag)
+        # Cached responses must be revalidated with If-None-Match
+        response.headers['Cache-Control'] = 'no-cache'
+    if op in db.ops:
+        response_bytes.inc(len(body), op=op)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Serve the metrics in the Prometheus text format."""
+    return Response(db.get_metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/stream/<path:identifier>')
+def stream(identifier):
+    """Stream the changes of a task as Server-Sent Events."""
+    subscription = db.subscribe(identifier)
+
+    def events():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscription.get(timeout=STREAM_KEEPALIVE)
+                if event is None:
+                    # Also lets a closed connection be noticed
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'data: {}\n\n'.format(json.dumps(event))
+        finally:
+            db.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route('/export/<path:identifier>')
+def export(identifier):
+    """Stream a project or task with its descendants as an archive."""
+    compression = request.args.get('compression') or default_compression()
+    try:
+        if compression not in SUFFIXES:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        chunks = stream_export(db, identifier, compression)
+    except Exception as e:
+        return jsonify({'msg': str(e)}), 500
+    filename = identifier.replace('/', '_') + SUFFIXES[compression]
+    return Response(chunks, mimetype='application/octet-stream',
+                    headers={'Content-Disposition':
+                             'attachment; filename="{}"'.format(filename)})
+
+
+@app.route('/import', methods=['POST'])
+def import_archive():
+    """Import an archive sent as the request body. The query arguments are
+    the parent to import under ('' for a project) and an optional new name.
+    """
+    try:
+        identifier = import_tree(db, request.stream,
+                                 request.args.get('parent', ''),
+                                 request.args.get('name') or None)
+    except Exception as e:
+        return jsonify({'msg': str(e)}), 500
+    return jsonify({'data': identifier}), 200
+
+
+@app.route('/artifacts', methods=['POST'])
+def upload_artifact():
+    """Store the request body, which may be sent with chunked transfer
+    encoding, as an artifact. The returned value is what 'file' configs and
+    results reference it with.
+    """
+    try:
+        info = db.artifacts.write(request.stream)
+    except Exception as e:
+        return jsonify({'msg': str(e)}), 500
+    return jsonify({'data': info}), 200
+
+
+@app.route('/artifacts/<digest>')
+def download_artifact(digest):
+    """Serve an artifact, with support for Range and conditional requests.
+    The optional name query argument is the file name to save it as.
+    """
+    try:
+        if parse_ref(PREFIX + digest) is None or \
+                db.artifacts.stat(digest) is None:
+            raise ValueError('Artifact {} does not exist'.format(digest))
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 404
+    # Blobs never change, so their hash is a strong ETag
+    return send_file(db.artifacts.blob_path(digest),
+                     mimetype='application/octet-stream',
+                     as_attachment='name' in request.args,
+                     download_name=request.args.get('name', digest),
+                     conditional=True, etag=digest, max_age=31536000)
+
+
+def run_worker(number: int, sock):
+    """Serve the listening socket of the launcher in a worker process."""
+    global db
+    db = open_database(number)
+    try:
+        if args.server == 'asgi':
+            from asgi import serve
+            serve(db, host, args.port, args.io_workers, args.max_pending,
+                  sock)
+        else:
+            make_server(host, args.port, app, threaded=True,
+                        fd=sock.fileno()).serve_forever()
+    finally:
+        db.close()
 
 
 if __name__ == '__main__':
-    app.run(host=host, port=args.port, debug=True, threaded=True)
+    if args.workers > 1:
+        serve_workers(bind(host, args.port), args.workers, run_worker)
+    elif args.server == 'asgi':
+        from asgi import serve
+        db = open_database()
+        try:
+            serve(db, host, args.port, args.io_workers, args.max_pending)
+        finally:
+            db.close()
+    else:
+        db = open_database()
+        try:
+            # The reloader would run a second process on the same database
+            app.run(host=host, port=args.port, debug=True, threaded=True,
+                    use_reloader=False)
+        finally:
+            db.close()
@@ -0,0 +1,655 @@
+"""Export a project or task with its descendants as a compressed archive,
+and import it again:
+
+    python archive.py export proj/task1 -o task1.tar.gz --dbpath database
+    python archive.py import task1.tar.gz --parent proj2 --dbpath database
+
+Use --url instead of --dbpath while a server runs on the database. An
+archive is a tar stream of manifest.json followed by the metadata.json,
+config.json, result.json and rows/<j>.jsonl of every node, parents first.
+Artifacts are not included, see artifacts.py.
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import shutil
+import logging
+import tarfile
+import itertools
+import threading
+import tempfile
+import http.client
+from urllib.parse import quote, urlencode, urlsplit
+from urllib.request import urlopen
+from contextlib import contextmanager
+from argparse import ArgumentParser
+
+from artifacts import dict_refs
+from database import Result, validate_name
+from migrate import child_key
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+ARCHIVE_FORMAT = 1
+COMPRESSIONS = ['zstd', 'gzip', 'none']
+SUFFIXES = {'zstd': '.tar.zst', 'gzip': '.tar.gz', 'none': '.tar'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Rows of a result are spooled to disk beyond this size while exported
+SPOOL_SIZE = 16 * 1024 * 1024
+# Number of rows read or written at a time
+ROW_CHUNK = 10000
+# Size of the chunks of streamed exports
+STREAM_CHUNK = 256 * 1024
+# Number of nodes read at a time under their read locks by snapshot()
+SNAPSHOT_GROUP = 64
+# Number of times a snapshot is taken before giving up on a changing tree
+SNAPSHOT_ATTEMPTS = 3
+
+
+def default_compression() -> str:
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('zstd compression requires the zstandard module')
+
+
+class Snapshot(object):
+    """State of a node at the time of an export. The metadata and dicts are
+    serialized right away; of the row logs, which are append-only, only the
+    counts are kept, and rows appended later are left out when streaming.
+    """
+
+    def __init__(self, identifier: str, path: str, metadata: dict,
+                 config: dict, result: dict):
+        self.identifier = identifier
+        self.path = path
+        self.metadata = json.dumps(metadata).encode('utf-8')
+        self.config = json.dumps(config).encode('utf-8')
+        self.result = json.dumps(result).encode('utf-8')
+        # [key, number of stored rows, buffered rows, columnar]
+        self.rows = []
+
+
+def walk(storage, identifier: str) -> list:
+    """List a node and its descendants, parents first."""
+    identifiers = []
+    stack = [identifier]
+    while stack:
+        node = stack.pop()
+        metadata = storage.read_metadata(node)
+        if metadata is None:
+            continue
+        identifiers.append(node)
+        stack.extend('{}/{}'.format(node, child)
+                     for child in reversed(metadata.get(child_key(node), [])))
+    return identifiers
+
+
+def snapshot_nodes(db, identifier: str):
+    """Read a node and its descendants in groups of SNAPSHOT_GROUP nodes,
+    each under their read locks.
+    :return: (list of Snapshot, metadata version of each node)
+    """
+    if not identifier or db.storage.read_metadata(identifier) is None:
+        raise ValueError('{} does not exist'.format(identifier))
+    identifiers = walk(db.storage, identifier)
+    exported = set(identifiers)
+    # Nodes listed by their parent in the snapshot
+    listed = {identifier}
+    nodes = []
+    versions = []
+    for start in range(0, len(identifiers), SNAPSHOT_GROUP):
+        group = identifiers[start:start + SNAPSHOT_GROUP]
+        with db.locks.read(*group):
+            for node_id in group:
+                if node_id not in listed:
+                    continue
+                version = db.versions.get(node_id, 'metadata')
+                metadata = db.storage.read_metadata(node_id)
+                if metadata is None:
+                    continue
+                # Children created after the walk are left out
+                key = child_key(node_id)
+                if key in metadata:
+                    metadata = dict(metadata, **{key: [
+                        child for child in metadata[key]
+                        if '{}/{}'.format(node_id, child) in exported]})
+                    listed.update('{}/{}'.format(node_id, child)
+                                  for child in metadata[key])
+                buffered = (db.write_behind.get(node_id)
+                            if db.write_behind is not None else None)
+                if buffered is not None:
+                    config = buffered.config.dictionary
+                    result = buffered.result.dictionary
+                else:
+                    config = db.storage.read_dict(node_id, 'config')
+                    result = db.storage.read_dict(node_id, 'result')
+                node = Snapshot(node_id, node_id[len(identifier):], metadata,
+                                config, result)
+                for key, entry in result.items():
+                    if entry['type'] not in Result.log_types:
+                        continue
+                    columnar = entry.get('columnar', False)
+                    if columnar:
+                        count = len(db.storage.read_columns(node_id, key))
+                    else:
+                        count = db.storage.count_rows(node_id, key)
+                    pending = (list(buffered.result.pending.get(key, []))
+                               if buffered is not None else [])
+                    node.rows.append([key, count, pending, columnar])
+                nodes.append(node)
+                versions.append(version)
+    if not nodes or nodes[0].identifier != identifier:
+        raise ValueError('{} does not exist'.format(identifier))
+    return nodes, versions
+
+
+def snapshot(db, identifier: str) -> list:
+    """Take a snapshot of a node and its descendants. Writers only wait for
+    the group of nodes being read. If the metadata of a node changed by the
+    end, e.g. a child was created or deleted in between, the snapshot is
+    taken again.
+    :return: A list of Snapshot, parents first.
+    """
+    for _ in range(SNAPSHOT_ATTEMPTS):
+        # Changes of other processes are seen through the journal
+        db.sync()
+        nodes, versions = snapshot_nodes(db, identifier)
+        db.sync()
+        if all(db.versions.get(node.identifier, 'metadata') == version
+               for node, version in zip(nodes, versions)):
+            return nodes
+    raise ValueError('{} was changed during the export'.format(identifier))
+
+
+def iter_stored_rows(storage, identifier: str, key: str, count: int,
+                     columnar: bool):
+    """Iterate over the first count stored rows of a result."""
+    if columnar:
+        rows = storage.read_columns(identifier, key)
+        if len(rows) < count:
+            raise ValueError('Result {} of {} was changed during the '
+                             'export'.format(key, identifier))
+        for start in range(0, count, ROW_CHUNK):
+            yield from rows[start:min(start + ROW_CHUNK, count)]
+        return
+    done = 0
+    while True:
+        try:
+            for row in itertools.islice(storage.iter_rows(identifier, key),
+                                        done, count):
+                yield row
+                done += 1
+            break
+        except FileNotFoundError:
+            # The log was compacted in the meantime, which keeps the order
+            # of the rows, so reading starts over after the rows already
+            # read
+            continue
+    if done < count:
+        raise ValueError('Result {} of {} was changed during the '
+                         'export'.format(key, identifier))
+
+
+@contextmanager
+def open_writer(fileobj, compression: str = None):
+    """Open a streaming tar writer on a file object."""
+    compression = compression or default_compression()
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: {}'.format(compression))
+    if compression == 'zstd':
+        require_zstandard()
+        stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            fileobj, closefd=False)
+    elif compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=fileobj, mode='wb',
+                               compresslevel=GZIP_LEVEL)
+    else:
+        stream = None
+    with tarfile.open(fileobj=stream or fileobj, mode='w|') as tar:
+        yield tar
+    if stream is not None:
+        stream.close()
+
+
+def add_member(tar, name: str, f, size: int):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    tar.addfile(info, f)
+
+
+def add_bytes(tar, name: str, data: bytes):
+    add_member(tar, name, io.BytesIO(data), len(data))
+
+
+def write_archive(storage, nodes: list, fileobj, compression: str = None):
+    """Write the archive of a snapshot, reading the rows from the storage
+    as they are written.
+    :param nodes: Result of snapshot().
+    """
+    manifest = {
+        'format': ARCHIVE_FORMAT,
+        'root': nodes[0].identifier,
+        'export_time': int(time.time()),
+        'nodes': [{'path': node.path,
+                   'rows': [[key, count + len(pending)]
+                            for key, count, pending, _ in node.rows]}
+                  for node in nodes]
+    }
+    with open_writer(fileobj, compression) as tar:
+        add_bytes(tar, 'manifest.json', json.dumps(manifest).encode('utf-8'))
+        for i, node in enumerate(nodes):
+            prefix = 'nodes/{}/'.format(i)
+            add_bytes(tar, prefix + 'metadata.json', node.metadata)
+            add_bytes(tar, prefix + 'config.json', node.config)
+            add_bytes(tar, prefix + 'result.json', node.result)
+            for j, (key, count, pending, columnar) in enumerate(node.rows):
+                rows = itertools.chain(
+                    iter_stored_rows(storage, node.identifier, key, count,
+                                     columnar), pending)
+                with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+                    for row in rows:
+                        spool.write(json.dumps(row).encode('utf-8') + b'\n')
+                    size = spool.tell()
+                    spool.seek(0)
+                    add_member(tar, '{}rows/{}.jsonl'.format(prefix, j),
+                               spool, size)
+
+
+def export_tree(db, identifier: str, fileobj, compression: str = None):
+    """Export a project or task with its descendants to a file object.
+    :param compression: 'zstd', 'gzip' or 'none'; zstd if available by
+    default.
+    """
+    write_archive(db.storage, snapshot(db, identifier), fileobj, compression)
+
+
+class StreamWriter(object):
+    """File object passing what is written to another thread in chunks."""
+
+    def __init__(self, max_chunks: int = 16):
+        self.queue = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.cancelled = False
+
+    def put(self, item):
+        while True:
+            if self.cancelled:
+                raise IOError('Export was cancelled')
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= STREAM_CHUNK:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+        self.put(None)
+
+
+def stream_export(db, identifier: str, compression: str = None):
+    """Export a node as an iterator of archive chunks, e.g. for a streamed
+    response. The snapshot is taken before this returns, so a missing node
+    raises here; the archive is then written by a background thread.
+    """
+    nodes = snapshot(db, identifier)
+    writer = StreamWriter()
+
+    def run():
+        try:
+            write_archive(db.storage, nodes, writer, compression)
+        except Exception:
+            if not writer.cancelled:
+                logger.exception('Export of {} failed'.format(identifier))
+        try:
+            writer.finish()
+        except IOError:
+            pass
+
+    def chunks():
+        threading.Thread(target=run, name='export', daemon=True).start()
+        try:
+            while True:
+                chunk = writer.queue.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            writer.cancelled = True
+
+    return chunks()
+
+
+class PrefixedReader(object):
+    """File object that returns some bytes already read before the rest."""
+
+    def __init__(self, prefix: bytes, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+
+@contextmanager
+def open_reader(fileobj):
+    """Open a streaming tar reader on a file object, detecting the
+    compression.
+    """
+    magic = b''
+    while len(magic) < 4:
+        data = fileobj.read(4 - len(magic))
+        if not data:
+            break
+        magic += data
+    stream = PrefixedReader(magic, fileobj)
+    if magic.startswith(b'\x1f\x8b'):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif magic == ZSTD_MAGIC:
+        require_zstandard()
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            yield tar
+    except (tarfile.TarError, EOFError, gzip.BadGzipFile) as e:
+        raise ValueError('Invalid archive: {}'.format(e))
+
+
+def read_member(tar, member):
+    if not member.isfile():
+        raise ValueError('Invalid archive member: {}'.format(member.name))
+    return tar.extractfile(member)
+
+
+def import_rows(storage, identifier: str, key: str, columnar: bool, f) -> int:
+    """Append the JSON lines of a rows member in chunks.
+    :return: Number of rows.
+    """
+    append = storage.append_columns if columnar else storage.append_rows
+    count = 0
+    chunk = []
+    for line in f:
+        if not line.strip():
+            continue
+        chunk.append(json.loads(line))
+        if len(chunk) >= ROW_CHUNK:
+            append(identifier, key, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        append(identifier, key, chunk)
+        count += len(chunk)
+    return count
+
+
+def check_paths(nodes: list) -> dict:
+    """Check that the nodes of a manifest form a tree, parents first, of
+    valid names.
+    :return: {path: names of its children}
+    """
+    if not nodes or nodes[0].get('path') != '':
+        raise ValueError('Invalid archive: the first node must be the root')
+    children = {'': []}
+    for node in nodes[1:]:
+        path = node.get('path')
+        if type(path) is not str:
+            raise ValueError('Invalid archive: invalid node path')
+        parent, _, name = path.rpartition('/')
+        if (parent not in children or path in children
+                or not validate_name(name)):
+            raise ValueError('Invalid archive: invalid node path {}'.format(
+                path))
+        children[parent].append(name)
+        children[path] = []
+    return children
+
+
+def import_tree(db, fileobj, parent: str = '', name: str = None) -> str:
+    """Import an archive written by export_tree(). The new node is only
+    listed by its parent once everything is written, so a failed import
+    leaves nothing behind.
+    :param parent: Identifier of the task or project to import a task
+    under, or '' to import a project.
+    :param name: New name of the imported node, its old name by default.
+    :return: Identifier of the imported node.
+    """
+    storage = db.storage
+    with open_reader(fileobj) as tar:
+        member = tar.next()
+        if member is None or member.name != 'manifest.json':
+            raise ValueError('Invalid archive: manifest.json must come first')
+        manifest = json.load(read_member(tar, member))
+        if manifest.get('format') != ARCHIVE_FORMAT:
+            raise ValueError('Unsupported archive format: {}'.format(
+                manifest.get('format')))
+        root = manifest['root']
+        if parent and '/' not in root:
+            raise ValueError('A project can only be imported as a project')
+        if not parent and '/' in root:
+            raise ValueError('A task can only be imported under a project '
+                             'or task')
+        name = name or root.rsplit('/', 1)[-1]
+        if not validate_name(name):
+            raise ValueError('Invalid name')
+        identifier = '{}/{}'.format(parent, name) if parent else name
+        if parent:
+            exists = db.get_child(parent).has_child(name)
+        else:
+            exists = db.has_project(name)
+        if exists:
+            raise ValueError('{} already exists'.format(identifier))
+
+        nodes = manifest['nodes']
+        children = check_paths(nodes)
+        imported = []
+        # Artifacts referenced by the imported configs and results
+        refs = []
+        referenced = []
+        created = False
+        try:
+            while True:
+                # Iterating over tar would start with the manifest again
+                member = tar.next()
+                if member is None:
+                    break
+                parts = member.name.split('/')
+                if (len(parts) not in {3, 4} or parts[0] != 'nodes'
+                        or not parts[1].isdigit()
+                        or int(parts[1]) >= len(nodes)):
+                    raise ValueError('Unexpected archive member: {}'.format(
+                        member.name))
+                i = int(parts[1])
+                node_id = identifier + nodes[i]['path']
+                f = read_member(tar, member)
+                if parts[2] == 'metadata.json':
+                    if i != len(imported):
+                        raise ValueError('Unexpected archive member: '
+                                         '{}'.format(member.name))
+                    metadata = json.load(f)
+                    path = nodes[i]['path']
+                    if (sorted(metadata.get(child_key(node_id), []))
+                            != sorted(children[path])):
+                        raise ValueError('Invalid archive: children of {} do '
+                                         'not match the manifest'.format(
+                                             node_id))
+                    metadata['identifier'] = node_id
+                    if i == 0:
+                        metadata['name'] = name
+                    # Deleted children of the source are not imported
+                    metadata.pop('tombstones', None)
+                    storage.create_node(node_id, metadata)
+                    created = True
+                    imported.append((node_id, metadata, {}))
+                elif i != len(imported) - 1:
+                    raise ValueError('Unexpected archive member: {}'.format(
+                        member.name))
+                elif parts[2] in {'config.json', 'result.json'}:
+                    dictionary = json.load(f)
+                    if (parts[2] == 'result.json'
+                            and not storage.supports_columns):
+                        # Columnar results are imported as rows of JSON
+                        dictionary = {
+                            key: {k: v for k, v in entry.items()
+                                  if k != 'columnar'}
+                            for key, entry in dictionary.items()}
+                    storage.write_dict(node_id, parts[2][:-5], dictionary)
+                    refs += dict_refs(dictionary)
+                    if parts[2] == 'result.json':
+                        imported[i][2].update(dictionary)
+                elif parts[2] == 'rows' and len(parts) == 4:
+                    key, count = nodes[i]['rows'][int(parts[3].split('.')[0])]
+                    columnar = imported[i][2][key].get('columnar', False)
+                    if import_rows(storage, node_id, key, columnar,
+                                   f) != count:
+                        raise ValueError('Archive is missing rows of {} of '
+                                         '{}'.format(key, node_id))
+                else:
+                    raise ValueError('Unexpected archive member: {}'.format(
+                        member.name))
+            if len(imported) != len(nodes):
+                raise ValueError('Archive is missing nodes')
+
+            with db.writing(parent):
+                if parent:
+                    node = db.get_child(parent)
+                    exists = node.has_child(name)
+                else:
+                    node = db
+                    exists = db.has_project(name)
+                if exists:
+                    raise ValueError('{} already exists'.format(identifier))
+                for ref in refs:
+                    # Archives do not contain the artifacts themselves
+                    if db.artifacts.stat(ref) is not None:
+                        db.artifacts.incref(ref)
+                        referenced.append(ref)
+                node.append_metadata_item(child_key(parent), name)
+                try:
+                    for node_id, metadata, _ in imported:
+                        db.index.update(node_id, metadata)
+                        if '/' in node_id:
+                            db.search.update(node_id, metadata)
+                            db.search.set_configs(
+                                node_id, storage.read_dict(node_id, 'config'))
+                except BaseException:
+                    db.index.remove(identifier)
+                    db.search.remove(identifier)
+                    node.remove_metadata_item(child_key(parent), name)
+                    raise
+                created = False
+                if parent:
+                    db.publish(parent, {'event': 'children',
+                                        'created': [name]})
+        except BaseException:
+            if created:
+                storage.delete_node(identifier)
+                db.release_artifacts(referenced)
+            raise
+    return identifier
+
+
+def post_archive(url: str, path: str, parent: str, name: str) -> str:
+    """Import an archive file through a server."""
+    parts = urlsplit(url)
+    connection_class = (http.client.HTTPSConnection
+                        if parts.scheme == 'https'
+                        else http.client.HTTPConnection)
+    conn = connection_class(parts.netloc)
+    query = urlencode({k: v for k, v in [('parent', parent), ('name', name)]
+                       if v})
+    with open(path, 'rb') as f:
+        conn.request('POST', '{}/import?{}'.format(parts.path.rstrip('/'),
+                                                   query), f,
+                     {'Content-Type': 'application/octet-stream',
+                      'Content-Length': str(os.path.getsize(path))})
+        response = conn.getresponse()
+        body = json.loads(response.read())
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(body.get('msg'))
+    return body['data']
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('target', help='Identifier to export, or archive '
+                                       'file to import')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Archive file to export to, - for stdout')
+    parser.add_argument('--compression', default=None, choices=COMPRESSIONS)
+    parser.add_argument('--parent', default='',
+                        help='Project or task to import a task under')
+    parser.add_argument('--name', default=None,
+                        help='New name of the imported project or task')
+    parser.add_argument('--url', default=None,
+                        help='URL of a server to export from or import to')
+    parser.add_argument('--dbpath', default='database',
+                        help='Path to the database, if no server is given')
+    parser.add_argument('--backend', default='file', choices=['file', 'sqlite'])
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        output = args.output or args.target.replace('/', '_') + SUFFIXES[
+            args.compression or default_compression()]
+        out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        if args.url:
+            query = urlencode({'compression': args.compression}
+                              if args.compression else {})
+            with urlopen('{}/export/{}?{}'.format(
+                    args.url.rstrip('/'), quote(args.target), query)) as f:
+                shutil.copyfileobj(f, out, STREAM_CHUNK)
+        else:
+            from database import Database
+            db = Database(args.dbpath, backend=args.backend)
+            export_tree(db, args.target, out, args.compression)
+            db.close()
+        out.close()
+        logger.info('Exported {}'.format(args.target))
+    else:
+        if args.url:
+            identifier = post_archive(args.url, args.target, args.parent,
+                                      args.name)
+        else:
+            from database import Database
+            db = Database(args.dbpath, backend=args.backend)
+            with open(args.target, 'rb') as f:
+                identifier = import_tree(db, f, args.parent, args.name)
+            db.close()
+        logger.info('Imported {}'.format(identifier))
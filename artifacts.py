@@ -0,0 +1,186 @@
+"""Content-addressed store of the files of 'file' results and configs.
+
+Blobs are stored once under the SHA-256 of their content in
+<dbpath>/artifacts/<2 hex digits>/<hex>, and 'file' entries reference them
+as 'sha256:<hex>'. A blob is removed with its last reference, unless it
+was uploaded less than UPLOAD_GRACE seconds ago; collect() removes those
+later.
+"""
+import os
+import re
+import time
+import hashlib
+import tempfile
+
+from utils import atomic_write_json, read_json
+
+PREFIX = 'sha256:'
+# Bytes read from an upload at a time
+CHUNK_SIZE = 1 << 20
+# Seconds during which an unreferenced upload is kept
+UPLOAD_GRACE = 3600
+# Prefix of the lock identifiers of blobs, which can not clash with nodes
+LOCK_PREFIX = ':artifact:'
+
+
+def parse_ref(value) -> str:
+    """Get the hash referenced by a 'file' value.
+    :return: The hex digest, or None for plain paths.
+    """
+    if type(value) is not str or not value.startswith(PREFIX):
+        return None
+    digest = value[len(PREFIX):]
+    if re.match('^[0-9a-f]{64}$', digest) is None:
+        raise ValueError('Invalid artifact reference: {}'.format(value))
+    return digest
+
+
+def entry_ref(entry: dict) -> str:
+    """Get the hash referenced by a config or result entry, if any."""
+    if entry is None or entry['type'] != 'file':
+        return None
+    return parse_ref(entry['value'])
+
+
+def dict_refs(dictionary: dict) -> list:
+    return [ref for ref in map(entry_ref, dictionary.values())
+            if ref is not None]
+
+
+class ArtifactStore(object):
+    def __init__(self, path: str, locks):
+        """
+        :param path: Directory of the blobs.
+        :param locks: LockManager of the database, whose write locks guard
+        the reference counts.
+        """
+        self.path = path
+        self.locks = locks
+        self.tmp_dir = os.path.join(path, 'uploads')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def meta_path(self, digest: str) -> str:
+        return self.blob_path(digest) + '.json'
+
+    def stat(self, digest: str) -> dict:
+        """Get the size, reference count and upload time of a blob.
+        :return: None if there is no such blob.
+        """
+        try:
+            return read_json(self.meta_path(digest))
+        except FileNotFoundError:
+            return None
+
+    def write(self, stream, chunk_size: int = CHUNK_SIZE) -> dict:
+        """Store the content of a binary stream, hashing it while it is
+        read. Content already stored is not stored again.
+        :return: {'value': 'sha256:<hex>', 'size': ..., 'deduplicated': ...}
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = sha.hexdigest()
+            with self.locks.write(LOCK_PREFIX + digest):
+                meta = self.stat(digest)
+                deduplicated = meta is not None
+                if meta is None:
+                    os.makedirs(os.path.dirname(self.blob_path(digest)),
+                                exist_ok=True)
+                    os.replace(tmp_path, self.blob_path(digest))
+                    meta = {'size': size, 'refs': 0}
+                meta['upload_time'] = int(time.time())
+                atomic_write_json(self.meta_path(digest), meta, fsync=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return {'value': PREFIX + digest, 'size': size,
+                'deduplicated': deduplicated}
+
+    def incref(self, digest: str):
+        """Count a new reference to a blob.
+        :raise ValueError: If there is no such blob.
+        """
+        with self.locks.write(LOCK_PREFIX + digest):
+            meta = self.stat(digest)
+            if meta is None:
+                raise ValueError('Artifact {} does not exist'.format(digest))
+            meta['refs'] += 1
+            atomic_write_json(self.meta_path(digest), meta)
+
+    def decref(self, digest: str) -> int:
+        """Drop a reference to a blob, and remove it if it was the last one.
+        :return: Number of bytes freed.
+        """
+        with self.locks.write(LOCK_PREFIX + digest):
+            meta = self.stat(digest)
+            if meta is None:
+                return 0
+            meta['refs'] = max(meta['refs'] - 1, 0)
+            if self.expired(meta, time.time()):
+                return self.remove(digest, meta)
+            atomic_write_json(self.meta_path(digest), meta)
+            return 0
+
+    @staticmethod
+    def expired(meta: dict, now: float, grace: float = UPLOAD_GRACE) -> bool:
+        return not meta['refs'] and now - meta.get('upload_time', 0) >= grace
+
+    def remove(self, digest: str, meta: dict) -> int:
+        # The metadata goes last, so that an interrupted removal is retried
+        # by collect()
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+        os.remove(self.meta_path(digest))
+        return meta['size']
+
+    def digests(self) -> list:
+        digests = []
+        for prefix in sorted(os.listdir(self.path)):
+            if len(prefix) != 2:
+                continue
+            for name in os.listdir(os.path.join(self.path, prefix)):
+                if name.endswith('.json'):
+                    digests.append(name[:-5])
+        return digests
+
+    def collect(self, counts: dict = None, grace: float = UPLOAD_GRACE) -> dict:
+        """Remove the blobs nobody references.
+        :param counts: If given, the actual number of references of every
+        blob, which replace the stored counts.
+        :param grace: Keep unreferenced blobs uploaded less than this many
+        seconds ago.
+        :return: Number of blobs kept and removed, and bytes freed.
+        """
+        stats = {'blobs': 0, 'blobs_removed': 0, 'bytes_freed': 0}
+        now = time.time()
+        for digest in self.digests():
+            with self.locks.write(LOCK_PREFIX + digest):
+                meta = self.stat(digest)
+                if meta is None:
+                    continue
+                if counts is not None and meta['refs'] != counts.get(digest,
+                                                                     0):
+                    meta['refs'] = counts.get(digest, 0)
+                    atomic_write_json(self.meta_path(digest), meta)
+                if self.expired(meta, now, grace):
+                    stats['bytes_freed'] += self.remove(digest, meta)
+                    stats['blobs_removed'] += 1
+                else:
+                    stats['blobs'] += 1
+        return stats
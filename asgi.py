@@ -0,0 +1,215 @@
+"""ASGI application serving /api/<op> of app.py for high throughput
+ingestion, e.g. python app.py --server asgi. Database calls run on a
+bounded thread pool, and writes to the same task keep their order.
+"""
+import json
+import asyncio
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import not_modified, response_bytes
+from versions import etag_matches
+from wire import decode_body, encode_response, negotiate, representation_tag
+
+# Ops that write, with the arguments naming the nodes they write to
+WRITE_OPS = {
+    'create_project': [''],
+    'delete_project': ['', 'name'],
+    'create_task': ['parent'],
+    'create_tasks': ['parent'],
+    'insert_task_result': ['identifier'],
+    'delete_task_result': ['identifier'],
+    'append_task_result': ['identifier'],
+    'insert_task_config': ['identifier'],
+    'delete_task_config': ['identifier'],
+    'update_child_metadata': ['identifier'],
+    'compact_task_results': ['identifier'],
+    'delete_task': ['identifier'],
+    'batch_task_results': []
+}
+
+
+def write_keys(op: str, args: dict) -> list:
+    """Get the identifiers of the nodes an op writes to. '' stands for the
+    database itself.
+    """
+    if op not in WRITE_OPS:
+        return []
+    if op == 'batch_task_results':
+        operations = args.get('operations', '[]')
+        try:
+            if type(operations) is str:
+                operations = json.loads(operations)
+            return sorted({str(o.get('identifier')) for o in operations})
+        except (ValueError, TypeError, AttributeError):
+            return []
+    return [args.get(arg, '') if arg else '' for arg in WRITE_OPS[op]]
+
+
+class OrderedExecutor(object):
+    """Run blocking calls on a bounded thread pool. Calls sharing a key run
+    in the order run() was called, calls without keys run concurrently.
+    """
+
+    def __init__(self, workers: int = 16, max_pending: int = 1024):
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = asyncio.Semaphore(workers + max_pending)
+        # key -> future done when the last call with the key is finished
+        self.tails = {}
+
+    async def run(self, keys: list, func, *args):
+        loop = asyncio.get_running_loop()
+        previous = {self.tails[k] for k in keys if k in self.tails}
+        done = loop.create_future()
+        for key in keys:
+            self.tails[key] = done
+        try:
+            for future in previous:
+                await asyncio.shield(future)
+            async with self.slots:
+                return await loop.run_in_executor(self.pool, func, *args)
+        finally:
+            done.set_result(None)
+            for key in keys:
+                if self.tails.get(key) is done:
+                    del self.tails[key]
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class ApiApp(object):
+    """ASGI app for /api/<op> and /metrics. Responses of ops are the same
+    as those of the Flask route: {'data': ...} with 200 on success,
+    {'msg': ...} with 500 on failure.
+    """
+
+    def __init__(self, db, workers: int = 16, max_pending: int = 1024):
+        self.db = db
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.executor = OrderedExecutor(self.workers, self.max_pending)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        if self.executor is None:
+            # The server does not support the lifespan protocol
+            self.executor = OrderedExecutor(self.workers, self.max_pending)
+        path = scope['path']
+        if path == '/metrics':
+            return await self.send_body(
+                send, 200, self.db.get_metrics().encode('utf-8'),
+                b'text/plain; version=0.0.4; charset=utf-8')
+        if not path.startswith('/api/') or '/' in path[5:]:
+            return await self.respond(send, 404, {'msg': 'Not found'})
+        if scope['method'] not in {'GET', 'POST'}:
+            return await self.respond(send, 405, {'msg': 'Method not allowed'})
+        op = path[5:]
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1'),
+                              keep_blank_values=True))
+        body = await self.read_body(receive)
+        headers = {k: v.decode('latin-1') for k, v in scope['headers']}
+        try:
+            args.update(decode_body(body, headers.get(b'content-type'),
+                                    headers.get(b'content-encoding')))
+        except Exception as e:
+            return await self.respond(send, 500, {'msg': str(e)})
+        content_type, coding = negotiate(headers.get(b'accept'),
+                                         headers.get(b'accept-encoding'))
+
+        status, body, coding, etag = await self.executor.run(
+            write_keys(op, args), self.call, op, args, content_type, coding,
+            headers.get(b'if-none-match', ''))
+        if status == 304:
+            return await self.send_body(send, 304, b'', etag=etag, vary=True)
+        await self.send_body(send, status, body, content_type.encode(),
+                             etag=etag if status == 200 else None,
+                             coding=coding, vary=True)
+
+    def call(self, op: str, args: dict, content_type: str, coding: str,
+             if_none_match: str):
+        """Run an op and encode its response, on a worker thread. Computing
+        the entity tag may read the journal, so it is done here as well.
+        """
+        etag = self.db.etag(op, args)
+        if etag is not None:
+            etag = representation_tag(etag, content_type, coding)
+            if etag_matches(if_none_match, etag):
+                not_modified.inc(op=op)
+                return 304, b'', None, etag
+        success, msg = self.db.api(op, args)
+        body, coding = encode_response(
+            {'data': msg} if success else {'msg': msg}, content_type, coding)
+        if op in self.db.ops:
+            response_bytes.inc(len(body), op=op)
+        return 200 if success else 500, body, coding, etag
+
+    @staticmethod
+    async def read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def respond(self, send, status: int, obj):
+        await self.send_body(send, status, json.dumps(obj).encode('utf-8'))
+
+    @staticmethod
+    async def send_body(send, status: int, body: bytes,
+                        content_type: bytes = b'application/json',
+                        etag: str = None, coding: str = None,
+                        vary: bool = False):
+        """
+        :param coding: Content coding the body is compressed with.
+        :param vary: Whether the body depends on the Accept and
+        Accept-Encoding headers.
+        """
+        headers = [(b'content-type', content_type),
+                   (b'content-length', str(len(body)).encode())]
+        if coding is not None:
+            headers.append((b'content-encoding', coding.encode('latin-1')))
+        if vary:
+            headers.append((b'vary', b'Accept, Accept-Encoding'))
+        if etag is not None:
+            headers += [(b'etag', '"{}"'.format(etag).encode('latin-1')),
+                        (b'cache-control', b'no-cache')]
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def serve(db, host: str, port: int, workers: int = 16,
+          max_pending: int = 1024, sock=None):
+    """
+    :param sock: Listening socket to serve instead of binding host:port,
+    e.g. that of the pre-fork launcher.
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('The asgi server mode requires uvicorn')
+    uvicorn.run(ApiApp(db, workers, max_pending), host=host, port=port,
+                fd=sock.fileno() if sock is not None else None,
+                log_level='warning', access_log=False)
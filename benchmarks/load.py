@@ -0,0 +1,182 @@
+"""Load generator comparing the server modes of app.py (asgi needs
+uvicorn):
+
+    python benchmarks/load.py --servers flask asgi --connections 64 \
+        --requests 20000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+import tempfile
+import subprocess
+from urllib.parse import urlencode
+from argparse import ArgumentParser
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Connection(object):
+    """Minimal keep-alive HTTP/1.1 client connection."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path: str, args: dict):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        body = urlencode(args).encode('utf-8')
+        self.writer.write(
+            'POST {} HTTP/1.1\r\nHost: {}:{}\r\n'
+            'Content-Type: application/x-www-form-urlencoded\r\n'
+            'Content-Length: {}\r\n\r\n'.format(
+                path, self.host, self.port, len(body)).encode('latin-1')
+            + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in {b'\r\n', b''}:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = await self.reader.readexactly(
+                int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+        if headers.get('connection', '').lower() == 'close' or \
+                'content-length' not in headers:
+            self.close()
+        return status, json.loads(body) if body else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def wait_for_server(host: str, port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError('Server on port {} did not start'.format(port))
+
+
+async def run_load(host: str, port: int, args) -> dict:
+    setup = Connection(host, port)
+    await setup.post('/api/create_project', {'name': 'load'})
+    await setup.post('/api/create_tasks', {
+        'parent': 'load',
+        'names': json.dumps(['task{}'.format(i) for i in range(args.tasks)])})
+    for i in range(args.tasks):
+        await setup.post('/api/insert_task_result', {
+            'identifier': 'load/task{}'.format(i), 'key': 'rows',
+            'value': json.dumps(['client', 'i']), 'val_type': 'table'})
+
+    latencies = []
+    errors = []
+    per_connection = args.requests // args.connections
+
+    async def client(c: int):
+        conn = Connection(host, port)
+        identifier = 'load/task{}'.format(c % args.tasks)
+        for i in range(per_connection):
+            start = time.perf_counter()
+            status, _ = await conn.post('/api/append_task_result', {
+                'identifier': identifier, 'key': 'rows',
+                'value': json.dumps([c, i]), 'val_type': 'table'})
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+        conn.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(c) for c in range(args.connections)])
+    elapsed = time.perf_counter() - start
+
+    # Rows of every client must be in the order it sent them
+    ordered = True
+    for t in range(args.tasks):
+        _, rst = await setup.post('/api/get_task_result', {
+            'identifier': 'load/task{}'.format(t), 'key': 'rows'})
+        last = {}
+        for c, i in rst['data']['value']['data']:
+            if last.get(c, -1) != i - 1:
+                ordered = False
+            last[c] = i
+    setup.close()
+
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p),
+                                   len(latencies) - 1)] * 1000, 2)
+
+    return {
+        'requests': len(latencies),
+        'elapsed': round(elapsed, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+        'errors': len(errors),
+        'ordered': ordered
+    }
+
+
+def start_server(server: str, port: int, dbpath: str, args):
+    command = [sys.executable, os.path.join(root, 'app.py'), '--localhost',
+               '--port', str(port), '--dbpath', dbpath, '--server', server,
+               '--backend', args.backend]
+    # A new session so that the Flask reloader child is stopped as well
+    return subprocess.Popen(command, cwd=root, start_new_session=True,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--servers', nargs='+', default=['flask', 'asgi'],
+                        choices=['flask', 'asgi'])
+    parser.add_argument('--connections', default=32, type=int)
+    parser.add_argument('--requests', default=10000, type=int,
+                        help='Total number of requests')
+    parser.add_argument('--tasks', default=8, type=int,
+                        help='Number of tasks the requests are spread over')
+    parser.add_argument('--backend', default='file', choices=['file', 'sqlite'])
+    parser.add_argument('--port', default=18000, type=int,
+                        help='Port of the first server')
+    args = parser.parse_args()
+
+    report = {}
+    for n, server in enumerate(args.servers):
+        port = args.port + n
+        path = tempfile.mkdtemp(prefix='footprint-load-')
+        process = start_server(server, port, path, args)
+        try:
+            asyncio.run(wait_for_server('127.0.0.1', port))
+            report[server] = asyncio.run(run_load('127.0.0.1', port, args))
+        except Exception as e:
+            report[server] = {'error': str(e)}
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            shutil.rmtree(path)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Stress test of concurrent writers appending to the same task:
+
+    python benchmarks/stress_append.py --threads 16 --rows 500
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import Database
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--threads', default=8, type=int)
+    parser.add_argument('--rows', default=500, type=int,
+                        help='Number of rows appended by each thread')
+    parser.add_argument('--file-locks', action='store_true')
+    parser.add_argument('--backend', default='file', choices=['file', 'sqlite'])
+    parser.add_argument('--dbpath', default=None,
+                        help='Database directory (a temporary one by default)')
+    args = parser.parse_args()
+
+    path = args.dbpath or tempfile.mkdtemp(prefix='footprint-stress-')
+    os.makedirs(path, exist_ok=True)
+    try:
+        db = Database(path, file_locks=args.file_locks, backend=args.backend)
+        db.create_project('stress')
+        db.create_task('stress', 'task')
+        db.insert_task_result('stress/task', 'rows', json.dumps(['thread', 'i']),
+                              'table')
+        errors = []
+
+        def worker(thread_id):
+            for i in range(args.rows):
+                for op, op_args in [
+                    ('append_task_result', {
+                        'identifier': 'stress/task', 'key': 'rows',
+                        'value': json.dumps([thread_id, i]),
+                        'val_type': 'table'}),
+                    ('insert_task_result', {
+                        'identifier': 'stress/task',
+                        'key': 'last_{}'.format(thread_id), 'value': str(i),
+                        'val_type': 'int', 'overwrite': True})]:
+                    success, msg = db.api(op, op_args)
+                    if not success:
+                        errors.append(msg)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(args.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        # Read everything back from disk with a fresh database
+        result = Database(path, backend=args.backend).get_task_results(
+            'stress/task')
+        rows = result['rows']['value']['data']
+        expected = args.threads * args.rows
+        lost = expected - len(set(map(tuple, rows)))
+        scalars_ok = all(
+            result.get('last_{}'.format(i), {}).get('value') == args.rows - 1
+            for i in range(args.threads))
+        ops = expected * 2
+        print(json.dumps({
+            'threads': args.threads,
+            'rows_per_thread': args.rows,
+            'elapsed': round(elapsed, 3),
+            'ops_per_sec': round(ops / elapsed, 1),
+            'rows_expected': expected,
+            'rows_found': len(rows),
+            'rows_lost': lost,
+            'scalars_ok': scalars_ok,
+            'errors': len(errors)
+        }, indent=2))
+        if lost or not scalars_ok or errors or len(rows) != expected:
+            sys.exit(1)
+    finally:
+        if args.dbpath is None:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
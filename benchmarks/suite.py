@@ -0,0 +1,287 @@
+"""Benchmarks of the core Database operations on a synthetic database:
+
+    python benchmarks/suite.py --output base.json
+    python benchmarks/suite.py --baseline base.json --threshold 0.2
+
+With --baseline it exits with status 1 if any benchmark got slower by
+more than the threshold.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import Database
+
+# Table sizes at which appends are timed
+APPEND_SIZES = [0, 1000, 10000, 100000]
+# Rows per batch_task_results call when building the database
+BUILD_BATCH = 5000
+BENCHMARKS = ['create_task', 'append_task_result', 'get_task_results',
+              'get_task_results_cold', 'list_projects_info', 'get_child_cold',
+              'concurrent_writers']
+
+
+def call(db, op: str, **args):
+    success, msg = db.api(op, args)
+    if not success:
+        raise RuntimeError('{} failed: {}'.format(op, msg))
+    return msg
+
+
+def fill_rows(db, identifier: str, key: str, count: int, rng):
+    for start in range(0, count, BUILD_BATCH):
+        call(db, 'batch_task_results', operations=json.dumps([
+            {'op': 'append', 'identifier': identifier, 'key': key,
+             'value': json.dumps([i, rng.random()]), 'val_type': 'table'}
+            for i in range(start, min(start + BUILD_BATCH, count))]))
+
+
+def build_database(db, args) -> list:
+    """Create the synthetic tree.
+    :return: Identifiers of all tasks and subtasks.
+    """
+    rng = random.Random(args.seed)
+    identifiers = []
+    for p in range(args.projects):
+        project = 'project{}'.format(p)
+        call(db, 'create_project', name=project)
+        call(db, 'create_tasks', parent=project, names=json.dumps(
+            ['task{}'.format(t) for t in range(args.tasks)]))
+        for t in range(args.tasks):
+            parent = '{}/task{}'.format(project, t)
+            identifiers.append(parent)
+            for d in range(args.depth):
+                call(db, 'create_task', parent=parent, name='sub{}'.format(d))
+                parent = '{}/sub{}'.format(parent, d)
+                identifiers.append(parent)
+    for identifier in identifiers:
+        for key in ['lr', 'batch_size']:
+            call(db, 'insert_task_config', identifier=identifier, key=key,
+                 value=str(rng.random()), val_type='float')
+        call(db, 'insert_task_result', identifier=identifier, key='acc',
+             value=str(rng.random()), val_type='float')
+        call(db, 'insert_task_result', identifier=identifier, key='loss',
+             value=json.dumps(['step', 'loss']), val_type='table')
+        fill_rows(db, identifier, 'loss', args.rows, rng)
+    return identifiers
+
+
+def timed(func, count: int) -> list:
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies: list, elapsed: float = None) -> dict:
+    latencies = sorted(latencies)
+    n = len(latencies)
+    elapsed = elapsed if elapsed is not None else sum(latencies)
+
+    def percentile(p):
+        return round(latencies[min(int(n * p), n - 1)] * 1000, 4)
+
+    return {
+        'count': n,
+        'ops_per_sec': round(n / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(latencies) / n * 1000, 4),
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99)
+    }
+
+
+def bench_create_task(db, identifiers, args) -> dict:
+    call(db, 'create_project', name='bench_create')
+    return {'create_task': summarize(timed(
+        lambda i: call(db, 'create_task', parent='bench_create',
+                       name='t{}'.format(i)), args.repeat))}
+
+
+def bench_append_task_result(db, identifiers, args) -> dict:
+    rng = random.Random(args.seed)
+    call(db, 'create_project', name='bench_append')
+    results = {}
+    for size in args.append_sizes:
+        identifier = 'bench_append/rows{}'.format(size)
+        call(db, 'create_task', parent='bench_append',
+             name='rows{}'.format(size))
+        call(db, 'insert_task_result', identifier=identifier, key='loss',
+             value=json.dumps(['step', 'loss']), val_type='table')
+        fill_rows(db, identifier, 'loss', size, rng)
+        results['append_task_result@{}'.format(size)] = summarize(timed(
+            lambda i: call(db, 'append_task_result', identifier=identifier,
+                           key='loss', value=json.dumps([size + i, 0.5]),
+                           val_type='table'), args.repeat))
+    return results
+
+
+def bench_get_task_results(db, identifiers, args) -> dict:
+    return {'get_task_results': summarize(timed(
+        lambda i: call(db, 'get_task_results',
+                       identifier=identifiers[i % len(identifiers)]),
+        args.repeat))}
+
+
+def bench_get_task_results_cold(db, identifiers, args) -> dict:
+    def get(i):
+        db.cache.clear()
+        call(db, 'get_task_results',
+             identifier=identifiers[i % len(identifiers)])
+    return {'get_task_results_cold': summarize(timed(get, args.repeat))}
+
+
+def bench_list_projects_info(db, identifiers, args) -> dict:
+    return {'list_projects_info': summarize(timed(
+        lambda i: call(db, 'list_projects', info='true'),
+        max(args.repeat // 10, 1)))}
+
+
+def bench_get_child_cold(db, identifiers, args) -> dict:
+    deepest = max(identifiers, key=lambda x: x.count('/'))
+
+    def get(i):
+        db.cache.clear()
+        db.get_child(deepest)
+    return {'get_child_cold@depth{}'.format(deepest.count('/')):
+            summarize(timed(get, args.repeat))}
+
+
+def bench_concurrent_writers(db, identifiers, args) -> dict:
+    call(db, 'create_project', name='bench_writers')
+    names = ['w{}'.format(i) for i in range(args.threads)]
+    call(db, 'create_tasks', parent='bench_writers', names=json.dumps(names))
+    for name in names:
+        call(db, 'insert_task_result', identifier='bench_writers/' + name,
+             key='loss', value=json.dumps(['step', 'loss']), val_type='table')
+    latencies = [[] for _ in names]
+
+    def writer(w):
+        identifier = 'bench_writers/' + names[w]
+        latencies[w] = timed(
+            lambda i: call(db, 'append_task_result', identifier=identifier,
+                           key='loss', value=json.dumps([i, 0.5]),
+                           val_type='table'), args.repeat)
+
+    threads = [threading.Thread(target=writer, args=(w,))
+               for w in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'concurrent_writers@{}'.format(args.threads): summarize(
+        [x for w in latencies for x in w], elapsed)}
+
+
+def compare(results: dict, baseline: dict, threshold: float,
+            metric: str = 'p50_ms') -> list:
+    """Compare the latencies of a run with a baseline run.
+    :return: Names of the benchmarks that regressed.
+    """
+    if results['shape'] != baseline.get('shape'):
+        print('Warning: the baseline has a different shape', file=sys.stderr)
+    regressions = []
+    for name, stats in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        change = stats[metric] / base[metric] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:40s} {:10.4f} ms {:10.4f} ms {:+7.1%}{}'.format(
+            name, base[metric], stats[metric], change,
+            '  REGRESSION' if regressed else ''), file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--projects', default=4, type=int)
+    parser.add_argument('--tasks', default=25, type=int,
+                        help='Number of tasks per project')
+    parser.add_argument('--depth', default=2, type=int,
+                        help='Depth of the subtasks under every task')
+    parser.add_argument('--rows', default=100, type=int,
+                        help='Number of rows of the table result of every node')
+    parser.add_argument('--repeat', default=500, type=int,
+                        help='Number of timed calls per benchmark')
+    parser.add_argument('--append-sizes', nargs='+', default=APPEND_SIZES,
+                        type=int,
+                        help='Table sizes at which appends are timed')
+    parser.add_argument('--threads', default=8, type=int,
+                        help='Number of threads of concurrent_writers')
+    parser.add_argument('--backend', default='file', choices=['file', 'sqlite'])
+    parser.add_argument('--cache-size', default=1024, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--only', nargs='+', default=None, choices=BENCHMARKS)
+    parser.add_argument('--dbpath', default=None,
+                        help='Database directory (a temporary one by default)')
+    parser.add_argument('--output', default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', default=0.2, type=float,
+                        help='Allowed growth of the latency over the '
+                             'baseline, e.g. 0.2 for 20%%')
+    parser.add_argument('--metric', default='p50_ms',
+                        choices=['mean_ms', 'p50_ms', 'p99_ms'],
+                        help='Latency compared with the baseline')
+    args = parser.parse_args()
+
+    path = args.dbpath or tempfile.mkdtemp(prefix='footprint-bench-')
+    shape = {k: getattr(args, k) for k in [
+        'projects', 'tasks', 'depth', 'rows', 'repeat', 'append_sizes',
+        'threads', 'backend', 'cache_size', 'seed']}
+    try:
+        db = Database(path, cache_size=args.cache_size, backend=args.backend)
+        start = time.perf_counter()
+        identifiers = build_database(db, args)
+        build_time = time.perf_counter() - start
+        benchmarks = {}
+        for name in args.only or BENCHMARKS:
+            benchmarks.update(globals()['bench_' + name](db, identifiers,
+                                                         args))
+        db.close()
+    finally:
+        if args.dbpath is None:
+            shutil.rmtree(path)
+
+    results = {
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'shape': shape,
+        'build_sec': round(build_time, 3),
+        'benchmarks': benchmarks
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold,
+                              args.metric)
+        if regressions:
+            print('{} benchmark(s) regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
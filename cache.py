@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class NodeCache(object):
+    """LRU cache of parsed Project/Task nodes keyed by identifier. Writes go
+    through the cached nodes, so entries are only invalidated when nodes are
+    removed or changed elsewhere.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.nodes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, identifier: str):
+        with self.lock:
+            node = self.nodes.get(identifier)
+            if node is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.nodes.move_to_end(identifier)
+            return node
+
+    def put(self, identifier: str, node):
+        """Cache a node unless another thread has cached it first.
+        :return: The cached node, which callers should use from then on so
+        that all writers share the same object.
+        """
+        if self.size <= 0:
+            return node
+        with self.lock:
+            node = self.nodes.setdefault(identifier, node)
+            self.nodes.move_to_end(identifier)
+            while len(self.nodes) > self.size:
+                self.nodes.popitem(last=False)
+            return node
+
+    def invalidate(self, identifier: str, descendants: bool = True):
+        """Drop a node and, by default, all of its descendants."""
+        prefix = identifier + '/'
+        with self.lock:
+            self.nodes.pop(identifier, None)
+            if descendants:
+                for key in [k for k in self.nodes if k.startswith(prefix)]:
+                    del self.nodes[key]
+
+    def clear(self):
+        with self.lock:
+            self.nodes.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.nodes),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
@@ -0,0 +1,380 @@
+"""Client of the footprint server for training jobs.
+
+    from client import Client
+
+    fp = Client('http://127.0.0.1:8000')
+    fp.create_task(parent='proj', name='run1')
+    fp.insert_result('proj/run1', 'loss', ['step', 'loss'], 'plot2d')
+    for step in range(1000):
+        fp.append_result('proj/run1', 'loss', [step, 1 / (step + 1)])
+    fp.close()
+
+append_result(), insert_result() and delete_result() only queue the
+operation; a background thread sends them in batches with retries. Other
+ops of Database.ops can be called as methods and wait for the response.
+"""
+import json
+import time
+import shutil
+import queue
+import random
+import atexit
+import logging
+import threading
+import http.client
+from urllib.parse import urlencode, urlsplit
+
+from artifacts import parse_ref
+from wire import (COMPRESS_MIN_SIZE, FORM, JSON, MSGPACK, TYPED, codings,
+                  compress, decompress, dumps, loads, require_msgpack)
+
+logger = logging.getLogger()
+
+# Responses with these statuses are retried, as are requests that could
+# not be sent. A request failing after it was sent may have been applied by
+# the server and is not retried, so that its operations are not repeated.
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ClientError(Exception):
+    """An operation failed on the server."""
+    pass
+
+
+class TransportError(Exception):
+    """The server could not be reached, or did not respond.
+    :param sent: Whether the request was sent before it failed.
+    """
+
+    def __init__(self, msg: str, sent: bool = False):
+        super().__init__(msg)
+        self.sent = sent
+
+
+def encode_arg(value) -> str:
+    if type(value) is str:
+        return value
+    if type(value) is bool:
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return json.dumps(value)
+
+
+class HttpTransport(object):
+    """Pool of keep-alive HTTP connections to a server."""
+
+    def __init__(self, url: str, pool_size: int = 4, timeout: float = 30,
+                 encoding: str = 'form'):
+        """
+        :param encoding: 'form', or 'json' or 'msgpack' to send the
+        arguments of ops as typed objects, compressed if they are large.
+        """
+        if encoding not in {'form', 'json', 'msgpack'}:
+            raise ValueError('Unknown encoding: {}'.format(encoding))
+        if encoding == 'msgpack':
+            require_msgpack()
+        self.encoding = encoding
+        parts = urlsplit(url)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if parts.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(pool_size)
+
+    def encode(self, args: dict):
+        """Encode the arguments of an op as a request body.
+        :return: (body, headers)
+        """
+        headers = {'Accept-Encoding': ', '.join(codings())}
+        if self.encoding == 'form':
+            headers['Content-Type'] = FORM
+            return urlencode({k: encode_arg(v) for k, v in args.items()}), \
+                headers
+        content_type = MSGPACK if self.encoding == 'msgpack' else JSON
+        headers['Content-Type'] = headers['Accept'] = content_type
+        body = dumps(args, content_type)
+        if len(body) >= COMPRESS_MIN_SIZE:
+            body = compress(body, 'gzip')
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def request(self, op: str, args: dict):
+        """Call an op.
+        :return: (success, data or error message)
+        """
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            conn.request('POST', '{}/api/{}'.format(self.prefix, op),
+                         *self.encode(args))
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise TransportError(str(e))
+        try:
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise TransportError(str(e), sent=True)
+        if response.status in RETRY_STATUSES:
+            conn.close()
+            raise TransportError('HTTP {}'.format(response.status))
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        content_type = (response.getheader('Content-Type') or JSON).partition(
+            ';')[0].strip()
+        try:
+            body = loads(decompress(
+                body, response.getheader('Content-Encoding') or ''),
+                TYPED.get(content_type, JSON))
+        except (ValueError, OSError):
+            raise TransportError('Invalid response: HTTP {}'.format(
+                response.status), sent=True)
+        if response.status == 200:
+            return True, body.get('data')
+        return False, body.get('msg')
+
+    def upload(self, fileobj) -> dict:
+        """Stream a binary file to the artifact store with chunked
+        transfer encoding.
+        """
+        conn = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            conn.request('POST', '{}/artifacts'.format(self.prefix), fileobj,
+                         {'Content-Type': 'application/octet-stream'},
+                         encode_chunked=True)
+            response = conn.getresponse()
+            body = json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise TransportError(str(e))
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise ClientError(body.get('msg'))
+        return body['data']
+
+    def download(self, digest: str, fileobj):
+        conn = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            conn.request('GET', '{}/artifacts/{}'.format(self.prefix, digest))
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ClientError(json.loads(response.read()).get('msg'))
+            shutil.copyfileobj(response, fileobj)
+        except (OSError, http.client.HTTPException) as e:
+            raise TransportError(str(e))
+        finally:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class LocalTransport(object):
+    """Call the ops of a Database in the same process."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def request(self, op: str, args: dict):
+        return self.db.api(op, args)
+
+    def upload(self, fileobj) -> dict:
+        return self.db.artifacts.write(fileobj)
+
+    def download(self, digest: str, fileobj):
+        try:
+            with open(self.db.artifacts.blob_path(digest), 'rb') as f:
+                shutil.copyfileobj(f, fileobj)
+        except FileNotFoundError:
+            raise ClientError('Artifact {} does not exist'.format(digest))
+
+    def close(self):
+        self.db.close()
+
+
+class Client(object):
+    """Client of the footprint API. See the module docstring."""
+
+    def __init__(self, url: str = 'http://127.0.0.1:8000', dbpath: str = None,
+                 batch_size: int = 500, flush_interval: float = 0.5,
+                 max_queue: int = 100000, retries: int = 5,
+                 backoff: float = 0.5, timeout: float = 30,
+                 pool_size: int = 4, encoding: str = 'form', **db_args):
+        """
+        :param url: Server URL.
+        :param dbpath: Path to a database to write to directly instead of
+        through a server. Extra keyword arguments are passed to Database.
+        :param batch_size: Maximum number of queued operations per request.
+        :param flush_interval: Seconds to wait for more operations before
+        sending a batch.
+        :param max_queue: Maximum number of queued operations. Queueing
+        blocks while the queue is full.
+        :param retries: Number of retries of a request that could not be
+        sent or failed with one of RETRY_STATUSES.
+        :param backoff: Delay before the first retry in seconds, doubled for
+        every further retry.
+        :param encoding: Encoding of requests, see HttpTransport.
+        """
+        if dbpath is not None:
+            from database import Database
+            self.transport = LocalTransport(Database(dbpath, **db_args))
+        else:
+            self.transport = HttpTransport(url, pool_size, timeout, encoding)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(max_queue)
+        # Number of operations that could not be applied
+        self.failed = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='footprint-client',
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __getattr__(self, op: str):
+        if op.startswith('_'):
+            raise AttributeError(op)
+        return lambda **args: self.call(op, **args)
+
+    def call(self, op: str, **args):
+        """Call an op and wait for its result. Queued operations are sent
+        first, so that they are applied in order.
+        :raise ClientError: If the op fails.
+        """
+        self.flush()
+        success, data = self.request(op, {k: v for k, v in args.items()
+                                          if v is not None})
+        if not success:
+            raise ClientError(data)
+        return data
+
+    def request(self, op: str, args: dict):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.transport.request(op, args)
+            except TransportError as e:
+                if e.sent or attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                delay *= random.uniform(0.5, 1.5)
+                logger.warning('{} failed ({}), retrying in {:.2f}s'.format(
+                    op, e, delay))
+                time.sleep(delay)
+
+    def upload(self, path) -> str:
+        """Store a file as an artifact. Content already in the store is
+        only kept once.
+        :param path: Path or binary file object.
+        :return: The 'sha256:<hex>' value referencing it.
+        """
+        if isinstance(path, str):
+            with open(path, 'rb') as f:
+                return self.transport.upload(f)['value']
+        return self.transport.upload(path)['value']
+
+    def download(self, value: str, path):
+        """Save the artifact referenced by a 'file' value.
+        :param path: Path or binary file object.
+        """
+        digest = parse_ref(value)
+        if digest is None:
+            raise ClientError('{} is not an artifact'.format(value))
+        if isinstance(path, str):
+            with open(path, 'wb') as f:
+                self.transport.download(digest, f)
+        else:
+            self.transport.download(digest, path)
+
+    def enqueue(self, operation: dict):
+        if self.closed:
+            raise ClientError('Client is closed')
+        self.queue.put(operation)
+
+    def append_result(self, identifier: str, key: str, row,
+                      val_type: str = 'plot2d'):
+        """Queue a row to append to a table or plot2d result."""
+        self.enqueue({'op': 'append', 'identifier': identifier, 'key': key,
+                      'value': row, 'val_type': val_type})
+
+    def insert_result(self, identifier: str, key: str, value, val_type: str,
+                      overwrite: bool = False):
+        """Queue the insertion of a result."""
+        self.enqueue({'op': 'insert', 'identifier': identifier, 'key': key,
+                      'value': value, 'val_type': val_type,
+                      'overwrite': overwrite})
+
+    def delete_result(self, identifier: str, key: str):
+        """Queue the deletion of a result."""
+        self.enqueue({'op': 'delete', 'identifier': identifier, 'key': key})
+
+    def run(self):
+        while True:
+            operation = self.queue.get()
+            if operation is None:
+                self.queue.task_done()
+                return
+            batch = [operation]
+            deadline = time.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    operation = self.queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if operation is None:
+                    stop = True
+                    break
+                batch.append(operation)
+            self.send(batch)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def send(self, batch: list):
+        try:
+            success, status = self.request('batch_task_results',
+                                           {'operations': batch})
+        except TransportError as e:
+            logger.error('Dropped {} operations: {}'.format(len(batch), e))
+            self.failed += len(batch)
+            return
+        if not success:
+            logger.error('Batch failed: {}'.format(status))
+            self.failed += len(batch)
+            return
+        for operation, rst in zip(batch, status):
+            if not rst['success']:
+                logger.warning('{} of {} {} failed: {}'.format(
+                    operation['op'], operation['identifier'],
+                    operation['key'], rst['msg']))
+                self.failed += 1
+
+    def flush(self):
+        """Wait until all queued operations are sent."""
+        if threading.current_thread() is not self.thread:
+            self.queue.join()
+
+    def close(self):
+        """Send the queued operations and stop the client."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.transport.close()
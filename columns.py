@@ -0,0 +1,151 @@
+import io
+import os
+import shutil
+import hashlib
+
+from downsample import np, require_numpy
+from utils import read_json, atomic_write_json
+
+DTYPE = '<f8'
+# Rows are converted to lists in chunks of this many when iterated
+ITER_CHUNK = 4096
+
+
+def npy_header(count: int) -> bytes:
+    f = io.BytesIO()
+    np.lib.format.write_array_header_1_0(f, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(DTYPE)),
+        'fortran_order': False,
+        'shape': (count,)
+    })
+    return f.getvalue()
+
+
+class ColumnRows(object):
+    """Read-only sequence of the rows of memory-mapped columns.
+    Slicing returns lists of rows, so it can stand in for the list of rows
+    of a table or plot2d result, while column() gives zero-copy arrays.
+    """
+
+    def __init__(self, columns: list, count: int):
+        self.columns = columns
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            return self.take(np.arange(start, stop, step))
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('row index out of range')
+        return [c[index].item() for c in self.columns]
+
+    def __iter__(self):
+        for start in range(0, self.count, ITER_CHUNK):
+            yield from self[start:start + ITER_CHUNK]
+
+    def __add__(self, other):
+        return self[:] + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self[:]
+
+    def column(self, index: int):
+        return self.columns[index]
+
+    def take(self, indices) -> list:
+        """Get the rows at the given indices as lists."""
+        if not self.columns:
+            return [[] for _ in indices]
+        return np.column_stack([c[indices] for c in self.columns]).tolist()
+
+
+class ColumnStore(object):
+    """Numeric rows of a result stored column by column, as float64 .npy
+    files. header.json holds the number of committed rows and is written
+    last, so readers never see partially written rows.
+    """
+
+    def __init__(self, columns_dir: str, key: str):
+        self.path = os.path.join(columns_dir,
+                                 hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    @property
+    def header_path(self) -> str:
+        return os.path.join(self.path, 'header.json')
+
+    def column_path(self, index: int) -> str:
+        return os.path.join(self.path, 'c{}.npy'.format(index))
+
+    def header(self):
+        if os.path.exists(self.header_path):
+            return read_json(self.header_path)
+        return None
+
+    def count(self) -> int:
+        header = self.header()
+        return header['count'] if header else 0
+
+    def append(self, rows: list) -> int:
+        """Append rows to the columns.
+        :return: Number of bytes written.
+        """
+        require_numpy()
+        if not rows:
+            return 0
+        try:
+            array = np.array(rows, dtype=DTYPE)
+        except (TypeError, ValueError):
+            raise ValueError('Columnar results only accept rows of numbers')
+        if array.ndim != 2:
+            raise ValueError('Rows of columnar results must have the same '
+                             'number of values')
+        header = self.header()
+        if header is None:
+            os.makedirs(self.path, exist_ok=True)
+            header = {'columns': array.shape[1], 'count': 0,
+                      'offsets': [len(npy_header(0))] * array.shape[1]}
+        elif array.shape[1] != header['columns']:
+            raise ValueError('Rows must have {} values'.format(
+                header['columns']))
+        count = header['count'] + len(array)
+        for i in range(header['columns']):
+            self.append_column(i, header['offsets'][i], header['count'],
+                               array[:, i])
+        atomic_write_json(self.header_path, dict(header, count=count))
+        return array.nbytes
+
+    def append_column(self, index: int, offset: int, committed: int, values):
+        path = self.column_path(index)
+        count = committed + len(values)
+        header = npy_header(count)
+        if len(header) != offset:
+            raise ValueError('Unexpected header size of {}'.format(path))
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            # Anything after the committed rows is left over from a failed
+            # append and is overwritten
+            f.seek(offset + committed * values.itemsize)
+            f.write(np.ascontiguousarray(values).tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header)
+
+    def read(self) -> ColumnRows:
+        require_numpy()
+        header = self.header()
+        if header is None or not header['count']:
+            return ColumnRows([np.empty(0)] * (header or {}).get('columns', 0),
+                              0)
+        count = header['count']
+        return ColumnRows([np.memmap(self.column_path(i), dtype=DTYPE,
+                                     mode='r', offset=offset, shape=(count,))
+                           for i, offset in enumerate(header['offsets'])],
+                          count)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
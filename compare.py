@@ -0,0 +1,135 @@
+import warnings
+import threading
+
+from downsample import np, require_numpy, to_array
+
+
+def to_list(a) -> list:
+    """Convert an array to a list with NaN replaced by None for JSON."""
+    a = np.asarray(a, dtype=float)
+    return np.where(np.isnan(a), None, a.astype(object)).tolist()
+
+
+def align(series: list):
+    """Align series of different runs on the union of their steps.
+    :param series: List of (steps, values) array pairs, one per run.
+    :return: (steps, values) where values has shape (runs, steps) and is
+    NaN where a run has no value at a step.
+    """
+    if not series:
+        return np.empty(0), np.empty((0, 0))
+    steps = np.unique(np.concatenate([x for x, _ in series]))
+    values = np.full((len(series), len(steps)), np.nan)
+    for i, (x, y) in enumerate(series):
+        values[i, np.searchsorted(steps, x)] = y
+    return steps, values
+
+
+def aggregate(values, mode: str = 'max') -> dict:
+    """Aggregate values across runs (the first axis), ignoring NaN.
+    :param mode: 'max' or 'min', whether the best run has the largest or the
+    smallest value.
+    :return: Mean, standard deviation, minimum, maximum, number of runs and
+    index of the best run (-1 if no run has a value).
+    """
+    if mode not in {'max', 'min'}:
+        raise ValueError('Unknown mode: {}'.format(mode))
+    missing = np.isnan(values)
+    count = (~missing).sum(axis=0)
+    with warnings.catch_warnings():
+        # All-NaN slices give NaN, which is what we want
+        warnings.simplefilter('ignore', RuntimeWarning)
+        stats = {
+            'mean': np.nanmean(values, axis=0),
+            'std': np.nanstd(values, axis=0),
+            'min': np.nanmin(values, axis=0),
+            'max': np.nanmax(values, axis=0)
+        }
+    if mode == 'max':
+        best = np.argmax(np.where(missing, -np.inf, values), axis=0)
+    else:
+        best = np.argmin(np.where(missing, np.inf, values), axis=0)
+    best = np.where(count > 0, best, -1)
+    rst = {k: to_list(v) for k, v in stats.items()}
+    rst['count'] = count.tolist()
+    rst['best'] = best.tolist()
+    return rst
+
+
+def last_values(values):
+    """Get the last non-NaN value of every run, NaN if there is none."""
+    valid = ~np.isnan(values)
+    last = values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    return np.where(valid.any(axis=1),
+                    values[np.arange(len(values)), last], np.nan)
+
+
+def compare(runs: list, mode: str = 'max') -> dict:
+    """Compare a result across runs.
+    :param runs: List of (identifier, value), where value is a number for
+    scalar results or a (steps, values) array pair for series.
+    :param mode: 'max' or 'min', see aggregate().
+    """
+    require_numpy()
+    identifiers = [identifier for identifier, _ in runs]
+    if all(isinstance(v, tuple) for _, v in runs):
+        steps, values = align([v for _, v in runs])
+        final = last_values(values)
+        best = aggregate(final, mode)['best']
+        return {
+            'type': 'series',
+            'runs': identifiers,
+            'steps': to_list(steps),
+            'values': [to_list(v) for v in values],
+            'aggregate': aggregate(values, mode),
+            'final': to_list(final),
+            'best_run': identifiers[best] if best >= 0 else None
+        }
+    if any(isinstance(v, tuple) for _, v in runs):
+        raise ValueError('Cannot compare series with scalars')
+    values = to_array([v for _, v in runs])
+    rst = aggregate(values, mode)
+    best = rst.pop('best')
+    return {
+        'type': 'scalar',
+        'runs': identifiers,
+        'values': to_list(values),
+        'aggregate': dict(rst, best=identifiers[best] if best >= 0 else None)
+    }
+
+
+class ComparisonCache(object):
+    """Cache of comparisons by parent identifier. A write to any node in the
+    subtree of a parent drops the comparisons of that parent.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # Bumped on every invalidation, so that a comparison computed while
+        # a write happened is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value, self.generation
+
+    def put(self, key: tuple, value, generation: int):
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = value
+
+    def invalidate(self, identifier: str):
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.entries
+                        if identifier == k[0] or identifier.startswith(k[0] + '/')
+                        or not k[0]]:
+                del self.entries[key]
@@ -2,9 +2,31 @@ import os
 import re
 import json
 import time
-import shutil
+import atexit
 import logging
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from artifacts import ArtifactStore, dict_refs, entry_ref, parse_ref
+from cache import NodeCache
+from columns import ColumnRows
+from compare import ComparisonCache, compare
+from downsample import (Rollup, build_rollup, downsample, np, require_numpy,
+                        to_array)
+from journal import Journal
+from locking import LockManager
+from metrics import Profiler, op_errors, op_latency, registry, render_values
+from pubsub import Broker
+from reaper import DEFAULT_RATE, Reaper
+from retention import RetentionEngine, RetentionPolicy
+from search_index import SearchIndex
+from storage import Storage, create_storage
+from tree_index import CHILD_KEYS, TreeIndex
+from versions import PARTS, Versions
+from writebehind import WriteBehind
 
 logger = logging.getLogger()
 
@@ -14,23 +36,84 @@ root = os.path.dirname(os.path.abspath(__file__))
 # proj_dir_path = os.path.join(db_dir_path, 'projects')
 # ROOT = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_DB_PATH = os.path.join(root, 'database')
+# Number of threads reading tasks for compare_task_results
+COMPARE_WORKERS = 8
+# Rows of results with more rows than this are read from the storage on
+# every read instead of being kept with the cached node
+MAX_CACHED_ROWS = 10000
 
-boolean = lambda x : x if type(x) is bool else x.lower() == 'true'
+boolean = lambda x : x.lower() == 'true' if type(x) is str else bool(x)
 
 def validate_name(name: str) -> bool:
     return re.match('^[0-9a-zA-Z _-]{2,50}$', name) is not None
 
 
+def from_json(value):
+    """Parse a JSON value of an op. Clients sending typed request bodies
+    (see wire.py) may give it already parsed.
+    """
+    return json.loads(value) if type(value) is str else value
+
+
+def to_text(value) -> str:
+    return value if type(value) is str else json.dumps(value)
+
+
+def convert_arg(value, arg_type):
+    """Convert an op argument to the type of the op. Lists and objects of
+    typed request bodies are passed to string arguments as they are, for the
+    op to take them as parsed JSON values.
+    """
+    if value is None or arg_type is None:
+        return value
+    if arg_type is str and type(value) is not str:
+        return value if isinstance(value, (list, dict)) else json.dumps(value)
+    return arg_type(value)
+
+
 class Container(object):
-    def __init__(self):
+    def __init__(self, storage: Storage = None, identifier: str = ''):
         self.metadata = {}
-        self.metadata_path = None
+        self.storage = storage
+        self.identifier = identifier
+        self.batch_depth = 0
+        self.dirty = False
 
     def read_metadata(self):
-        return json.load(open(self.metadata_path, 'r', encoding='utf-8'))
+        return self.storage.read_metadata(self.identifier) or {}
 
     def save_metadata(self):
-        json.dump(self.metadata, open(self.metadata_path, 'w', encoding='utf-8'))
+        if self.batch_depth:
+            self.dirty = True
+        else:
+            self.write_metadata()
+
+    def write_metadata(self):
+        self.storage.write_metadata(self.identifier, self.metadata)
+        self.dirty = False
+
+    @contextmanager
+    def batch(self):
+        """Defer saving the metadata until the outermost batch block exits,
+        so that any number of changes made inside it cost a single write.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth and self.dirty:
+                self.write_metadata()
+
+    def update_metadata(self, metadata: dict):
+        """Add multiple key-value pairs to the metadata with a single write.
+        Existing values will be overwritten.
+        :param metadata: Key-value pairs to add.
+        """
+        # Metadata is replaced rather than modified in place so that lock-free
+        # readers always see a consistent snapshot
+        self.metadata = dict(self.metadata, **metadata)
+        self.save_metadata()
 
     def add_metadata(self, key: str, val):
         """Add a key-value pair to the metadata.
@@ -38,14 +121,16 @@ class Container(object):
         :param key: Key to add.
         :param val: Value to add.
         """
-        self.metadata[key] = val
+        self.metadata = dict(self.metadata, **{key: val})
         self.save_metadata()
 
     def delete_metadata(self, key: str):
         """Remove a key-value pair from the metadata.
         A KeyError will be raised if the key does not exist.
         """
-        val = self.metadata.pop(key)
+        metadata = dict(self.metadata)
+        val = metadata.pop(key)
+        self.metadata = metadata
         self.save_metadata()
         return val
 
@@ -56,14 +141,32 @@ class Container(object):
         """
         if key in self.metadata:
             if type(self.metadata[key]) is list:
-                self.metadata[key].append(item)
+                self.metadata = dict(self.metadata,
+                                     **{key: self.metadata[key] + [item]})
                 self.save_metadata()
             else:
                 raise TypeError('{} is not a list type value'.format(key))
         else:
-            self.metadata[key] = [item]
+            self.metadata = dict(self.metadata, **{key: [item]})
             self.save_metadata()
 
+    def trash_child(self, key: str, name: str):
+        """Delete a child, leaving its data to the Reaper.
+        :param key: Metadata key of the child list.
+        """
+        identifier = '{}/{}'.format(self.identifier, name) \
+            if self.identifier else name
+        token = self.storage.trash_node(identifier)
+        with self.batch():
+            self.remove_metadata_item(key, name)
+            if token is not None:
+                self.add_tombstone(token, name)
+
+    def add_tombstone(self, token: str, name: str):
+        tombstones = dict(self.metadata.get('tombstones', {}))
+        tombstones[token] = name
+        self.add_metadata('tombstones', tombstones)
+
     def remove_metadata_item(self, key: str, item: str):
         """Remove a value from a list type metadata value.
         :param key: Metadata key.
@@ -71,7 +174,9 @@ class Container(object):
         """
         if key in self.metadata:
             if type(self.metadata[key]) is list:
-                self.metadata[key].remove(item)
+                items = list(self.metadata[key])
+                items.remove(item)
+                self.metadata = dict(self.metadata, **{key: items})
                 self.save_metadata()
             else:
                 raise TypeError('{} is not a list type value'.format(key))
@@ -80,20 +185,45 @@ class Container(object):
 
 
 class Dict(object):
+    name = None
 
-    def __init__(self, path):
-        self.path = path
+    def __init__(self, storage: Storage, identifier: str):
+        self.storage = storage
+        self.identifier = identifier
         self.allowed_types = {}
         self.formatters = {}
         self.dictionary = {}
+        self.batch_depth = 0
+        self.dirty = False
         self.load()
 
     def load(self):
-        if os.path.exists(self.path):
-            self.dictionary = json.load(open(self.path, 'r', encoding='utf-8'))
+        self.dictionary = self.storage.read_dict(self.identifier, self.name)
 
     def save(self):
-        json.dump(self.dictionary, open(self.path, 'w', encoding='utf-8'))
+        if self.batch_depth:
+            self.dirty = True
+        else:
+            self.write()
+
+    def write(self):
+        self.storage.write_dict(self.identifier, self.name, self.dictionary)
+        self.dirty = False
+
+    def flush(self):
+        if self.dirty:
+            self.write()
+
+    @contextmanager
+    def batch(self):
+        """Defer saving until the outermost batch block exits."""
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush()
 
     def insert(self, key, value, val_type='str', overwrite: bool = False):
         if val_type not in self.allowed_types:
@@ -104,30 +234,50 @@ class Dict(object):
         self.save()
 
     def delete(self, key):
-        return self.dictionary.pop(key)
+        val = self.dictionary.pop(key)
+        self.save()
+        return val
 
     def get(self, key):
         return self.dictionary.get(key)
 
+    def to_dict(self):
+        # A shallow copy is enough for lock-free readers to serialize it
+        # while a writer inserts or deletes keys
+        return dict(self.dictionary)
+
     def append(self, key, value, val_type):
         raise NotImplementedError()
 
 
 class Result(Dict):
-    def __init__(self, path):
-        super().__init__(path)
+    name = 'result'
+    # Rows of these types are kept in append-only row logs of the storage
+    log_types = {'table', 'plot2d'}
+
+    def __init__(self, storage: Storage, identifier: str):
+        # Rows read from the segment logs, kept up to date by append()
+        self.rows = {}
+        # Rows appended inside a batch block, written to the logs on flush
+        self.pending = {}
+        # Min/max rollups of plot2d results, kept up to date by append()
+        self.rollups = {}
+        # Number of values per row of columnar results
+        self.widths = {}
+        self.rows_lock = threading.RLock()
+        super().__init__(storage, identifier)
         self.allowed_types = {'str', 'int', 'float', 'list', 'file',
                               'table', 'plot2d', 'html', 'json'}
         self.formatters = {
-            'str': lambda x: x,
-            'file': lambda x: x,
+            'str': to_text,
+            'file': to_text,
             'int': lambda x: int(x),
             'float': lambda x: float(x),
-            'list': lambda x: json.loads(x),
-            'json': lambda x: json.loads(x),
-            'html': lambda x: x,
-            'table': lambda x: {'cols': json.loads(x), 'data': []},
-            'plot2d': lambda x: {'series': json.loads(x), 'data': []}
+            'list': from_json,
+            'json': from_json,
+            'html': to_text,
+            'table': lambda x: {'cols': from_json(x), 'data': []},
+            'plot2d': lambda x: {'series': from_json(x), 'data': []}
         }
 
     def table_formatter(self, value: str):
@@ -136,25 +286,333 @@ class Result(Dict):
     def plot2d_formatter(self, value: str):
         pass
 
+    def is_logged(self, key) -> bool:
+        return (key in self.dictionary
+                and self.dictionary[key]['type'] in self.log_types)
+
+    def is_columnar(self, key) -> bool:
+        """Check if the rows of a result are stored as numeric columns."""
+        return self.dictionary.get(key, {}).get('columnar', False)
+
+    def get_rows(self, key) -> list:
+        with self.rows_lock:
+            if self.is_columnar(key):
+                # Columns are memory-mapped on every read instead of cached
+                rows = self.storage.read_columns(self.identifier, key)
+                pending = self.pending.get(key)
+                return rows + pending if pending else rows
+            if key in self.rows:
+                return self.rows[key]
+            rows = (self.storage.read_rows(self.identifier, key)
+                    + self.pending.get(key, []))
+            if len(rows) <= MAX_CACHED_ROWS:
+                self.rows[key] = rows
+            return rows
+
+    def clear_rows(self, key):
+        with self.rows_lock:
+            if self.is_columnar(key):
+                self.storage.clear_columns(self.identifier, key)
+            else:
+                self.storage.clear_rows(self.identifier, key)
+            self.rows.pop(key, None)
+            self.pending.pop(key, None)
+            self.rollups.pop(key, None)
+            self.widths.pop(key, None)
+
+    def append_rows(self, key, rows: list):
+        if self.is_columnar(key):
+            self.storage.append_columns(self.identifier, key, rows)
+        else:
+            self.storage.append_rows(self.identifier, key, rows)
+
+    def flush(self):
+        with self.rows_lock:
+            pending, self.pending = self.pending, {}
+            for key, rows in pending.items():
+                self.append_rows(key, rows)
+        super().flush()
+
+    def insert(self, key, value, val_type='str', overwrite: bool = False,
+               columnar: bool = False):
+        """Insert a result.
+        :param columnar: Store the rows of a table or plot2d result as
+        numeric columns instead of JSON. Its rows must then be lists of
+        numbers of the same length.
+        """
+        if columnar and val_type not in self.log_types:
+            raise ValueError('Only table and plot2d results can be columnar')
+        if columnar and not self.storage.supports_columns:
+            raise ValueError('Columnar results are not supported by this '
+                             'storage backend')
+        inserted = key not in self.dictionary or overwrite
+        if self.is_logged(key) and overwrite:
+            self.clear_rows(key)
+        with self.batch():
+            super().insert(key, value, val_type, overwrite)
+            if columnar and inserted:
+                self.dictionary[key]['columnar'] = True
+
+    def delete(self, key):
+        if self.is_logged(key):
+            self.clear_rows(key)
+        return super().delete(key)
+
     def append(self, key, value, val_type):
         if val_type in {'table', 'plot2d'}:
-            self.dictionary[key]['value']['data'].append(json.loads(value))
+            if key not in self.dictionary:
+                raise ValueError('Result {} does not exist'.format(key))
+            if self.is_logged(key):
+                # Only the row log is touched, the dictionary is unchanged
+                row = from_json(value)
+                with self.rows_lock:
+                    # Checked before the row is stored, so that a rejected
+                    # row is not written
+                    if self.is_columnar(key):
+                        self.check_columnar_row(key, row)
+                    else:
+                        self.check_row(key, row)
+                    if self.batch_depth:
+                        self.pending.setdefault(key, []).append(row)
+                    else:
+                        self.append_rows(key, [row])
+                    if key in self.rows:
+                        self.rows[key].append(row)
+                        if len(self.rows[key]) > MAX_CACHED_ROWS:
+                            del self.rows[key]
+                    if key in self.rollups:
+                        self.rollups[key].append(row[1:])
+                return
+            self.dictionary[key]['value']['data'].append(from_json(value))
         else:
             raise ValueError('Unknown value type: {}'.format(val_type))
         self.save()
 
+    def check_row(self, key, row):
+        value = self.dictionary[key]['value']
+        names = value.get('cols', value.get('series'))
+        if type(row) is not list:
+            raise ValueError('Rows of result {} must be lists'.format(key))
+        if type(names) is list and len(row) != len(names):
+            raise ValueError('Rows of result {} must have {} values'.format(
+                key, len(names)))
+
+    def check_columnar_row(self, key, row):
+        if (type(row) is not list or not row
+                or not all(type(v) in {int, float} for v in row)):
+            raise ValueError('Rows of columnar result {} must be lists of '
+                             'numbers'.format(key))
+        if key not in self.widths:
+            rows = self.get_rows(key)
+            self.widths[key] = len(rows[0]) if len(rows) else len(row)
+        if len(row) != self.widths[key]:
+            raise ValueError('Rows of result {} must have {} values'.format(
+                key, self.widths[key]))
+
+    def restore(self, key, entry: dict = None):
+        """Put a logged value back together from the dictionary and its row
+        log. Rows stored inline (written before the log was used) come first.
+        """
+        entry = entry or self.dictionary[key]
+        value = dict(entry['value'])
+        value['data'] = value.get('data', []) + self.get_rows(key)
+        return dict(entry, value=value)
+
+    def get(self, key):
+        if self.is_logged(key):
+            return self.restore(key)
+        return super().get(key)
+
+    def get_data(self, key) -> list:
+        """Get all rows of a table or plot2d result. Rows are numbered from 0
+        in this order.
+        """
+        entry = self.dictionary.get(key)
+        if entry is None:
+            raise ValueError('Result {} does not exist'.format(key))
+        if entry['type'] not in self.log_types:
+            raise ValueError('Result {} is not a table or plot2d'.format(key))
+        inline = entry['value'].get('data')
+        rows = self.get_rows(key)
+        return inline + rows if inline else rows
+
+    def count_rows(self, key) -> int:
+        inline = len(self.dictionary[key]['value'].get('data', []))
+        with self.rows_lock:
+            if self.is_columnar(key):
+                return inline + len(self.get_rows(key))
+            if key in self.rows:
+                return inline + len(self.rows[key])
+            return (inline + self.storage.count_rows(self.identifier, key)
+                    + len(self.pending.get(key, [])))
+
+    def window(self, key, data: list, **info) -> dict:
+        """Build a result entry that only carries the given rows."""
+        entry = self.dictionary[key]
+        return dict(entry, value=dict(entry['value'], data=data), **info)
+
+    def get_page(self, key, offset: int = 0, limit: int = None) -> dict:
+        """Get the rows of a result from an offset.
+        :param offset: Number of the first row. Negative offsets count from
+        the end.
+        :param limit: Maximum number of rows.
+        """
+        data = self.get_data(key)
+        total = len(data)
+        if offset < 0:
+            offset = max(total + offset, 0)
+        end = total if limit is None else min(offset + limit, total)
+        return self.window(key, data[offset:end], offset=offset, total=total)
+
+    def get_since(self, key, after: int = -1) -> dict:
+        """Get the rows numbered after a sequence number, so that clients
+        can refresh incrementally with the returned 'seq'.
+        """
+        data = self.get_data(key)
+        return self.window(key, data[after + 1:], offset=after + 1,
+                           total=len(data), seq=len(data) - 1)
+
+    def get_range(self, key, start: float = None, end: float = None,
+                  column=0) -> dict:
+        """Get the rows whose value in a column (e.g., the step or time) is
+        within [start, end].
+        :param column: Column index or name, the first column by default.
+        """
+        data = self.get_data(key)
+        column = self.column_index(key, column)
+        if isinstance(data, ColumnRows):
+            x = data.column(column)
+            mask = np.ones(len(x), dtype=bool)
+            if start is not None:
+                mask &= x >= start
+            if end is not None:
+                mask &= x <= end
+            data = data.take(np.flatnonzero(mask))
+            return self.window(key, data, total=len(data))
+        data = [row for row in data
+                if (start is None or row[column] >= start)
+                and (end is None or row[column] <= end)]
+        return self.window(key, data, total=len(data))
+
+    def column_index(self, key, column) -> int:
+        """Get the index of a column of a table or plot2d result.
+        :param column: Column index, or its name or index as a string.
+        """
+        if type(column) is str:
+            value = self.dictionary[key]['value']
+            names = value.get('cols', value.get('series')) or []
+            if column.lstrip('-').isdigit():
+                column = int(column)
+            elif column in names:
+                column = names.index(column)
+            else:
+                raise ValueError('Unknown column: {}'.format(column))
+        return column
+
+    def downsample(self, key, points: int, method: str = 'minmax') -> dict:
+        """Downsample a plot2d result to about the given number of points per
+        series, using a min/max rollup kept up to date by append().
+        :param method: 'minmax' or 'lttb'.
+        """
+        entry = self.dictionary.get(key)
+        if entry is None or entry['type'] != 'plot2d':
+            raise ValueError('Result {} is not a plot2d'.format(key))
+        with self.rows_lock:
+            data = self.get_data(key)
+            rollup = self.rollups.get(key)
+            if rollup is None or rollup.count != len(data):
+                if isinstance(data, ColumnRows):
+                    rollup = Rollup.build(np.column_stack(data.columns[1:]))
+                else:
+                    rollup = build_rollup(data)
+                self.rollups[key] = rollup
+            buckets = rollup.candidates(points)
+            total = len(data)
+        if not isinstance(data, ColumnRows):
+            data = data[:total]
+        return self.window(key, downsample(data, points, method, buckets),
+                           total=total)
+
+    def summarize(self) -> dict:
+        """Get the types of all results and the row counts of tables and
+        plot2d results without their rows.
+        """
+        return {key: self.summarize_entry(key, entry)
+                for key, entry in list(self.dictionary.items())}
+
+    def summarize_entry(self, key: str, entry: dict = None) -> dict:
+        if entry is None:
+            entry = self.dictionary[key]
+        if entry['type'] in self.log_types:
+            value = {k: v for k, v in entry['value'].items() if k != 'data'}
+            return dict(entry, value=value, total=self.count_rows(key))
+        return entry
+
+    def to_dict(self):
+        dictionary = super().to_dict()
+        for key, entry in dictionary.items():
+            if entry['type'] in self.log_types:
+                dictionary[key] = self.restore(key, entry)
+        return dictionary
+
+    def compact(self, key: str = None):
+        """Compact the row log of a key, or of all keys if not given."""
+        keys = [key] if key is not None else list(self.dictionary)
+        for key in keys:
+            if self.is_logged(key) and not self.is_columnar(key):
+                with self.rows_lock:
+                    self.storage.compact_rows(self.identifier, key)
+                    self.rows.pop(key, None)
+
+    def roll_up(self, key, points: int) -> dict:
+        """Replace the rows of a numeric table or plot2d result by a min/max
+        summary of about points rows per column.
+        :return: {'rows_removed': ..., 'bytes_freed': ...}, or None if the
+        result was left alone.
+        """
+        require_numpy()
+        if not self.is_logged(key) or self.is_columnar(key):
+            return None
+        with self.rows_lock:
+            if self.pending.get(key):
+                return None
+            data = list(self.get_data(key))
+            if len(data) <= points:
+                return None
+            try:
+                if np.array(data, dtype=float).ndim != 2:
+                    return None
+            except (TypeError, ValueError):
+                return None
+            kept = downsample(data, points, 'minmax')
+            freed = self.storage.replace_rows(self.identifier, key, kept)
+            self.rows.pop(key, None)
+            self.rollups.pop(key, None)
+            entry = self.dictionary[key]
+            rollup = entry.get('rollup', {})
+            self.dictionary[key] = dict(
+                entry, value=dict(entry['value'], data=[]),
+                rollup={'rows_removed': (rollup.get('rows_removed', 0)
+                                         + len(data) - len(kept)),
+                        'rows_kept': len(kept), 'points': points,
+                        'time': int(time.time())})
+            self.save()
+        return {'rows_removed': len(data) - len(kept), 'bytes_freed': freed}
+
 
 class Config(Dict):
-    def __init__(self, path):
-        super().__init__(path)
+    name = 'config'
+
+    def __init__(self, storage: Storage, identifier: str):
+        super().__init__(storage, identifier)
         self.allowed_types = {'str', 'int', 'float', 'file', 'list', 'json'}
         self.formatters = {
-            'str': lambda x: x,
-            'file': lambda x: x,
+            'str': to_text,
+            'file': to_text,
             'int': lambda x: int(x),
             'float': lambda x: float(x),
-            'list': lambda x: json.loads(x),
-            'json': lambda x: json.loads(x),
+            'list': from_json,
+            'json': from_json,
         }
 
     def append(self, key, value, val_type):
@@ -166,20 +624,15 @@ class Task(Container):
     def __init__(self,
                  name: str,
                  metadata: dict = None,
-                 path: str = ''
+                 storage: Storage = None,
+                 identifier: str = ''
                  ):
-        super().__init__()
+        super().__init__(storage, identifier)
         self.name = name
-        self.path = path
-        self.metadata_path = os.path.join(path,
-                                          'metadata.json') if path else None
-        self.config_path = os.path.join(path, 'config.json') if path else None
-        self.result_path = os.path.join(path, 'result.json') if path else None
+        self._result = None
+        self._config = None
         if metadata is None:
-            if os.path.exists(self.metadata_path):
-                self.metadata = self.read_metadata()
-            else:
-                self.metadata = {}
+            self.metadata = self.read_metadata()
         else:
             self.metadata = metadata
 
@@ -187,9 +640,7 @@ class Task(Container):
         return name in self.metadata.get('subtasks', [])
 
     def create(self):
-        os.mkdir(self.path)
-        os.mkdir(os.path.join(self.path, 'subtasks'))
-        self.save_metadata()
+        self.storage.create_node(self.identifier, self.metadata)
 
     def create_subtask(self, name: str):
         if self.has_subtask(name):
@@ -197,65 +648,76 @@ class Task(Container):
         if not validate_name(name):
             raise ValueError('Invalid task name')
 
-        task = Task(name, path=os.path.join(self.path, 'subtasks', name))
+        metadata = {
+            'name': name,
+            'identifier': '{}/{}'.format(self.metadata['identifier'], name),
+            'create_time': int(time.time()),
+            'status': 'running',
+            'subtasks': [],
+            'desc': ''
+        }
+        task = Task(name, metadata=metadata, storage=self.storage,
+                    identifier=metadata['identifier'])
         task.create()
-        task.add_metadata('name', name)
-        task.add_metadata('identifier', '{}/{}'.format(
-            self.metadata['identifier'], name))
-        task.add_metadata('create_time', int(time.time()))
-        task.add_metadata('status', 'running')
-        task.add_metadata('subtasks', [])
-        task.add_metadata('desc', '')
         self.append_metadata_item('subtasks', name)
+        return task
 
     def delete_subtask(self, name: str):
         if self.has_subtask(name):
-            shutil.rmtree(os.path.join(self.path, 'subtasks', name))
-            self.remove_metadata_item('subtasks', name)
+            self.trash_child('subtasks', name)
         else:
             raise ValueError('Subtask {} does not exists'.format(name))
 
     def get_subtask(self, name: str):
         if self.has_subtask(name):
-            return Task(name, path=os.path.join(self.path, 'subtasks', name))
+            return Task(name, storage=self.storage,
+                        identifier='{}/{}'.format(self.identifier, name))
         else:
             raise ValueError('Subtask {} does not exists'.format(name))
 
+    @property
+    def result(self):
+        if self._result is None:
+            self._result = Result(self.storage, self.identifier)
+        return self._result
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = Config(self.storage, self.identifier)
+        return self._config
+
     def insert_result(self, key: str, value: str, val_type: str,
-                      overwrite: bool = False):
-        result = Result(self.result_path)
-        result.insert(key, value, val_type, overwrite)
+                      overwrite: bool = False, columnar: bool = False):
+        self.result.insert(key, value, val_type, overwrite, columnar)
 
     def delete_result(self, key: str):
-        result = Result(self.result_path)
-        result.delete(key)
+        self.result.delete(key)
 
     def append_result(self, key: str, value: str, val_type: str):
-        result = Result(self.result_path)
-        result.append(key, value, val_type)
+        self.result.append(key, value, val_type)
 
     def get_result_value(self, key: str):
-        result = Result(self.result_path)
-        return result.get(key)
+        return self.result.get(key)
 
     def get_result(self):
-        return Result(self.result_path).dictionary
+        return self.result.to_dict()
+
+    def compact_result(self, key: str = None):
+        self.result.compact(key)
 
     def insert_config(self, key: str, value: str, val_type: str,
                       overwrite: bool = False):
-        config = Config(self.config_path)
-        config.insert(key, value, val_type, overwrite)
+        self.config.insert(key, value, val_type, overwrite)
 
     def delete_config(self, key: str):
-        config = Config(self.config_path)
-        config.delete(key)
+        self.config.delete(key)
 
     def get_config(self):
-        return Config(self.config_path).dictionary
+        return self.config.to_dict()
 
     def get_config_value(self, key: str):
-        config = Config(self.config_path)
-        return config.get(key)
+        return self.config.get(key)
 
     def create_child(self, name: str):
         return self.create_subtask(name)
@@ -280,18 +742,14 @@ class Project(Container):
     def __init__(self,
                  name: str,
                  metadata: dict = None,
-                 path: str = '',
+                 storage: Storage = None,
+                 identifier: str = ''
                  ):
-        super().__init__()
+        super().__init__(storage, identifier)
 
         self.name = name
-        self.path = path
-        self.metadata_path = os.path.join(path, 'metadata.json') if path else None
         if metadata is None:
-            if os.path.exists(self.metadata_path):
-                self.metadata = self.read_metadata()
-            else:
-                self.metadata = {}
+            self.metadata = self.read_metadata()
         else:
             self.metadata = metadata
 
@@ -299,9 +757,7 @@ class Project(Container):
         return name in self.metadata.get('tasks', [])
 
     def create(self):
-        os.mkdir(self.path)
-        os.mkdir(os.path.join(self.path, 'tasks'))
-        self.save_metadata()
+        self.storage.create_node(self.identifier, self.metadata)
 
     def create_task(self, name: str):
         if self.has_task(name):
@@ -309,27 +765,30 @@ class Project(Container):
         if not validate_name(name):
             raise ValueError('Invalid task name')
 
-        task = Task(name, path=os.path.join(self.path, 'tasks', name))
+        metadata = {
+            'name': name,
+            'create_time': int(time.time()),
+            'identifier': '{}/{}'.format(self.metadata['identifier'], name),
+            'status': 'running',
+            'desc': '',
+            'subtasks': []
+        }
+        task = Task(name, metadata=metadata, storage=self.storage,
+                    identifier=metadata['identifier'])
         task.create()
-        task.add_metadata('name', name)
-        task.add_metadata('create_time', int(time.time()))
-        task.add_metadata('identifier', '{}/{}'.format(
-            self.metadata['identifier'], name))
-        task.add_metadata('status', 'running')
-        task.add_metadata('desc', '')
-        task.add_metadata('subtasks', [])
         self.append_metadata_item('tasks', name)
+        return task
 
     def delete_task(self, name: str):
         if self.has_task(name):
-            shutil.rmtree(os.path.join(self.path, 'tasks', name))
-            self.remove_metadata_item('tasks', name)
+            self.trash_child('tasks', name)
         else:
             raise ValueError('Task {} does not exists'.format(name))
 
     def get_task(self, name: str):
         if self.has_task(name):
-            return Task(name, path=os.path.join(self.path, 'tasks', name))
+            return Task(name, storage=self.storage,
+                        identifier='{}/{}'.format(self.identifier, name))
         else:
             raise ValueError('Task {} does not exists'.format(name))
 
@@ -355,16 +814,79 @@ class Project(Container):
 class Database(Container):
     # TODO: rewrite api
     # TODO: combine similar api funcs (e.g., insert_task_config, insert_task_result)
-    def __init__(self, path: str = DEFAULT_DB_PATH):
-        super().__init__()
+    def __init__(self, path: str = DEFAULT_DB_PATH, cache_size: int = 1024,
+                 file_locks: bool = False, backend: str = 'file',
+                 write_behind: bool = False, flush_interval: float = 0.05,
+                 flush_writes: int = 1000, durability: str = 'buffer',
+                 retention: RetentionPolicy = None,
+                 retention_interval: float = 0,
+                 reap_rate: float = DEFAULT_RATE, journal: bool = False):
+        """
+        :param write_behind: Buffer result and config writes in memory and
+        write them in groups from a background thread. See WriteBehind.
+        :param flush_interval: Seconds between flushes of buffered writes.
+        :param flush_writes: Number of buffered writes that triggers a flush.
+        :param durability: 'buffer' to acknowledge buffered writes at once,
+        'fsync' to wait until they are written and synced.
+        :param retention: Policy of the retention passes, see retention.py.
+        :param retention_interval: Seconds between retention passes in the
+        background once started (see start()), 0 to only run them with
+        run_retention.
+        :param reap_rate: Bytes per second removed from the trash by the
+        Reaper, 0 for no limit.
+        :param journal: Share the database with other processes which also
+        use the journal and file locks: changes are recorded in a journal,
+        and those of the others are followed to keep what is held in memory
+        up to date. See journal.py.
+        """
+        if write_behind and file_locks:
+            raise ValueError('Write-behind can not be used with file locks')
+        if journal and not file_locks:
+            raise ValueError('The journal can only be used with file locks')
+        super().__init__(create_storage(backend, path), '')
 
         self.path = path
-        self.proj_dir_path = os.path.join(path, 'projects')
-        self.metadata_path = os.path.join(path, 'metadata.json')
-        if os.path.exists(self.metadata_path):
-            self.metadata = self.read_metadata()
+        self.cache = NodeCache(cache_size)
+        self.locks = LockManager(
+            os.path.join(path, 'locks') if file_locks else None)
+        self.broker = Broker()
+        self.comparisons = ComparisonCache()
+        self.executor = ThreadPoolExecutor(COMPARE_WORKERS)
+        self.profiler = Profiler()
+        self.artifacts = ArtifactStore(os.path.join(path, 'artifacts'),
+                                       self.locks)
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehind(self.storage, self.locks,
+                                            flush_interval, flush_writes,
+                                            durability)
+            atexit.register(self.close)
+        # Opened before anything is loaded, so that no change made meanwhile
+        # is missed
+        self.journal = None
+        self.versions = Versions()
+        if journal:
+            self.journal = Journal(os.path.join(path, 'journal'),
+                                   self.apply_changes)
+            self.versions = Versions(self.journal.epoch,
+                                     self.journal.position())
+        metadata = self.storage.read_metadata('')
+        if metadata is not None:
+            self.metadata = metadata
         else:
             self.initialize_database()
+        self.index = TreeIndex(path)
+        if journal:
+            # Other processes change the tree without updating the index
+            self.index.detach()
+        if not self.index.load(self.metadata.get('projects', [])):
+            logger.info('Building tree index...')
+            self.index.build(self.storage.read_metadata)
+        self.search = SearchIndex()
+        self.build_search_index()
+        self.retention = RetentionEngine(self, retention or RetentionPolicy(),
+                                         retention_interval)
+        self.reaper = Reaper(self.storage, reap_rate, self.drop_tombstone)
 
         self.ops = {
             'create_project': (self.create_project, [('name', str, None)]),
@@ -372,12 +894,25 @@ class Database(Container):
             'list_projects': (self.list_projects, [('info', boolean, False)]),
             'list_children': (self.list_children,
                               [('parent', str, None), ('info', boolean, False)]),
+            'list_tree': (self.list_tree,
+                          [('parent', str, ''), ('archived', boolean, None),
+                           ('status', str, None), ('offset', int, 0),
+                           ('limit', int, None), ('children', boolean, False)]),
+            'search_tasks': (self.search_tasks,
+                             [('text', str, None), ('status', str, None),
+                              ('created_after', int, None),
+                              ('created_before', int, None),
+                              ('config', str, None), ('parent', str, None),
+                              ('offset', int, 0), ('limit', int, None)]),
             'create_task': (self.create_task,
                             [('parent', str, None), ('name', str, None)]),
+            'create_tasks': (self.create_tasks,
+                             [('parent', str, None), ('names', str, None)]),
             'insert_task_result': (self.insert_task_result,
                                    [('identifier', str, None), ('key', str, None),
                                     ('value', str, None), ('val_type', str, None),
-                                    ('overwrite', boolean, False)]),
+                                    ('overwrite', boolean, False),
+                                    ('columnar', boolean, False)]),
             'delete_task_result': (self.delete_task_result,
                                    [('identifier', str, None), ('key', str, None)]),
             'insert_task_config': (self.insert_task_config,
@@ -394,10 +929,71 @@ class Database(Container):
                                       [('identifier', str, None),
                                        ('metadata', str, None)]),
             'get_task_configs': (self.get_task_configs, [('identifier', str, None)]),
-            'get_task_results': (self.get_task_results, [('identifier', str, None)]),
-            'delete_task': (self.delete_task, [('identifier', str, None)])
+            'get_task_results': (self.get_task_results,
+                                 [('identifier', str, None),
+                                  ('summary', boolean, False)]),
+            'get_task_result': (self.get_task_result,
+                                [('identifier', str, None), ('key', str, None),
+                                 ('offset', int, 0), ('limit', int, None),
+                                 ('points', int, None),
+                                 ('method', str, 'minmax')]),
+            'get_task_result_since': (self.get_task_result_since,
+                                      [('identifier', str, None),
+                                       ('key', str, None), ('after', int, -1)]),
+            'get_task_result_range': (self.get_task_result_range,
+                                      [('identifier', str, None),
+                                       ('key', str, None),
+                                       ('start', float, None),
+                                       ('end', float, None),
+                                       ('column', str, '0'),
+                                       ('points', int, None),
+                                       ('method', str, 'minmax')]),
+            'compare_task_results': (self.compare_task_results,
+                                     [('parent', str, None), ('key', str, None),
+                                      ('column', str, '1'),
+                                      ('mode', str, 'max')]),
+            'compact_task_results': (self.compact_task_results,
+                                     [('identifier', str, None),
+                                      ('key', str, None)]),
+            'delete_task': (self.delete_task, [('identifier', str, None)]),
+            'batch_task_results': (self.batch_task_results,
+                                   [('operations', str, None)]),
+            'get_cache_stats': (self.get_cache_stats, []),
+            'profile_op': (self.profile_op,
+                           [('op', str, None), ('count', int, 1)]),
+            'get_profiles': (self.get_profiles, []),
+            'get_artifact': (self.get_artifact, [('value', str, None)]),
+            'collect_artifacts': (self.collect_artifacts,
+                                  [('recount', boolean, False)]),
+            'run_retention': (self.run_retention, []),
+            'get_retention_report': (self.get_retention_report, [])
+        }
+        # Versions the responses of read ops depend on, see etag()
+        self.validators = {
+            # The info of projects holds that of their tasks
+            'list_projects': lambda args: [
+                ('', 'tree' if boolean(args.get('info', False))
+                 else 'children')],
+            'list_children': lambda args: [(args.get('parent'), 'children')],
+            'list_tree': lambda args: [('', 'tree')],
+            'get_task_configs': lambda args: [(args.get('identifier'),
+                                               'config')],
+            'get_task_results': lambda args: [(args.get('identifier'),
+                                               'result')],
+            'get_task_result': lambda args: [(args.get('identifier'),
+                                              'result')]
         }
 
+    def start(self):
+        """Start the background work of a serving process: removing the
+        trash, retention passes and following the journal.
+        """
+        self.recover_trash()
+        self.reaper.start()
+        self.retention.start()
+        if self.journal is not None:
+            self.journal.start()
+
     def initialize_database(self):
         logger.info('Initializing database...')
         self.metadata = {
@@ -405,8 +1001,245 @@ class Database(Container):
             'archived': [],
             'create_time': int(time.time())
         }
-        self.save_metadata()
-        os.mkdir(self.proj_dir_path)
+        self.storage.create_node('', self.metadata)
+
+    def build_search_index(self):
+        """Index all tasks from the summaries of the tree index and their
+        configs.
+        """
+        logger.info('Building search index...')
+        for identifier, summary in list(self.index.nodes.items()):
+            if '/' in identifier:
+                self.search.update(identifier, summary)
+                self.search.set_configs(
+                    identifier, self.storage.read_dict(identifier, 'config'))
+
+    @contextmanager
+    def writing(self, *identifiers, parts=PARTS):
+        """Hold the write locks of the given nodes ('' for the database) for a
+        read-modify-write cycle.
+        :param parts: Parts of the nodes which may change, whose versions
+        are bumped at the end. See Versions.
+        """
+        with self.locks.write(*identifiers):
+            if self.locks.file_locks:
+                for identifier in identifiers:
+                    if identifier:
+                        self.cache.invalidate(identifier, descendants=False)
+                    else:
+                        self.metadata = self.read_metadata()
+            try:
+                yield
+            finally:
+                version = None
+                try:
+                    if self.journal is not None:
+                        version = self.journal.append(identifiers, parts)
+                finally:
+                    for identifier in identifiers:
+                        self.comparisons.invalidate(identifier)
+                        self.retention.touch(identifier)
+                        self.versions.bump(identifier, parts, version)
+
+    def buffer(self, node: Task, writes: int = 1):
+        """Buffer the writes about to be made to a node in write-behind
+        mode. Must be called with the write lock of the node held.
+        :return: A ticket to pass to commit() once the lock is released.
+        """
+        if self.write_behind is not None:
+            return self.write_behind.buffer(node, writes)
+
+    def commit(self, ticket):
+        """Wait until buffered writes are as durable as configured."""
+        if ticket is not None:
+            self.write_behind.wait(ticket)
+
+    def close(self):
+        """Flush buffered writes and close the storage."""
+        if self.journal is not None:
+            self.journal.close()
+        self.retention.close()
+        self.reaper.close()
+        if self.write_behind is not None:
+            self.write_behind.close()
+        self.index.close()
+        self.storage.close()
+
+    def recover_trash(self):
+        """Complete the deletions interrupted by a crash after their nodes
+        were moved to the trash but before their parents were updated.
+        """
+        for token, identifier in self.storage.list_trash():
+            if identifier is None:
+                continue
+            parent, _, name = identifier.rpartition('/')
+            key = CHILD_KEYS[min(identifier.count('/'), 2)]
+            with self.writing(parent, identifier):
+                try:
+                    node = self.get_child(parent) if parent else self
+                except ValueError:
+                    # The parent is deleted as well
+                    continue
+                if token in node.metadata.get('tombstones', {}):
+                    continue
+                logger.info('Completing the deletion of {}'.format(identifier))
+                with node.batch():
+                    if name in node.metadata.get(key, []):
+                        node.remove_metadata_item(key, name)
+                    node.add_tombstone(token, name)
+                self.cache.invalidate(identifier)
+                self.index.remove(identifier)
+                self.search.remove(identifier)
+
+    def sync(self):
+        """Apply the changes other processes made so far, see journal.py."""
+        if self.journal is not None:
+            self.journal.sync()
+
+    def apply_changes(self, records):
+        """Refresh what is held in memory after other processes changed
+        the database.
+        :param records: Journal records of the changes, or None to reload
+        everything.
+        """
+        if records is None:
+            self.reload()
+            return
+        changes = {}
+        for record in records:
+            for identifier in record['ids']:
+                change = changes.setdefault(identifier, [set(), None])
+                change[0].update(record['parts'])
+                change[1] = record['position']
+        # Ancestors sort first, so parents are refreshed before children
+        for identifier in sorted(changes):
+            self.refresh_node(identifier, *changes[identifier])
+
+    def refresh_node(self, identifier: str, parts: set, version: int):
+        with self.locks.read(identifier):
+            if identifier:
+                self.cache.invalidate(identifier, descendants=False)
+                metadata = self.storage.read_metadata(identifier)
+            else:
+                metadata = self.metadata = self.read_metadata()
+            self.comparisons.invalidate(identifier)
+            self.retention.touch(identifier)
+            self.versions.bump(identifier, parts, version)
+            if metadata is None:
+                self.forget_node(identifier, version)
+                return
+            if identifier and 'metadata' in parts and \
+                    self.index.parent_of(identifier) in self.index.nodes:
+                self.index.update(identifier, metadata)
+                if '/' in identifier:
+                    self.search.update(identifier, metadata)
+            if 'children' in parts and identifier in self.index.nodes:
+                prefix = identifier + '/' if identifier else ''
+                names = metadata.get(
+                    CHILD_KEYS[min(prefix.count('/'), 2)], [])
+                indexed = list(self.index.nodes[identifier]['children'])
+                for name in indexed:
+                    if name not in names:
+                        self.forget_node(prefix + name, version)
+                for name in names:
+                    if name not in indexed:
+                        self.index_subtree(prefix + name)
+            if 'config' in parts and '/' in identifier:
+                self.search.set_configs(
+                    identifier, self.storage.read_dict(identifier, 'config'))
+        self.publish(identifier, {'event': 'reset'})
+
+    def index_subtree(self, identifier: str):
+        """Add a node created by another process and its descendants to
+        the tree and search indexes.
+        """
+        metadata = self.storage.read_metadata(identifier)
+        if metadata is None:
+            return
+        self.index.update(identifier, metadata)
+        if '/' in identifier:
+            self.search.update(identifier, metadata)
+            self.search.set_configs(
+                identifier, self.storage.read_dict(identifier, 'config'))
+        for name in metadata.get(CHILD_KEYS[min(identifier.count('/') + 1,
+                                                2)], []):
+            self.index_subtree('{}/{}'.format(identifier, name))
+
+    def forget_node(self, identifier: str, version: int):
+        """Drop a node deleted by another process and its descendants.
+        :param version: Journal position of the deletion.
+        """
+        self.cache.invalidate(identifier)
+        if identifier not in self.index.nodes:
+            return
+        self.index.remove(identifier)
+        self.search.remove(identifier)
+        self.versions.discard(identifier, version)
+        self.publish(identifier, {'event': 'deleted'})
+
+    def reload(self):
+        """Reload everything held in memory from the storage."""
+        with self.locks.read(''):
+            self.metadata = self.read_metadata()
+            self.cache.clear()
+            self.index.build(self.storage.read_metadata)
+            self.search = SearchIndex()
+            self.build_search_index()
+            self.comparisons = ComparisonCache()
+            self.retention.checked.clear()
+            self.retention.compressed.clear()
+            # A new epoch, or a new floor, invalidates all entity tags
+            self.versions = (Versions(self.journal.epoch,
+                                      self.journal.position())
+                             if self.journal is not None else Versions())
+        for identifier in list(self.broker.subscriptions):
+            self.publish(identifier, {'event': 'reset'})
+
+    def drop_tombstone(self, token: str, identifier: str):
+        """Remove the tombstone of a node whose data the Reaper removed."""
+        if identifier is None:
+            return
+        parent = identifier.rpartition('/')[0]
+        with self.writing(parent, parts=('metadata',)):
+            try:
+                node = self.get_child(parent) if parent else self
+            except ValueError:
+                return
+            tombstones = node.metadata.get('tombstones', {})
+            if token in tombstones:
+                node.add_metadata('tombstones', {
+                    k: v for k, v in tombstones.items() if k != token})
+
+    def subscribe(self, identifier: str):
+        """Subscribe to the changes of a node.
+        :return: A Subscription whose get() returns the change events.
+        """
+        return self.broker.subscribe(identifier)
+
+    def unsubscribe(self, subscription):
+        self.broker.unsubscribe(subscription)
+
+    def publish(self, identifier: str, event: dict):
+        if self.broker.has_subscribers(identifier):
+            self.broker.publish(identifier, dict(event, identifier=identifier))
+
+    def result_event(self, node: Task, op: str, key: str, value: str = None):
+        if op == 'delete':
+            return {'event': 'result_deleted', 'key': key}
+        elif op == 'append':
+            return {'event': 'rows', 'key': key, 'rows': [from_json(value)],
+                    'seq': node.result.count_rows(key) - 1}
+        return {'event': 'result', 'key': key,
+                'entry': node.result.summarize_entry(key)}
+
+    def publish_result(self, node: Task, op: str, key: str, value: str = None):
+        """Publish the change of a result to the subscribers of its task.
+        Must be called with the write lock of the task held so that events
+        are published in the order of the writes.
+        """
+        if self.broker.has_subscribers(node.identifier):
+            self.publish(node.identifier,
+                         self.result_event(node, op, key, value))
 
     def has_project(self, name: str) -> bool:
         """Check if a project exists by name.
@@ -419,40 +1252,55 @@ class Database(Container):
         :param name: Project name.
         :param desc: Project description.
         """
-        if self.has_project(name):
-            raise ValueError('Project {} exists'.format(name))
-        if not validate_name(name):
-            raise ValueError('Invalid project name')
-
-        proj = Project(name,
-                       path=os.path.join(self.proj_dir_path, name))
-        proj.create()
-        proj.add_metadata('name', name)
-        proj.add_metadata('identifier', name)
-        proj.add_metadata('create_time', int(time.time()))
-        proj.add_metadata('tasks', [])
-        proj.add_metadata('desc', '')
-        self.append_metadata_item('projects', name)
+        with self.writing(''):
+            if self.has_project(name):
+                raise ValueError('Project {} exists'.format(name))
+            if not validate_name(name):
+                raise ValueError('Invalid project name')
+
+            metadata = {
+                'name': name,
+                'identifier': name,
+                'create_time': int(time.time()),
+                'tasks': [],
+                'desc': ''
+            }
+            proj = Project(name, metadata=metadata, storage=self.storage,
+                           identifier=name)
+            proj.create()
+            self.append_metadata_item('projects', name)
+            self.index.update(name, metadata)
 
     def delete_project(self, name: str):
-        if self.has_project(name):
-           shutil.rmtree(os.path.join(self.proj_dir_path, name))
-           self.remove_metadata_item('projects', name)
-        else:
-            raise ValueError('Project {} does not exist'.format(name))
+        with self.writing('', name):
+            if self.has_project(name):
+               released = self.subtree_artifacts(name)
+               self.trash_child('projects', name)
+               self.cache.invalidate(name)
+               if self.write_behind is not None:
+                   self.write_behind.discard(name)
+               self.index.remove(name)
+               self.search.remove(name)
+               self.versions.discard(name)
+            else:
+                raise ValueError('Project {} does not exist'.format(name))
+        self.release_artifacts(released)
+        self.reaper.wake()
 
     def get_project(self, name: str):
         if self.has_project(name):
-            return Project(name, path=os.path.join(self.proj_dir_path, name))
+            return Project(name, storage=self.storage, identifier=name)
         else:
             raise ValueError('Project {} does not exist'.format(name))
 
     def list_projects(self, info: bool = False):
         projs = self.metadata.get('projects', [])
         if info:
-            projs = [self.get_project(proj).metadata for proj in projs]
+            projs = [self.get_child(proj).metadata for proj in projs]
             projs_ = []
             for proj in projs:
+                # Copy so that the cached metadata is left untouched
+                proj = dict(proj)
                 if 'tasks' in proj:
                     proj['tasks'] = self.list_children(proj['identifier'], info=True)
                 else:
@@ -462,82 +1310,550 @@ class Database(Container):
         return projs
 
     def list_children(self, parent, info: bool = False):
-        parent = self.get_child(parent)
-        return parent.list_children(info=info)
+        node = self.get_child(parent)
+        children = node.list_children()
+        if info:
+            children = [self.get_child('{}/{}'.format(parent, child)).metadata
+                        for child in children]
+        return children
+
+    def list_tree(self, parent: str = '', archived: bool = None,
+                  status: str = None, offset: int = 0, limit: int = None,
+                  children: bool = False):
+        """List the summaries of the children of a node from the tree index.
+        See TreeIndex.query().
+        """
+        return self.index.query(parent, archived, status, offset, limit,
+                                children)
+
+    def search_tasks(self, text: str = None, status: str = None,
+                     created_after: int = None, created_before: int = None,
+                     config: str = None, parent: str = None, offset: int = 0,
+                     limit: int = None):
+        """Search tasks with the search index. See SearchIndex.search().
+        :param config: JSON object of config values to match.
+        """
+        if config is not None:
+            config = from_json(config)
+            if type(config) is not dict:
+                raise TypeError('config must be an object')
+        return self.search.search(text, status, created_after, created_before,
+                                  config, parent, offset, limit)
 
     def get_child(self, name: str):
+        node = self.cache.get(name)
+        if node is not None:
+            return node
+        if self.write_behind is not None:
+            # A node with buffered writes may have been evicted from the
+            # cache, but its copy on disk is not up to date
+            node = self.write_behind.get(name)
+            if node is not None:
+                return self.cache.put(name, node)
         if '/' not in name:
             if self.has_project(name):
-                return self.get_project(name)
+                node = self.get_project(name)
             else:
                 raise ValueError('Project {} does not exist'.format(name))
         else:
-            name = name.split('/')
-            current = self.get_project(name[0])
-            tasks = name[1:]
-            for task in tasks:
-                current = current.get_child(task)
-            return current
+            parent, child = name.rsplit('/', 1)
+            node = self.get_child(parent).get_child(child)
+        return self.cache.put(name, node)
+
+    def get_cache_stats(self):
+        return self.cache.stats()
+
+    def profile_op(self, op: str = None, count: int = 1):
+        """Profile the next calls of an op with cProfile.
+        :param op: Op to profile, None to stop profiling.
+        :param count: Number of calls to profile, -1 for all of them.
+        """
+        if op is not None and op not in self.ops:
+            raise ValueError('Unknown operation: {}'.format(op))
+        self.profiler.arm(op, count)
+
+    def get_profiles(self):
+        """Get the statistics of the most recently profiled calls."""
+        return list(self.profiler.profiles)
+
+    def get_metrics(self) -> str:
+        """Render the metrics of the process and the state of the caches in
+        the Prometheus text format.
+        """
+        nodes = self.cache.stats()
+        comparisons = self.comparisons
+        caches = {('node',): nodes, ('comparison',): {
+            'size': len(comparisons.entries), 'hits': comparisons.hits,
+            'misses': comparisons.misses}}
+        text = registry.render()
+        text += render_values(
+            'footprint_cache_hits_total', 'Number of cache hits',
+            {k: v['hits'] for k, v in caches.items()}, ['cache'], 'counter')
+        text += render_values(
+            'footprint_cache_misses_total', 'Number of cache misses',
+            {k: v['misses'] for k, v in caches.items()}, ['cache'], 'counter')
+        text += render_values(
+            'footprint_cache_entries', 'Number of cached entries',
+            {k: v['size'] for k, v in caches.items()}, ['cache'])
+        text += render_values(
+            'footprint_subscriptions', 'Number of nodes with subscribers',
+            len(self.broker.subscriptions))
+        text += render_values(
+            'footprint_trash_entries',
+            'Number of deleted nodes whose data is not removed yet',
+            len(self.storage.list_trash()))
+        if self.write_behind is not None:
+            text += render_values(
+                'footprint_buffered_writes',
+                'Number of buffered writes not flushed yet',
+                self.write_behind.written - self.write_behind.flushed)
+        return text
 
     def create_task(self, parent: str, name: str):
-        parent = self.get_child(parent)
-        parent.create_child(name)
+        with self.writing(parent):
+            node = self.get_child(parent)
+            task = node.create_child(name)
+            self.index.update(task.identifier, task.metadata)
+            self.search.update(task.identifier, task.metadata)
+            self.publish(parent, {'event': 'children', 'created': [name]})
+
+    def create_tasks(self, parent: str, names: str):
+        """Create multiple tasks under the same parent.
+        The parent's metadata is saved once after all tasks are created.
+        :param parent: Parent identifier.
+        :param names: JSON list of task names.
+        """
+        names = from_json(names)
+        with self.writing(parent):
+            node = self.get_child(parent)
+            with node.batch():
+                for name in names:
+                    task = node.create_child(name)
+                    self.index.update(task.identifier, task.metadata)
+                    self.search.update(task.identifier, task.metadata)
+            self.publish(parent, {'event': 'children', 'created': names})
 
     def insert_task_result(self, identifier: str, key: str, value: str,
-                           val_type: str, overwrite: bool = False):
-        node = self.get_child(identifier)
-        node.insert_result(key, value, val_type, overwrite)
+                           val_type: str, overwrite: bool = False,
+                           columnar: bool = False):
+        with self.writing(identifier, parts=('result',)):
+            node = self.get_child(identifier)
+            ticket = self.buffer(node)
+            released = self.update_entry(
+                node.result, key, lambda: node.insert_result(
+                    key, value, val_type, overwrite, columnar),
+                value, val_type)
+            self.publish_result(node, 'insert', key)
+        self.commit(ticket)
+        self.release_artifacts(released)
 
     def delete_task_result(self, identifier: str, key: str):
-        node = self.get_child(identifier)
-        node.delete_result(key)
+        with self.writing(identifier, parts=('result',)):
+            node = self.get_child(identifier)
+            ticket = self.buffer(node)
+            released = self.update_entry(node.result, key,
+                                         lambda: node.delete_result(key))
+            self.publish_result(node, 'delete', key)
+        self.commit(ticket)
+        self.release_artifacts(released)
 
     def append_task_result(self, identifier: str, key: str, value: str,
                            val_type: str):
-        node = self.get_child(identifier)
-        node.append_result(key, value, val_type)
+        with self.writing(identifier, parts=('result',)):
+            node = self.get_child(identifier)
+            ticket = self.buffer(node)
+            node.append_result(key, value, val_type)
+            self.publish_result(node, 'append', key, value)
+        self.commit(ticket)
+
+    def batch_task_results(self, operations: str):
+        """Apply insert, append and delete operations on task results in bulk.
+        Operations are grouped by task and each group is saved only once.
+        :param operations: JSON list of operations. Each operation is an
+        object with 'op' ('insert', 'append' or 'delete'), 'identifier',
+        'key' and the other arguments of the corresponding single op.
+        :return: A list of {'success': bool, 'msg': str} in input order.
+        """
+        operations = from_json(operations)
+        if type(operations) is not list:
+            raise TypeError('operations must be a list')
+        status = [None] * len(operations)
+        ticket = None
+        released = []
+        groups = OrderedDict()
+        for i, operation in enumerate(operations):
+            groups.setdefault(operation.get('identifier'), []).append(i)
+
+        for identifier, indices in groups.items():
+            try:
+                with self.writing(identifier, parts=('result',)):
+                    node = self.get_child(identifier)
+                    ticket = self.buffer(node, len(indices)) or ticket
+                    events = []
+                    with node.result.batch():
+                        for i in indices:
+                            operation = operations[i]
+                            try:
+                                event = self.apply_result_operation(
+                                    node, operation, released)
+                                status[i] = {'success': True, 'msg': None}
+                            except Exception as e:
+                                status[i] = {'success': False, 'msg': str(e)}
+                                continue
+                            if self.broker.has_subscribers(identifier):
+                                self.merge_event(events, event)
+                    for event in events:
+                        self.publish(identifier, event)
+            except Exception as e:
+                for i in indices:
+                    if status[i] is None:
+                        status[i] = {'success': False, 'msg': str(e)}
+        self.commit(ticket)
+        self.release_artifacts(released)
+        return status
+
+    def apply_result_operation(self, node: Task, operation: dict,
+                               released: list):
+        op, key = operation.get('op'), operation.get('key')
+        value = operation.get('value')
+        if op == 'insert':
+            val_type = operation.get('val_type', 'str')
+            released += self.update_entry(
+                node.result, key, lambda: node.insert_result(
+                    key, value, val_type,
+                    boolean(operation.get('overwrite', False)),
+                    boolean(operation.get('columnar', False))),
+                value, val_type)
+        elif op == 'append':
+            node.append_result(key, value, operation.get('val_type'))
+        elif op == 'delete':
+            released += self.update_entry(node.result, key,
+                                          lambda: node.delete_result(key))
+        else:
+            raise ValueError('Unknown operation: {}'.format(op))
+        if self.broker.has_subscribers(node.identifier):
+            return self.result_event(node, op, key, value)
+
+    @staticmethod
+    def merge_event(events: list, event: dict):
+        """Add an event to a list of events, merging rows appended to the
+        same key in a row into one event.
+        """
+        last = events[-1] if events else None
+        if (last is not None and event['event'] == last['event'] == 'rows'
+                and event['key'] == last['key']):
+            last['rows'].append(event['rows'][0])
+            last['seq'] = event['seq']
+        else:
+            events.append(event)
 
-    def get_task_results(self, identifier: str):
+    def get_task_results(self, identifier: str, summary: bool = False):
         node = self.get_child(identifier)
+        if summary:
+            return node.result.summarize()
         return node.get_result()
 
+    def get_task_result(self, identifier: str, key: str, offset: int = 0,
+                        limit: int = None, points: int = None,
+                        method: str = 'minmax'):
+        """Get a result with a page of its rows, or, if points is given, the
+        whole plot2d series downsampled to about that many points.
+        """
+        node = self.get_child(identifier)
+        if points:
+            return node.result.downsample(key, points, method)
+        return node.result.get_page(key, offset, limit)
+
+    def get_task_result_since(self, identifier: str, key: str, after: int = -1):
+        node = self.get_child(identifier)
+        return node.result.get_since(key, after)
+
+    def get_task_result_range(self, identifier: str, key: str,
+                              start: float = None, end: float = None,
+                              column: str = '0', points: int = None,
+                              method: str = 'minmax'):
+        node = self.get_child(identifier)
+        rst = node.result.get_range(key, start, end, column)
+        if points:
+            rst['value']['data'] = downsample(rst['value']['data'], points,
+                                              method)
+        return rst
+
+    def fetch_result(self, identifier: str, key: str, column: str):
+        """Get a result of a task for a comparison, along with the
+        identifiers of the children of the task.
+        :return: (value, children). value is None if the task has no such
+        result, a number for scalars, and a (steps, values) pair of arrays
+        for tables and plot2d results.
+        """
+        node = self.get_child(identifier)
+        children = ['{}/{}'.format(identifier, child)
+                    for child in node.list_children()]
+        if '/' not in identifier or key not in node.result.dictionary:
+            return None, children
+        entry = node.result.dictionary[key]
+        if entry['type'] in {'int', 'float'}:
+            return entry['value'], children
+        if entry['type'] not in Result.log_types:
+            raise ValueError('Result {} of {} can not be compared'.format(
+                key, identifier))
+        index = node.result.column_index(key, column)
+        data = node.result.get_data(key)
+        if isinstance(data, ColumnRows):
+            x, y = data.column(0), data.column(index)
+            keep = ~np.isnan(x)
+            return (x[keep], y[keep]), children
+        x = to_array([row[0] for row in data])
+        y = to_array([row[index] if len(row) > index else None
+                      for row in data])
+        keep = ~np.isnan(x)
+        return (x[keep], y[keep]), children
+
+    def compare_task_results(self, parent: str, key: str, column: str = '1',
+                             mode: str = 'max'):
+        """Compare a result across all descendants of a node.
+        :param parent: Parent identifier.
+        :param key: Result key. The result may be an int or float, or a
+        table or plot2d whose first column is the step.
+        :param column: Column of tables and plot2d results to compare.
+        :param mode: 'max' or 'min', whether larger or smaller values are
+        better.
+        """
+        cache_key = (parent, key, column, mode)
+        rst, generation = self.comparisons.get(cache_key)
+        if rst is not None:
+            return rst
+        runs, level = [], [parent]
+        while level:
+            fetched = self.executor.map(
+                lambda i: self.fetch_result(i, key, column), level)
+            next_level = []
+            for identifier, (value, children) in zip(level, fetched):
+                if value is not None and identifier != parent:
+                    runs.append((identifier, value))
+                next_level.extend(children)
+            level = next_level
+        if not runs:
+            raise ValueError('No descendant of {} has result {}'.format(
+                parent, key))
+        rst = compare(runs, mode)
+        self.comparisons.put(cache_key, rst, generation)
+        return rst
+
+    def compact_task_results(self, identifier: str, key: str = None):
+        with self.writing(identifier, parts=()):
+            node = self.get_child(identifier)
+            node.compact_result(key)
+
+    def roll_up_task(self, identifier: str, points: int, min_rows: int) -> dict:
+        """Roll up the table and plot2d results of a task which have more
+        than min_rows rows, or grew by more than min_rows rows since their
+        last rollup. See Result.roll_up().
+        :return: Number of results rolled up, rows removed and bytes freed.
+        """
+        stats = {'results': 0, 'rows_removed': 0, 'bytes_freed': 0}
+        with self.writing(identifier, parts=('result',)):
+            node = self.get_child(identifier)
+            for key, entry in list(node.result.dictionary.items()):
+                if not node.result.is_logged(key) or \
+                        node.result.is_columnar(key):
+                    continue
+                kept = entry.get('rollup', {}).get('rows_kept', 0)
+                if node.result.count_rows(key) <= kept + min_rows:
+                    continue
+                rst = node.result.roll_up(key, points)
+                if rst is None:
+                    continue
+                stats['results'] += 1
+                stats['rows_removed'] += rst['rows_removed']
+                stats['bytes_freed'] += rst['bytes_freed']
+                self.publish_result(node, 'insert', key)
+        return stats
+
+    def compress_node(self, identifier: str):
+        """Compress the stored results and configs of a node.
+        :return: (bytes before, bytes after)
+        """
+        with self.writing(identifier, parts=()):
+            self.get_child(identifier)
+            return self.storage.compress_node(identifier)
+
+    def run_retention(self):
+        """Run a retention pass now.
+        :return: Its report, see RetentionEngine.run().
+        """
+        return self.retention.run()
+
+    def get_retention_report(self):
+        """Get the report of the last retention pass."""
+        return self.retention.last_report
+
+    def update_entry(self, dictionary: Dict, key: str, change,
+                     value: str = None, val_type: str = None) -> list:
+        """Change an entry of a config or result, keeping the reference
+        counts of artifacts up to date.
+        :param change: Function making the change.
+        :return: Artifacts no longer referenced, to pass to
+        release_artifacts() once the change is committed.
+        """
+        ref = parse_ref(value) if val_type == 'file' else None
+        if ref is not None:
+            self.artifacts.incref(ref)
+        old = dictionary.dictionary.get(key)
+        try:
+            change()
+        except Exception:
+            if ref is not None:
+                self.artifacts.decref(ref)
+            raise
+        entry = dictionary.dictionary.get(key)
+        released = []
+        if ref is not None and entry is old:
+            # Not inserted
+            released.append(ref)
+        if entry is not old and entry_ref(old) is not None:
+            released.append(entry_ref(old))
+        return released
+
+    def subtree_artifacts(self, identifier: str) -> list:
+        """List the artifacts referenced by a node and its descendants, once
+        per reference.
+        """
+        prefix = identifier + '/'
+        return [ref for node_id in [identifier] + [
+            i for i in list(self.index.nodes) if i.startswith(prefix)]
+            for ref in self.node_artifacts(node_id)]
+
+    def node_artifacts(self, identifier: str) -> list:
+        if '/' not in identifier:
+            return []
+        node = self.get_child(identifier)
+        return (dict_refs(node.config.dictionary)
+                + dict_refs(node.result.dictionary))
+
+    def release_artifacts(self, refs: list):
+        for ref in refs:
+            self.artifacts.decref(ref)
+
+    def get_artifact(self, value: str):
+        """Get the size, reference count and upload time of an artifact.
+        :param value: 'sha256:<hex>' value of a 'file' entry.
+        """
+        ref = parse_ref(value)
+        meta = self.artifacts.stat(ref) if ref is not None else None
+        if meta is None:
+            raise ValueError('Artifact {} does not exist'.format(value))
+        return meta
+
+    def collect_artifacts(self, recount: bool = False):
+        """Remove the artifacts nobody references any more.
+        :param recount: Recount the references of all artifacts from the
+        tree first, only while the database is idle.
+        :return: Number of artifacts kept and removed, and bytes freed.
+        """
+        counts = None
+        if recount:
+            counts = {}
+            for identifier in list(self.index.nodes):
+                for ref in self.node_artifacts(identifier):
+                    counts[ref] = counts.get(ref, 0) + 1
+        return self.artifacts.collect(counts)
+
     def delete_task(self, identifier: str):
-        parent = self.get_child(identifier[:identifier.rfind('/')])
-        parent.delete_child(identifier[identifier.rfind('/') + 1:])
+        parent = identifier[:identifier.rfind('/')]
+        name = identifier[identifier.rfind('/') + 1:]
+        with self.writing(parent, identifier):
+            released = self.subtree_artifacts(identifier)
+            self.get_child(parent).delete_child(name)
+            self.cache.invalidate(identifier)
+            if self.write_behind is not None:
+                self.write_behind.discard(identifier)
+            self.index.remove(identifier)
+            self.search.remove(identifier)
+            self.versions.discard(identifier)
+            self.publish(identifier, {'event': 'deleted'})
+            self.publish(parent, {'event': 'children', 'deleted': [name]})
+        self.release_artifacts(released)
+        self.reaper.wake()
 
     def insert_task_config(self, identifier: str, key: str, value: str,
                            val_type: str, overwrite: bool = False):
-        node = self.get_child(identifier)
-        node.insert_config(key, value, val_type, overwrite)
+        with self.writing(identifier, parts=('config',)):
+            node = self.get_child(identifier)
+            ticket = self.buffer(node)
+            released = self.update_entry(
+                node.config, key, lambda: node.insert_config(
+                    key, value, val_type, overwrite),
+                value, val_type)
+            self.search.set_config(identifier, key,
+                                   node.config.dictionary[key]['value'])
+            self.publish(identifier, {'event': 'config', 'key': key,
+                                      'entry': node.config.dictionary[key]})
+        self.commit(ticket)
+        self.release_artifacts(released)
 
     def delete_task_config(self, identifier: str, key: str):
-        node = self.get_child(identifier)
-        node.delete_config(key)
+        with self.writing(identifier, parts=('config',)):
+            node = self.get_child(identifier)
+            ticket = self.buffer(node)
+            released = self.update_entry(node.config, key,
+                                         lambda: node.delete_config(key))
+            self.search.set_config(identifier, key, deleted=True)
+            self.publish(identifier, {'event': 'config_deleted', 'key': key})
+        self.commit(ticket)
+        self.release_artifacts(released)
 
     def get_task_configs(self, identifier: str):
         node = self.get_child(identifier)
         return node.get_config()
 
     def update_child_metadata(self, identifier: str, metadata: str):
-        node = self.get_child(identifier)
-        for k, v in json.loads(metadata).items():
-            node.add_metadata(k, v)
+        with self.writing(identifier, parts=('metadata',)):
+            node = self.get_child(identifier)
+            node.update_metadata(from_json(metadata))
+            self.index.update(identifier, node.metadata)
+            if '/' in identifier:
+                self.search.update(identifier, node.metadata)
+            self.publish(identifier, {'event': 'metadata',
+                                      'metadata': node.metadata})
 
     def update_metadata(self, metadata):
-        for k, v in json.loads(metadata).items():
-            self.add_metadata(k, v)
+        if type(metadata) is str:
+            metadata = json.loads(metadata)
+        with self.writing(''):
+            super().update_metadata(metadata)
+
+    def etag(self, op: str, args) -> str:
+        """Get the entity tag of the response of a read op, which only
+        changes when the nodes the op reads do. Computing it touches neither
+        the storage nor the cache.
+        :return: None for ops without entity tags.
+        """
+        validator = self.validators.get(op)
+        if validator is None:
+            return None
+        self.sync()
+        return self.versions.etag(
+            validator(args),
+            [args.get(arg, default) for arg, _, default in self.ops[op][1]])
 
     def api(self, op, args):
         try:
+            self.sync()
             if op in self.ops:
                 op_func, op_args = self.ops[op]
-                args_ = {}
-                for arg, arg_type, arg_default in op_args:
-                    val = args.get(arg, arg_default)
-                    if val is not None and arg_type is not None:
-                        val = arg_type(val)
-                    args_[arg] = val
-                rst = op_func(**args_)
+                start = time.perf_counter()
+                try:
+                    args_ = {}
+                    for arg, arg_type, arg_default in op_args:
+                        args_[arg] = convert_arg(args.get(arg, arg_default),
+                                                 arg_type)
+                    rst = self.profiler.call(op, op_func, **args_)
+                except Exception:
+                    op_errors.inc(op=op)
+                    raise
+                finally:
+                    op_latency.observe(time.perf_counter() - start, op=op)
                 return True, rst
             else:
                 return False, 'Unknown operation: {}'.format(op)
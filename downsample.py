@@ -0,0 +1,212 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of buckets of a rollup level merged into one bucket of the next
+ROLLUP_FACTOR = 8
+# A query for n points reads a rollup level with at most this many times n
+# buckets, so it never has to look at more than a few times n candidates.
+CANDIDATE_RATIO = 4
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError('Downsampling requires NumPy')
+
+
+def to_array(values) -> 'np.ndarray':
+    return np.array([v if isinstance(v, (int, float)) else np.nan
+                     for v in values], dtype=float)
+
+
+def lttb(x, y, n: int):
+    """Select n points with Largest-Triangle-Three-Buckets.
+    :param x: X values, sorted.
+    :param y: Y values.
+    :param n: Number of points to select.
+    :return: Indices of the selected points.
+    """
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:max(n, 1)])
+    # n - 2 buckets between the first and the last point
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    selected = np.empty(n, dtype=int)
+    selected[0], selected[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = np.nanmean(x[end:edges[i + 2]])
+            next_y = np.nanmean(y[end:edges[i + 2]])
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (next_y - y[a]))
+        area[np.isnan(area)] = -1
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(min_idx, min_val, max_idx, max_val, n: int):
+    """Select the minimum and maximum of each of n / 2 groups of buckets.
+    Raw points can be passed as buckets whose minimum and maximum are the
+    point itself.
+    :return: Sorted indices of the selected points.
+    """
+    size = len(min_val)
+    groups = max(min(n // 2, size), 1)
+    edges = np.linspace(0, size, groups + 1).astype(int)
+    group_ids = np.repeat(np.arange(groups), np.diff(edges))
+    starts = edges[:-1]
+    # Sorting by (group, value) puts the extremum of each group at its start
+    lo = np.lexsort((min_val, group_ids))[starts]
+    hi = np.lexsort((-max_val, group_ids))[starts]
+    return np.union1d(min_idx[lo], max_idx[hi])
+
+
+class Rollup(object):
+    """Multi-resolution min/max summary of the y columns of a plot2d series,
+    updated on every append without rescanning the series.
+    """
+
+    def __init__(self, columns: int):
+        self.columns = columns
+        self.count = 0
+        # levels[k - 1] holds the closed buckets of level k as lists of
+        # (min_idx, min_val, max_idx, max_val) tuples of per-column lists
+        self.levels = []
+        self.open = []
+
+    @classmethod
+    def build(cls, ys):
+        """Build a rollup from existing rows.
+        :param ys: Array of y values of shape (rows, columns).
+        """
+        require_numpy()
+        rollup = cls(ys.shape[1])
+        rollup.count = len(ys)
+        idx = np.broadcast_to(np.arange(len(ys))[:, None], ys.shape)
+        items = (idx, ys, idx, ys)
+        level = 0
+        while True:
+            rollup.levels.append([])
+            rollup.open.append(None)
+            closed = len(items[0]) // ROLLUP_FACTOR * ROLLUP_FACTOR
+            tail = [a[closed:] for a in items]
+            if closed:
+                shape = (-1, ROLLUP_FACTOR, rollup.columns)
+                min_idx, min_val, max_idx, max_val = [
+                    a[:closed].reshape(shape) for a in items]
+                lo = np.argmin(np.where(np.isnan(min_val), np.inf, min_val),
+                               axis=1)[:, None]
+                hi = np.argmax(np.where(np.isnan(max_val), -np.inf, max_val),
+                               axis=1)[:, None]
+                items = tuple(np.take_along_axis(a, i, 1)[:, 0]
+                              for a, i in [(min_idx, lo), (min_val, lo),
+                                           (max_idx, hi), (max_val, hi)])
+                rollup.levels[level] = [tuple(b.tolist() for b in bucket)
+                                        for bucket in zip(*items)]
+            # Items left over go into the open bucket of the level
+            for bucket in zip(*tail):
+                rollup.merge(level, tuple(b.tolist() for b in bucket),
+                             propagate=False)
+            if not closed:
+                return rollup
+            level += 1
+
+    def merge(self, level: int, bucket: tuple, propagate: bool = True):
+        """Merge a bucket of the lower level into the open bucket of a level.
+        The open bucket is closed and merged upwards once it is full.
+        """
+        if level == len(self.levels):
+            self.levels.append([])
+            self.open.append(None)
+        current = self.open[level]
+        if current is None:
+            current = [list(b) for b in bucket] + [0]
+        else:
+            min_idx, min_val, max_idx, max_val = bucket
+            for c in range(self.columns):
+                if min_val[c] < current[1][c] or current[1][c] != current[1][c]:
+                    current[0][c], current[1][c] = min_idx[c], min_val[c]
+                if max_val[c] > current[3][c] or current[3][c] != current[3][c]:
+                    current[2][c], current[3][c] = max_idx[c], max_val[c]
+        current[4] += 1
+        if current[4] == ROLLUP_FACTOR:
+            closed = tuple(current[:4])
+            self.levels[level].append(closed)
+            self.open[level] = None
+            if propagate:
+                self.merge(level + 1, closed)
+        else:
+            self.open[level] = current
+
+    def append(self, ys: list):
+        """Add the y values of the next row."""
+        ys = [float(v) if isinstance(v, (int, float)) else float('nan')
+              for v in ys]
+        idx = [self.count] * self.columns
+        self.count += 1
+        self.merge(0, (idx, ys, idx, ys))
+
+    def candidates(self, n: int):
+        """Get the buckets of the finest level that has at most
+        CANDIDATE_RATIO * n of them.
+        :return: (min_idx, min_val, max_idx, max_val) arrays of shape
+        (buckets, columns), or None if the raw rows are few enough.
+        """
+        if self.count <= CANDIDATE_RATIO * n:
+            return None
+        for level, closed in enumerate(self.levels):
+            if (len(closed) <= CANDIDATE_RATIO * n
+                    or level == len(self.levels) - 1):
+                # The open buckets of this and the lower levels hold the
+                # latest rows
+                buckets = closed + [tuple(b[:4]) for b in
+                                    reversed(self.open[:level + 1]) if b]
+                return tuple(np.array(a) for a in zip(*buckets))
+        return None
+
+
+def build_rollup(rows: list) -> Rollup:
+    require_numpy()
+    ys = np.array([to_array(row[1:]) for row in rows])
+    return Rollup.build(ys.reshape(len(rows), -1))
+
+
+def downsample(rows: list, n: int, method: str = 'minmax',
+               buckets: tuple = None) -> list:
+    """Downsample the rows of a plot2d series to about n rows per y column.
+    :param rows: Rows of [x, y1, y2, ...].
+    :param n: Number of points per column.
+    :param method: 'minmax' (per-bucket min/max) or 'lttb'.
+    :param buckets: Candidate buckets of the rows from Rollup.candidates().
+    If given, only they are read instead of all rows.
+    """
+    require_numpy()
+    if method not in {'minmax', 'lttb'}:
+        raise ValueError('Unknown downsampling method: {}'.format(method))
+    if n <= 0 or len(rows) <= n:
+        return rows
+    if buckets is None:
+        ys = np.array([to_array(row[1:]) for row in rows]).reshape(len(rows), -1)
+        idx = np.broadcast_to(np.arange(len(rows))[:, None], ys.shape)
+        buckets = (idx, ys, idx, ys)
+    min_idx, min_val, max_idx, max_val = buckets
+    selected = [np.array([0, len(rows) - 1])]
+    for c in range(min_val.shape[1]):
+        if method == 'minmax':
+            selected.append(minmax(min_idx[:, c], min_val[:, c],
+                                   max_idx[:, c], max_val[:, c], n))
+        else:
+            idx, order = np.unique(np.concatenate(
+                [min_idx[:, c], max_idx[:, c]]), return_index=True)
+            y = np.concatenate([min_val[:, c], max_val[:, c]])[order]
+            x = to_array([rows[i][0] for i in idx])
+            selected.append(idx[lttb(x, y, n)])
+    return [rows[i] for i in np.unique(np.concatenate(selected))]
@@ -0,0 +1,215 @@
+"""Change journal of the processes sharing a database (see --workers in
+app.py). Each process appends the nodes and parts it changed to
+<dbpath>/journal/<segment>.log and follows the records of the others to
+refresh what it holds in memory. Records are not synced to disk; a process
+that misses some reloads everything. Record positions, under the epoch in
+<dbpath>/journal/epoch, are the versions of the entity tags.
+"""
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger()
+
+# Seconds between checks for new records
+POLL_INTERVAL = 0.1
+# Bytes after which a new segment is started
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+def position(segment: int, offset: int) -> int:
+    """Position in the journal of the end of a record, which only grows
+    from one record to the next. See Versions.
+    """
+    return (segment << 32) + offset
+
+
+class Journal(object):
+    def __init__(self, path: str, on_change, interval: float = POLL_INTERVAL):
+        """
+        :param path: Directory of the segments.
+        :param on_change: Called with the list of new records of the other
+        processes, in order, or with None if records were missed.
+        :param interval: Seconds between checks of the background thread
+        started by start(), which calls sync() so that changes are seen
+        even by idle processes.
+        """
+        if fcntl is None:
+            raise RuntimeError('The journal is not supported on this platform')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.origin = '{}-{}'.format(os.getpid(), os.urandom(4).hex())
+        # Appends hold a shared lock of this file, rotations an exclusive one
+        self.lock_file = open(os.path.join(path, 'journal.lock'), 'a')
+        with self.locked(fcntl.LOCK_EX):
+            self.segment = self.latest()
+            if self.segment is None:
+                self.segment = 0
+                open(self.segment_path(0), 'a').close()
+            # Shared by the processes as long as the segments are kept
+            epoch_path = os.path.join(path, 'epoch')
+            if not os.path.exists(epoch_path):
+                with open(epoch_path, 'w') as f:
+                    f.write(os.urandom(4).hex())
+            with open(epoch_path) as f:
+                self.epoch = f.read()
+        self.write_fd = self.open_segment(self.segment, os.O_WRONLY)
+        self.read_segment = self.segment
+        self.read_fd = self.open_segment(self.segment, os.O_RDONLY)
+        self.read_pos = os.fstat(self.read_fd).st_size
+        self.appending = threading.Lock()
+        self.reading = threading.Lock()
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, '{:08d}.log'.format(segment))
+
+    def open_segment(self, segment: int, flags: int) -> int:
+        if flags & os.O_WRONLY:
+            flags |= os.O_APPEND | os.O_CREAT
+        return os.open(self.segment_path(segment), flags, 0o644)
+
+    def latest(self) -> int:
+        segments = [int(name[:-4]) for name in os.listdir(self.path)
+                    if name.endswith('.log') and name[:-4].isdigit()]
+        return max(segments) if segments else None
+
+    @contextmanager
+    def locked(self, operation: int):
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def position(self) -> int:
+        """Position up to which the records were read."""
+        return position(self.read_segment, self.read_pos)
+
+    def append(self, identifiers, parts) -> int:
+        """Record a change of the given parts of nodes. See Versions.
+        :return: Position of the record.
+        """
+        data = (json.dumps({'origin': self.origin, 'ids': list(identifiers),
+                            'parts': list(parts)}) + '\n').encode('utf-8')
+        with self.appending:
+            with self.locked(fcntl.LOCK_SH):
+                if os.path.exists(self.segment_path(self.segment + 1)):
+                    os.close(self.write_fd)
+                    self.segment = self.latest()
+                    self.write_fd = self.open_segment(self.segment,
+                                                      os.O_WRONLY)
+                # Appends of a single write() never interleave
+                os.write(self.write_fd, data)
+                record = position(self.segment,
+                                  os.lseek(self.write_fd, 0, os.SEEK_CUR))
+                full = os.fstat(self.write_fd).st_size >= SEGMENT_SIZE
+            if full:
+                self.rotate()
+        return record
+
+    def rotate(self):
+        with self.locked(fcntl.LOCK_EX):
+            if self.latest() != self.segment:
+                return
+            os.close(self.write_fd)
+            self.segment += 1
+            self.write_fd = self.open_segment(self.segment, os.O_WRONLY)
+            for name in os.listdir(self.path):
+                if (name.endswith('.log') and name[:-4].isdigit()
+                        and int(name[:-4]) < self.segment - 1):
+                    os.remove(os.path.join(self.path, name))
+
+    def read_records(self) -> list:
+        """Read the records appended since the last call.
+        :return: The records of the other processes, or None if some were
+        missed.
+        """
+        records = []
+        while True:
+            # Once the next segment exists nothing is appended to this one,
+            # so it is read to the end before moving on. The next one may
+            # already be removed as well if this one is.
+            rotated = (os.path.exists(self.segment_path(self.read_segment + 1))
+                       or not os.fstat(self.read_fd).st_nlink)
+            while True:
+                data = os.pread(self.read_fd, 1 << 20, self.read_pos)
+                end = data.rfind(b'\n') + 1
+                if not end:
+                    break
+                for line in data[:end].splitlines(keepends=True):
+                    self.read_pos += len(line)
+                    record = json.loads(line)
+                    if record['origin'] != self.origin:
+                        record['position'] = self.position()
+                        records.append(record)
+            if not rotated:
+                return records
+            os.close(self.read_fd)
+            self.read_segment += 1
+            self.read_pos = 0
+            try:
+                self.read_fd = self.open_segment(self.read_segment,
+                                                 os.O_RDONLY)
+            except FileNotFoundError:
+                self.read_segment = self.latest()
+                self.read_fd = self.open_segment(self.read_segment,
+                                                 os.O_RDONLY)
+                self.read_pos = os.fstat(self.read_fd).st_size
+                return None
+
+    def sync(self):
+        """Pass the records of the other processes appended since the last
+        call to on_change().
+        """
+        with self.reading:
+            records = self.read_records()
+            if records is None:
+                logger.warning('Changes of other processes were missed')
+            elif not records:
+                return
+            else:
+                try:
+                    self.on_change(records)
+                    return
+                except Exception:
+                    logger.exception('Applying changes of other processes '
+                                     'failed')
+            self.on_change(None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name='journal',
+                                       daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped, self.interval)
+                if self.stopped:
+                    return
+            try:
+                self.sync()
+            except Exception:
+                logger.exception('Reading the journal failed')
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.write_fd)
+        os.close(self.read_fd)
+        self.lock_file.close()
@@ -0,0 +1,115 @@
+import os
+import hashlib
+import threading
+import weakref
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RWLock(object):
+    """A reader/writer lock that gives waiting writers priority."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class LockManager(object):
+    """Per-identifier reader/writer locks, acquired in sorted order so that
+    callers cannot deadlock. With a lock directory they are also backed by
+    fcntl lock files, for processes sharing a database.
+    """
+
+    def __init__(self, lock_dir: str = None):
+        if lock_dir is not None:
+            if fcntl is None:
+                raise RuntimeError('File locks are not supported on this '
+                                   'platform')
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.locks = weakref.WeakValueDictionary()
+        self.mutex = threading.Lock()
+
+    @property
+    def file_locks(self) -> bool:
+        return self.lock_dir is not None
+
+    def get_lock(self, identifier: str) -> RWLock:
+        with self.mutex:
+            lock = self.locks.get(identifier)
+            if lock is None:
+                lock = RWLock()
+                self.locks[identifier] = lock
+            return lock
+
+    def lock_file_path(self, identifier: str) -> str:
+        return os.path.join(self.lock_dir, '{}.lock'.format(
+            hashlib.md5(identifier.encode('utf-8')).hexdigest()))
+
+    @contextmanager
+    def acquire(self, identifiers, exclusive: bool):
+        identifiers = sorted(set(identifiers))
+        locks = [self.get_lock(identifier) for identifier in identifiers]
+        files = []
+        acquired = []
+        try:
+            for identifier, lock in zip(identifiers, locks):
+                if exclusive:
+                    lock.acquire_write()
+                else:
+                    lock.acquire_read()
+                acquired.append(lock)
+                if self.file_locks:
+                    f = open(self.lock_file_path(identifier), 'a')
+                    files.append(f)
+                    fcntl.flock(f, fcntl.LOCK_EX if exclusive
+                                else fcntl.LOCK_SH)
+            yield
+        finally:
+            for f in reversed(files):
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            for lock in reversed(acquired):
+                if exclusive:
+                    lock.release_write()
+                else:
+                    lock.release_read()
+
+    def read(self, *identifiers):
+        """Hold the shared locks of the given nodes."""
+        return self.acquire(identifiers, exclusive=False)
+
+    def write(self, *identifiers):
+        """Hold the exclusive locks of the given nodes."""
+        return self.acquire(identifiers, exclusive=True)
@@ -0,0 +1,213 @@
+"""Process-wide counters and histograms in the Prometheus text format,
+rendered by Database.get_metrics() and served on /metrics.
+"""
+import io
+import time
+import bisect
+import pstats
+import cProfile
+import threading
+from collections import deque
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Number of profiles kept by a Profiler
+PROFILES_KEPT = 20
+# Number of functions listed in a profile
+PROFILE_LINES = 40
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')) for name, value in zip(names, values)) + '}'
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if type(value) is float and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter(object):
+    """Monotonic counter, optionally split by labels."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self.values.get(tuple(labels[name] for name in self.labels), 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name, self.labels, key, value
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets, optionally
+    split by labels.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((k, list(v)) for k, v in self.values.items())
+        names = self.labels + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield self.name + '_bucket', names, key + (
+                    format_value(float(bound)),), total
+            yield self.name + '_sum', self.labels, key, counts[-1]
+            yield self.name + '_count', self.labels, key, total
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(),
+                  buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, label_names, label_values, value in metric.samples():
+                lines.append('{}{} {}'.format(
+                    name, format_labels(label_names, label_values),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def render_values(name: str, help: str, values, labels=(),
+                  type: str = 'gauge') -> str:
+    """Render a metric whose values are collected from elsewhere when the
+    metrics are rendered.
+    :param values: A number, or a dict from tuples of label values to
+    numbers.
+    """
+    if not isinstance(values, dict):
+        values = {(): values}
+    lines = ['# HELP {} {}'.format(name, help),
+             '# TYPE {} {}'.format(name, type)]
+    for key, value in sorted(values.items()):
+        lines.append('{}{} {}'.format(name, format_labels(labels, key),
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+op_latency = registry.histogram(
+    'footprint_op_duration_seconds', 'Time spent in Database ops', ['op'])
+op_errors = registry.counter(
+    'footprint_op_errors_total', 'Number of failed Database ops', ['op'])
+response_bytes = registry.counter(
+    'footprint_response_bytes_total', 'Bytes of /api responses', ['op'])
+not_modified = registry.counter(
+    'footprint_not_modified_total',
+    'Number of /api requests answered with 304 Not Modified', ['op'])
+storage_reads = registry.counter(
+    'footprint_storage_reads_total', 'Number of reads from the storage',
+    ['kind'])
+storage_writes = registry.counter(
+    'footprint_storage_writes_total', 'Number of writes to the storage',
+    ['kind'])
+storage_written_bytes = registry.counter(
+    'footprint_storage_written_bytes_total', 'Bytes written to the storage',
+    ['kind'])
+reaped_bytes = registry.counter(
+    'footprint_reaped_bytes_total',
+    'Bytes of deleted nodes removed from the trash')
+
+
+class Profiler(object):
+    """Profile the calls of a single op with cProfile, one call at a time,
+    keeping the statistics of the most recent ones.
+    """
+
+    def __init__(self):
+        self.op = None
+        # Number of calls left to profile, -1 for all
+        self.remaining = 0
+        self.profiles = deque(maxlen=PROFILES_KEPT)
+        self.running = threading.Lock()
+
+    def arm(self, op: str, count: int = 1):
+        """Profile the next count calls of an op, or all with count -1. An
+        op of None disarms the profiler.
+        """
+        self.op = op
+        self.remaining = count if op is not None else 0
+
+    def call(self, op: str, func, **args):
+        if op != self.op or not self.remaining or \
+                not self.running.acquire(blocking=False):
+            return func(**args)
+        try:
+            if self.remaining > 0:
+                self.remaining -= 1
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profile.runcall(func, **args)
+            finally:
+                elapsed = time.perf_counter() - start
+                out = io.StringIO()
+                stats = pstats.Stats(profile, stream=out)
+                stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+                self.profiles.append({'op': op, 'time': int(time.time()),
+                                      'elapsed': elapsed,
+                                      'stats': out.getvalue()})
+        finally:
+            self.running.release()
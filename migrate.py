@@ -0,0 +1,95 @@
+"""Copy a database to another storage backend, e.g. from the
+directory-of-JSON-files layout to SQLite:
+
+    python migrate.py --source database --target database_sqlite \
+        --source-backend file --target-backend sqlite
+"""
+import logging
+from argparse import ArgumentParser
+
+from database import Result
+from storage import Storage, create_storage
+from tree_index import CHILD_KEYS
+
+logger = logging.getLogger()
+
+
+def child_key(identifier: str) -> str:
+    depth = identifier.count('/') + 1 if identifier else 0
+    return CHILD_KEYS[min(depth, 2)]
+
+
+def copy_rows(source: Storage, target: Storage, identifier: str,
+              result: dict, stats: dict) -> dict:
+    """Copy the rows of the table and plot2d results of a node.
+    :return: The result dict to write to the target.
+    """
+    result = dict(result)
+    for key, entry in result.items():
+        if entry['type'] not in Result.log_types:
+            continue
+        if entry.get('columnar') and source.supports_columns:
+            rows = source.read_columns(identifier, key)[:]
+        else:
+            rows = source.read_rows(identifier, key)
+        if entry.get('columnar') and target.supports_columns:
+            target.append_columns(identifier, key, rows)
+        else:
+            entry = result[key] = dict(entry)
+            entry.pop('columnar', None)
+            target.append_rows(identifier, key, rows)
+        stats['rows'] += len(rows)
+    return result
+
+
+def migrate(source: Storage, target: Storage) -> dict:
+    """Copy every node with its metadata, config, result and result rows.
+    Columnar results are copied as rows of JSON if the target does not
+    support them.
+    :return: Numbers of copied nodes and rows.
+    """
+    if target.read_metadata('') is not None:
+        raise ValueError('Target database is not empty')
+    metadata = source.read_metadata('')
+    if metadata is None:
+        raise ValueError('Source database does not exist')
+    stats = {'nodes': 0, 'rows': 0}
+    stack = ['']
+    while stack:
+        identifier = stack.pop()
+        metadata = source.read_metadata(identifier)
+        if metadata is None:
+            logger.warning('Skipping missing node: {}'.format(identifier))
+            continue
+        target.create_node(identifier, metadata)
+        for name in ['config', 'result']:
+            dictionary = source.read_dict(identifier, name)
+            if name == 'result':
+                dictionary = copy_rows(source, target, identifier,
+                                       dictionary, stats)
+            if dictionary:
+                target.write_dict(identifier, name, dictionary)
+        if identifier:
+            stats['nodes'] += 1
+        children = metadata.get(child_key(identifier), [])
+        stack.extend('{}/{}'.format(identifier, child) if identifier
+                     else child for child in reversed(children))
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument('--source', required=True,
+                        help='Path to the source database')
+    parser.add_argument('--target', required=True,
+                        help='Path to the target database')
+    parser.add_argument('--source-backend', default='file')
+    parser.add_argument('--target-backend', default='sqlite')
+    args = parser.parse_args()
+
+    source = create_storage(args.source_backend, args.source)
+    target = create_storage(args.target_backend, args.target)
+    stats = migrate(source, target)
+    logger.info('Copied {} nodes and {} rows'.format(stats['nodes'],
+                                                     stats['rows']))
@@ -0,0 +1,88 @@
+"""Pre-fork launcher of server processes sharing one port, e.g.
+python app.py --workers 4. Every worker opens the database after the fork
+with file locks and the journal (see journal.py), and dead workers are
+restarted.
+"""
+import os
+import signal
+import socket
+import logging
+import time
+import traceback
+
+logger = logging.getLogger()
+
+# Seconds to wait before restarting a worker that died
+RESTART_DELAY = 1
+
+
+def bind(host: str, port: int, backlog: int = 128) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_workers(sock: socket.socket, count: int, run):
+    """Run worker processes until SIGTERM or SIGINT is received.
+    :param sock: Listening socket.
+    :param count: Number of workers.
+    :param run: Function serving the socket in a worker, called with the
+    number of the worker (from 0) and the socket.
+    """
+    signals = [signal.SIGTERM, signal.SIGINT]
+    handlers = {signum: signal.getsignal(signum) for signum in signals}
+    children = {}
+    stopping = False
+
+    def spawn(number: int):
+        pid = os.fork()
+        if pid:
+            children[pid] = number
+            return
+        code = 0
+        try:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            run(number, sock)
+        except SystemExit as e:
+            code = e.code if type(e.code) is int else int(e.code is not None)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for number in range(count):
+        spawn(number)
+    for signum in signals:
+        signal.signal(signum, stop)
+    logger.info('Serving on {}:{} with {} workers'.format(
+        *sock.getsockname()[:2], count))
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = children.pop(pid, None)
+        if number is None or stopping:
+            continue
+        logger.warning('Worker {} exited with status {}, restarting'.format(
+            number, os.waitstatus_to_exitcode(status)))
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            spawn(number)
+    sock.close()
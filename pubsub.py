@@ -0,0 +1,63 @@
+import queue
+import threading
+
+
+class Subscription(object):
+    def __init__(self, identifier: str, size: int = 1000):
+        self.identifier = identifier
+        self.queue = queue.Queue(size)
+
+    def put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # The subscriber is too slow to keep up. Drop the events it has
+            # not read yet and tell it to reload everything instead.
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait({'event': 'reset',
+                                   'identifier': self.identifier})
+
+    def get(self, timeout: float = None):
+        """Wait for the next event.
+        :return: The event, or None if the timeout expired.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker(object):
+    """In-process publish/subscribe fan-out of node change events.
+    Every subscription has its own bounded queue, so a slow subscriber
+    never blocks the writer that publishes an event.
+    """
+
+    def __init__(self, queue_size: int = 1000):
+        self.queue_size = queue_size
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, identifier: str) -> Subscription:
+        subscription = Subscription(identifier, self.queue_size)
+        with self.lock:
+            self.subscriptions.setdefault(identifier, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.identifier)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.identifier]
+
+    def has_subscribers(self, identifier: str) -> bool:
+        return identifier in self.subscriptions
+
+    def publish(self, identifier: str, event: dict):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(identifier, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
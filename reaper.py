@@ -0,0 +1,97 @@
+"""Background removal of deleted projects and tasks. Deletions only move
+nodes to the trash of the storage, and the Reaper removes the trash at a
+limited number of bytes per second.
+"""
+import time
+import logging
+import threading
+
+from metrics import reaped_bytes
+
+logger = logging.getLogger()
+
+# Bytes removed per second by default
+DEFAULT_RATE = 64 * 1024 * 1024
+# Minimum cost of a step in bytes, so that removing many small files is
+# throttled too
+STEP_COST = 4096
+# Seconds to wait before retrying after an error
+RETRY_DELAY = 60
+
+
+class Reaper(object):
+    def __init__(self, storage, rate: float = DEFAULT_RATE, on_reaped=None):
+        """
+        :param rate: Bytes removed per second, 0 for no limit.
+        :param on_reaped: Function called with the token and identifier of
+        every trash entry once it is removed.
+        """
+        self.storage = storage
+        self.rate = rate
+        self.on_reaped = on_reaped
+        self.condition = threading.Condition()
+        # Look for trash entries at once, they may be left from a crash
+        self.pending = True
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name='reaper',
+                                       daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """Look for new trash entries."""
+        with self.condition:
+            self.pending = True
+            self.condition.notify_all()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.stopped)
+                if self.stopped:
+                    return
+                self.pending = False
+            try:
+                for token, identifier in self.storage.list_trash():
+                    if not self.reap(token):
+                        return
+                    if self.on_reaped is not None:
+                        self.on_reaped(token, identifier)
+            except Exception:
+                logger.exception('Reaping the trash failed')
+                with self.condition:
+                    if self.condition.wait_for(lambda: self.stopped,
+                                               RETRY_DELAY):
+                        return
+                    self.pending = True
+
+    def reap(self, token: str) -> bool:
+        """Remove a trash entry at the configured rate.
+        :return: False if the reaper was stopped before it was removed.
+        """
+        start = time.monotonic()
+        cost = 0
+        for size in self.storage.reap_trash(token):
+            reaped_bytes.inc(size)
+            cost += max(size, STEP_COST)
+            delay = start + cost / self.rate - time.monotonic() \
+                if self.rate else 0
+            if delay > 0:
+                with self.condition:
+                    if self.condition.wait_for(lambda: self.stopped, delay):
+                        return False
+            elif self.stopped:
+                return False
+        return True
+
+    def close(self):
+        """Stop the reaper. Entries being removed are resumed at the next
+        start.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
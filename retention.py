@@ -0,0 +1,190 @@
+"""Retention of old results. A pass rolls up the table and plot2d results
+of finished or old tasks (see Result.roll_up()) and compresses the results
+of archived projects (see Storage.compress_node()). Passes run in the
+server, with the run_retention op, or from the command line:
+
+    python retention.py --dbpath database --rollup-points 1000
+"""
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+
+logger = logging.getLogger()
+
+
+class RetentionPolicy(object):
+    def __init__(self, rollup_points: int = 1000, rollup_min_rows: int = 10000,
+                 rollup_after: float = None, compress_archived: bool = True):
+        """
+        :param rollup_points: Number of rows per column kept by a rollup.
+        :param rollup_min_rows: Only roll up results with more rows than
+        this, or which grew by more rows than this since their last rollup.
+        :param rollup_after: Also roll up the results of running tasks
+        created this many seconds ago. Only those of finished tasks by
+        default.
+        :param compress_archived: Compress the results of archived projects.
+        """
+        if rollup_min_rows < rollup_points:
+            raise ValueError('rollup_min_rows must not be less than '
+                             'rollup_points')
+        self.rollup_points = rollup_points
+        self.rollup_min_rows = rollup_min_rows
+        self.rollup_after = rollup_after
+        self.compress_archived = compress_archived
+
+
+class RetentionEngine(object):
+    """Run retention passes over a database. Nodes done by a pass are
+    skipped by the next ones until they are written to again.
+    """
+
+    def __init__(self, db, policy: RetentionPolicy, interval: float = 0):
+        """
+        :param interval: Seconds between passes of a background thread, 0 to
+        only run passes on demand.
+        """
+        self.db = db
+        self.policy = policy
+        self.interval = interval
+        # Tasks whose results were rolled up as far as the policy asks
+        self.checked = set()
+        # Archived projects whose results are compressed
+        self.compressed = set()
+        self.last_report = None
+        self.running = threading.Lock()
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Start the background passes, if an interval is set."""
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self.loop, name='retention',
+                                           daemon=True)
+            self.thread.start()
+
+    def touch(self, identifier: str):
+        """Mark a node as written to, so that the next pass looks at it."""
+        self.checked.discard(identifier)
+        self.compressed.discard(identifier.split('/', 1)[0])
+
+    def due(self, summary: dict, now: float) -> bool:
+        if summary.get('status') != 'running':
+            return True
+        return (self.policy.rollup_after is not None
+                and now - summary.get('create_time', now)
+                >= self.policy.rollup_after)
+
+    def run(self) -> dict:
+        """Run a retention pass.
+        :return: Report of what was rolled up and compressed, and of the
+        space reclaimed.
+        """
+        with self.running:
+            start = time.time()
+            report = {'tasks_checked': 0, 'results_rolled_up': 0,
+                      'rows_removed': 0, 'rollup_bytes_freed': 0,
+                      'projects_compressed': 0, 'nodes_compressed': 0,
+                      'bytes_before_compression': 0,
+                      'bytes_after_compression': 0}
+            nodes = list(self.db.index.nodes.items())
+            for identifier, summary in nodes:
+                if ('/' not in identifier or identifier in self.checked
+                        or not self.due(summary, start)):
+                    continue
+                report['tasks_checked'] += 1
+                try:
+                    stats = self.db.roll_up_task(
+                        identifier, self.policy.rollup_points,
+                        self.policy.rollup_min_rows)
+                except ValueError:
+                    # Deleted in the meantime
+                    continue
+                report['results_rolled_up'] += stats['results']
+                report['rows_removed'] += stats['rows_removed']
+                report['rollup_bytes_freed'] += stats['bytes_freed']
+                self.checked.add(identifier)
+
+            if self.policy.compress_archived:
+                for project, summary in nodes:
+                    if ('/' in project or not summary.get('archived')
+                            or project in self.compressed):
+                        continue
+                    prefix = project + '/'
+                    compressed = 0
+                    for identifier, _ in nodes:
+                        if identifier != project and \
+                                not identifier.startswith(prefix):
+                            continue
+                        try:
+                            before, after = self.db.compress_node(identifier)
+                        except (ValueError, FileNotFoundError):
+                            continue
+                        if before:
+                            compressed += 1
+                        report['bytes_before_compression'] += before
+                        report['bytes_after_compression'] += after
+                    report['nodes_compressed'] += compressed
+                    if compressed:
+                        report['projects_compressed'] += 1
+                    self.compressed.add(project)
+
+            report['reclaimed_bytes'] = (
+                report['rollup_bytes_freed']
+                + report['bytes_before_compression']
+                - report['bytes_after_compression'])
+            report['time'] = int(start)
+            report['elapsed'] = round(time.time() - start, 3)
+            self.last_report = report
+            return report
+
+    def loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped, self.interval)
+                if self.stopped:
+                    return
+            try:
+                report = self.run()
+                if report['reclaimed_bytes']:
+                    logger.info('Retention reclaimed {} bytes'.format(
+                        report['reclaimed_bytes']))
+            except Exception:
+                logger.exception('Retention pass failed')
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+
+if __name__ == '__main__':
+    import json
+    from database import Database
+
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', default='database',
+                        help='Path to the database')
+    parser.add_argument('--backend', default='file', choices=['file', 'sqlite'])
+    parser.add_argument('--file-locks', action='store_true')
+    parser.add_argument('--rollup-points', default=1000, type=int)
+    parser.add_argument('--rollup-min-rows', default=10000, type=int)
+    parser.add_argument('--rollup-after', default=None, type=float,
+                        help='Also roll up running tasks created this many '
+                             'hours ago')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='Do not compress archived projects')
+    args = parser.parse_args()
+
+    policy = RetentionPolicy(
+        args.rollup_points, args.rollup_min_rows,
+        args.rollup_after * 3600 if args.rollup_after is not None else None,
+        not args.no_compress)
+    db = Database(args.dbpath, backend=args.backend,
+                  file_locks=args.file_locks, retention=policy)
+    print(json.dumps(db.retention.run(), indent=2))
+    db.close()
@@ -0,0 +1,190 @@
+import re
+import json
+import bisect
+import threading
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> set:
+    return set(TOKEN_PATTERN.findall((text or '').lower()))
+
+
+def config_value_key(value) -> str:
+    """Normalize a config value so that equal values given in different
+    ways (e.g., 1 and 1.0) are indexed under the same key.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True)
+
+
+def time_key(value):
+    """Convert a create_time to a number so that it can be ordered,
+    missing or malformed values are indexed as 0.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SearchIndex(object):
+    """In-memory secondary indexes over all tasks: words of names and
+    descriptions, create_time, status and config (key, value) pairs.
+    """
+
+    def __init__(self):
+        # identifier -> indexed fields of the task
+        self.docs = {}
+        self.tokens = {}
+        self.times = []
+        self.statuses = {}
+        self.configs = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def add_to(index: dict, key, identifier: str):
+        index.setdefault(key, set()).add(identifier)
+
+    @staticmethod
+    def remove_from(index: dict, key, identifier: str):
+        identifiers = index.get(key)
+        if identifiers is not None:
+            identifiers.discard(identifier)
+            if not identifiers:
+                del index[key]
+
+    def update(self, identifier: str, metadata: dict):
+        """Index or reindex the metadata of a task. Its configs are kept."""
+        with self.lock:
+            doc = self.docs.get(identifier)
+            configs = {}
+            if doc is not None:
+                configs = doc['configs']
+                self.unindex_metadata(identifier, doc)
+            doc = {
+                'name': metadata.get('name', ''),
+                'identifier': identifier,
+                'desc': metadata.get('desc', ''),
+                'status': metadata.get('status'),
+                'create_time': time_key(metadata.get('create_time')),
+                'configs': configs
+            }
+            doc['tokens'] = tokenize(doc['name']) | tokenize(doc['desc'])
+            for token in doc['tokens']:
+                self.add_to(self.tokens, token, identifier)
+            self.add_to(self.statuses, doc['status'], identifier)
+            bisect.insort(self.times, (doc['create_time'], identifier))
+            self.docs[identifier] = doc
+
+    def unindex_metadata(self, identifier: str, doc: dict):
+        for token in doc['tokens']:
+            self.remove_from(self.tokens, token, identifier)
+        self.remove_from(self.statuses, doc['status'], identifier)
+        i = bisect.bisect_left(self.times, (doc['create_time'], identifier))
+        if i < len(self.times) and self.times[i][1] == identifier:
+            del self.times[i]
+
+    def remove(self, identifier: str):
+        """Remove a task, or a project, and all of its descendants."""
+        prefix = identifier + '/'
+        with self.lock:
+            for key in [k for k in self.docs
+                        if k == identifier or k.startswith(prefix)]:
+                doc = self.docs.pop(key)
+                self.unindex_metadata(key, doc)
+                for config in doc['configs'].items():
+                    self.remove_from(self.configs, config, key)
+
+    def set_config(self, identifier: str, key: str, value=None,
+                   deleted: bool = False):
+        """Index the value of a config of a task, or remove it if deleted."""
+        with self.lock:
+            doc = self.docs.get(identifier)
+            if doc is None:
+                return
+            old = doc['configs'].pop(key, None)
+            if old is not None:
+                self.remove_from(self.configs, (key, old), identifier)
+            if not deleted:
+                doc['configs'][key] = config_value_key(value)
+                self.add_to(self.configs, (key, doc['configs'][key]),
+                            identifier)
+
+    def set_configs(self, identifier: str, config: dict):
+        """Index all configs of a task from its config dict. Indexed configs
+        which are not in it are removed.
+        """
+        with self.lock:
+            doc = self.docs.get(identifier)
+            keys = [k for k in doc['configs'] if k not in config] \
+                if doc is not None else []
+        for key in keys:
+            self.set_config(identifier, key, deleted=True)
+        for key, entry in config.items():
+            self.set_config(identifier, key, entry.get('value'))
+
+    def match_text(self, text: str) -> set:
+        """Find tasks whose name or description contains every word of the
+        text. Words may be parts of the indexed words.
+        """
+        matches = None
+        for word in tokenize(text):
+            identifiers = set()
+            for token, ids in self.tokens.items():
+                if word in token:
+                    identifiers |= ids
+            matches = identifiers if matches is None else matches & identifiers
+        return matches if matches is not None else set(self.docs)
+
+    def search(self, text: str = None, status: str = None,
+               created_after: int = None, created_before: int = None,
+               config: dict = None, parent: str = None, offset: int = 0,
+               limit: int = None) -> dict:
+        """Search tasks. All given conditions must hold.
+        :param text: Words to find in names and descriptions.
+        :param status: Task status.
+        :param created_after: Minimum create_time, inclusive.
+        :param created_before: Maximum create_time, inclusive.
+        :param config: Config values as {key: value}.
+        :param parent: Only search descendants of this node.
+        :return: {'tasks': [...], 'total': number of matching tasks,
+        'offset': offset}, newest tasks first.
+        """
+        with self.lock:
+            candidates = []
+            if text:
+                candidates.append(self.match_text(text))
+            if status is not None:
+                candidates.append(self.statuses.get(status, set()))
+            if created_after is not None or created_before is not None:
+                lo = 0 if created_after is None else bisect.bisect_left(
+                    self.times, (created_after, ''))
+                hi = len(self.times) if created_before is None else \
+                    bisect.bisect_left(self.times, (created_before + 1, ''))
+                candidates.append({i for _, i in self.times[lo:hi]})
+            for key, value in (config or {}).items():
+                candidates.append(self.configs.get(
+                    (key, config_value_key(value)), set()))
+            if candidates:
+                candidates.sort(key=len)
+                matches = set(candidates[0]).intersection(*candidates[1:])
+            else:
+                matches = set(self.docs)
+            if parent:
+                prefix = parent + '/'
+                matches = {i for i in matches if i.startswith(prefix)}
+
+            matches = sorted(matches, reverse=True,
+                             key=lambda i: (self.docs[i]['create_time'], i))
+            end = None if limit is None else offset + limit
+            tasks = []
+            for identifier in matches[offset:end]:
+                doc = self.docs[identifier]
+                tasks.append({k: doc[k] for k in ['name', 'identifier',
+                                                  'desc', 'status',
+                                                  'create_time']})
+            return {'tasks': tasks, 'total': len(matches), 'offset': offset}
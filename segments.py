@@ -0,0 +1,251 @@
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Rows written since the last fsync are flushed to disk once either limit
+# is reached, or by a timer SYNC_INTERVAL after they were written.
+SYNC_EVERY = 64
+SYNC_INTERVAL = 1.0
+# A new segment is started once the current one grows beyond this size.
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# path -> (rows written since the last fsync, time of the last fsync)
+_unsynced = {}
+_lock = threading.Lock()
+_timer = None
+
+
+def _schedule_sync():
+    """Make sure the unsynced rows are synced even if nothing else is
+    appended. Must be called with _lock held.
+    """
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(SYNC_INTERVAL, _sync_pending)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _sync_pending():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        sync_all()
+    except OSError:
+        logger.exception('Failed to sync row logs')
+
+
+def _forget(path: str):
+    with _lock:
+        _unsynced.pop(path, None)
+
+
+def sync_all():
+    """Flush the rows of all segments that are not synced yet to disk."""
+    with _lock:
+        # Rows appended from now on are tracked anew
+        pending = dict(_unsynced)
+        _unsynced.clear()
+    for path, entry in pending.items():
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            with _lock:
+                _unsynced.setdefault(path, entry)
+                _schedule_sync()
+            raise
+        finally:
+            os.close(fd)
+
+
+def truncate_partial_row(f):
+    """Cut off the unterminated row left at the end of a segment by a crash
+    during an append.
+    :param f: Segment opened in binary mode for reading and writing.
+    """
+    end = f.seek(0, os.SEEK_END)
+    if not end:
+        return
+    f.seek(end - 1)
+    if f.read(1) == b'\n':
+        return
+    pos = end
+    while pos > 0:
+        start = max(0, pos - (1 << 16))
+        f.seek(start)
+        newline = f.read(pos - start).rfind(b'\n')
+        if newline >= 0:
+            f.truncate(start + newline + 1)
+            return
+        pos = start
+    f.truncate(0)
+
+
+def open_segment(path: str, mode: str = 'r'):
+    """Open a segment for reading, whether it is gzip-compressed or not."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode if 'b' in mode else mode + 't',
+                         encoding=None if 'b' in mode else 'utf-8')
+    return open(path, mode, encoding=None if 'b' in mode else 'utf-8')
+
+
+class SegmentLog(object):
+    """Append-only row log of a single result key, in JSON lines segment
+    files named <prefix>.<lo>-<hi>.jsonl(.gz) by the range of segments they
+    cover, so that compaction never duplicates or loses rows.
+    """
+
+    def __init__(self, log_dir: str, key: str):
+        self.log_dir = log_dir
+        self.key = key
+        self.prefix = hashlib.md5(key.encode('utf-8')).hexdigest()
+        self.pattern = re.compile(
+            r'^{}\.(\d+)-(\d+)\.jsonl(\.gz)?$'.format(self.prefix))
+
+    def segment_path(self, lo: int, hi: int) -> str:
+        return os.path.join(self.log_dir,
+                            '{}.{}-{}.jsonl'.format(self.prefix, lo, hi))
+
+    def segments(self):
+        """List live segments as (lo, hi, path) tuples in row order.
+        Segments already covered by a compacted segment are skipped.
+        """
+        if not os.path.isdir(self.log_dir):
+            return []
+        found = []
+        for filename in os.listdir(self.log_dir):
+            match = self.pattern.match(filename)
+            if match:
+                lo, hi = int(match.group(1)), int(match.group(2))
+                found.append((lo, hi, os.path.join(self.log_dir, filename)))
+        # An uncompressed segment wins over a compressed copy of itself
+        found.sort(key=lambda x: (x[0], -x[1], x[2].endswith('.gz')))
+        segments, covered = [], 0
+        for lo, hi, path in found:
+            if hi > covered:
+                segments.append((lo, hi, path))
+                covered = hi
+        return segments
+
+    def append(self, rows: list) -> int:
+        """Append rows to the last segment.
+        :param rows: Rows to append.
+        :return: Number of bytes written.
+        """
+        if not rows:
+            return 0
+        os.makedirs(self.log_dir, exist_ok=True)
+        segments = self.segments()
+        if not segments:
+            path = self.segment_path(1, 1)
+        else:
+            lo, hi, path = segments[-1]
+            if not path.endswith('.gz'):
+                with open(path, 'r+b') as f:
+                    truncate_partial_row(f)
+            if path.endswith('.gz') or os.path.getsize(path) >= SEGMENT_SIZE:
+                path = self.segment_path(hi + 1, hi + 1)
+        data = ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+        with open(path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            with _lock:
+                count, last_sync = _unsynced.pop(path, (0, time.time()))
+                count += len(rows)
+                due = (count >= SYNC_EVERY
+                       or time.time() - last_sync >= SYNC_INTERVAL)
+                if not due:
+                    _unsynced[path] = (count, last_sync)
+                    _schedule_sync()
+            if due:
+                os.fsync(f.fileno())
+        return len(data)
+
+    def read(self) -> list:
+        return list(self.iter())
+
+    def iter(self):
+        """Iterate over the rows, reading the segments line by line. An
+        unterminated last line is a row whose append did not complete.
+        """
+        for _, _, path in self.segments():
+            with open_segment(path) as f:
+                for line in f:
+                    if line.strip() and line.endswith('\n'):
+                        yield json.loads(line)
+
+    def count(self) -> int:
+        count = 0
+        for _, _, path in self.segments():
+            with open_segment(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    count += chunk.count(b'\n')
+        return count
+
+    def compact(self):
+        """Merge all segments into a single one."""
+        segments = self.segments()
+        if len(segments) < 2:
+            return
+        lo, hi = segments[0][0], segments[-1][1]
+        path = self.segment_path(lo, hi)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            for _, _, segment in segments:
+                with open_segment(segment) as f:
+                    for line in f:
+                        if line.strip() and line.endswith('\n'):
+                            out.write(line)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+        for _, _, segment in segments:
+            if segment != path:
+                _forget(segment)
+                os.remove(segment)
+
+    def replace(self, rows: list) -> int:
+        """Replace all rows at once. Like compact(), the new rows are
+        written to a single segment covering all existing ones.
+        :return: Number of bytes freed.
+        """
+        segments = self.segments()
+        if not segments:
+            return -self.append(rows)
+        lo, hi = segments[0][0], segments[-1][1]
+        before = sum(os.path.getsize(segment) for _, _, segment in segments)
+        path = self.segment_path(lo, hi)
+        tmp_path = path + '.tmp'
+        data = ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+        with open(tmp_path, 'wb') as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+        for _, _, segment in segments:
+            if segment != path:
+                _forget(segment)
+                os.remove(segment)
+        return before - len(data)
+
+    def clear(self):
+        """Remove all segments of the key."""
+        if not os.path.isdir(self.log_dir):
+            return
+        for filename in os.listdir(self.log_dir):
+            if self.pattern.match(filename):
+                path = os.path.join(self.log_dir, filename)
+                _forget(path)
+                os.remove(path)
@@ -0,0 +1,262 @@
+import json
+import zlib
+import sqlite3
+import threading
+
+import metrics
+from storage import Storage, new_trash_token
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS nodes (
+        identifier TEXT PRIMARY KEY,
+        parent TEXT,
+        metadata TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent)',
+    '''CREATE TABLE IF NOT EXISTS configs (
+        identifier TEXT PRIMARY KEY,
+        dictionary TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS results (
+        identifier TEXT PRIMARY KEY,
+        dictionary TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS result_rows (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        identifier TEXT NOT NULL,
+        key TEXT NOT NULL,
+        row TEXT NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS result_rows_key
+        ON result_rows (identifier, key, id)''',
+    '''CREATE TABLE IF NOT EXISTS packed_rows (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        identifier TEXT NOT NULL,
+        key TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS packed_rows_key
+        ON packed_rows (identifier, key, id)''',
+    '''CREATE TABLE IF NOT EXISTS trash (
+        token TEXT PRIMARY KEY,
+        identifier TEXT NOT NULL
+    )'''
+]
+
+# Statements are kept as constants so that sqlite3's statement cache
+# prepares each of them only once per connection.
+SELECT_METADATA = 'SELECT metadata FROM nodes WHERE identifier = ?'
+UPSERT_METADATA = '''INSERT INTO nodes (identifier, parent, metadata)
+    VALUES (?, ?, ?)
+    ON CONFLICT (identifier) DO UPDATE SET metadata = excluded.metadata'''
+INSERT_NODE = 'INSERT INTO nodes (identifier, parent, metadata) VALUES (?, ?, ?)'
+SELECT_DICT = 'SELECT dictionary FROM {} WHERE identifier = ?'
+UPSERT_DICT = '''INSERT INTO {} (identifier, dictionary) VALUES (?, ?)
+    ON CONFLICT (identifier) DO UPDATE SET dictionary = excluded.dictionary'''
+SELECT_ROWS = '''SELECT row FROM result_rows
+    WHERE identifier = ? AND key = ? ORDER BY id'''
+COUNT_ROWS = 'SELECT COUNT(*) FROM result_rows WHERE identifier = ? AND key = ?'
+INSERT_ROW = 'INSERT INTO result_rows (identifier, key, row) VALUES (?, ?, ?)'
+DELETE_ROWS = 'DELETE FROM {} WHERE identifier = ? AND key = ?'
+SELECT_PACKED = '''SELECT data FROM packed_rows
+    WHERE identifier = ? AND key = ? ORDER BY id'''
+COUNT_PACKED = '''SELECT COALESCE(SUM(count), 0) FROM packed_rows
+    WHERE identifier = ? AND key = ?'''
+INSERT_PACKED = '''INSERT INTO packed_rows (identifier, key, count, data)
+    VALUES (?, ?, ?, ?)'''
+SIZE_ROWS = '''SELECT COALESCE(SUM(LENGTH({})), 0) FROM {}
+    WHERE identifier = ? AND key = ?'''
+SELECT_ROW_KEYS = 'SELECT DISTINCT key FROM result_rows WHERE identifier = ?'
+SELECT_ROWS_WITH_ID = '''SELECT id, row FROM result_rows
+    WHERE identifier = ? AND key = ? ORDER BY id'''
+DELETE_ROWS_UNTIL = '''DELETE FROM result_rows
+    WHERE identifier = ? AND key = ? AND id <= ?'''
+# '0' is the character right after '/', so [id + '/', id + '0') covers all
+# descendants of a node and can be answered from the primary key index.
+DELETE_SUBTREE = 'DELETE FROM {} WHERE identifier = ? OR ' \
+                 '(identifier >= ? AND identifier < ?)'
+SELECT_SUBTREE_ROWS = '''SELECT id, LENGTH({}) FROM {}
+    WHERE identifier = ? OR (identifier >= ? AND identifier < ?) LIMIT ?'''
+DELETE_ROW_IDS = 'DELETE FROM {} WHERE id IN ({})'
+INSERT_TRASH = 'INSERT INTO trash (token, identifier) VALUES (?, ?)'
+SELECT_TRASH = 'SELECT token, identifier FROM trash ORDER BY token'
+SELECT_TRASH_OF = 'SELECT token FROM trash WHERE identifier = ?'
+SELECT_TRASH_IDENTIFIER = 'SELECT identifier FROM trash WHERE token = ?'
+DELETE_TRASH = 'DELETE FROM trash WHERE token = ?'
+# Number of rows removed by a step of reap_trash()
+REAP_ROWS = 1000
+
+
+class SqliteStorage(Storage):
+    """SQLite storage in WAL mode, with a connection per thread.
+    compress_node() packs the rows of a node into zlib-compressed blobs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        with self.connection as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def read_metadata(self, identifier: str):
+        row = self.connection.execute(SELECT_METADATA, (identifier,)).fetchone()
+        metrics.storage_reads.inc(kind='metadata')
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def count_write(kind: str, size: int):
+        metrics.storage_writes.inc(kind=kind)
+        metrics.storage_written_bytes.inc(size, kind=kind)
+
+    def write_metadata(self, identifier: str, metadata: dict):
+        parent = identifier.rpartition('/')[0] if identifier else None
+        data = json.dumps(metadata)
+        with self.connection as conn:
+            conn.execute(UPSERT_METADATA, (identifier, parent, data))
+        self.count_write('metadata', len(data))
+
+    def create_node(self, identifier: str, metadata: dict):
+        if not identifier:
+            return self.write_metadata(identifier, metadata)
+        for token, in self.connection.execute(SELECT_TRASH_OF,
+                                              (identifier,)).fetchall():
+            for _ in self.reap_trash(token):
+                pass
+        data = json.dumps(metadata)
+        with self.connection as conn:
+            conn.execute(INSERT_NODE, (identifier, identifier.rpartition('/')[0],
+                                       data))
+        self.count_write('metadata', len(data))
+
+    def delete_node(self, identifier: str):
+        args = (identifier, identifier + '/', identifier + '0')
+        with self.connection as conn:
+            for table in ['nodes', 'configs', 'results', 'result_rows',
+                          'packed_rows']:
+                conn.execute(DELETE_SUBTREE.format(table), args)
+
+    def trash_node(self, identifier: str) -> str:
+        token = new_trash_token()
+        args = (identifier, identifier + '/', identifier + '0')
+        with self.connection as conn:
+            for table in ['nodes', 'configs', 'results']:
+                conn.execute(DELETE_SUBTREE.format(table), args)
+            conn.execute(INSERT_TRASH, (token, identifier))
+        return token
+
+    def list_trash(self) -> list:
+        return self.connection.execute(SELECT_TRASH).fetchall()
+
+    def reap_trash(self, token: str):
+        conn = self.connection
+        row = conn.execute(SELECT_TRASH_IDENTIFIER, (token,)).fetchone()
+        if row is None:
+            return
+        args = (row[0], row[0] + '/', row[0] + '0')
+        for table, column in [('result_rows', 'row'), ('packed_rows', 'data')]:
+            while True:
+                with conn:
+                    rows = conn.execute(
+                        SELECT_SUBTREE_ROWS.format(column, table),
+                        args + (REAP_ROWS,)).fetchall()
+                    if not rows:
+                        break
+                    conn.execute(DELETE_ROW_IDS.format(
+                        table, ','.join(str(i) for i, _ in rows)))
+                yield sum(size for _, size in rows)
+        with conn:
+            conn.execute(DELETE_TRASH, (token,))
+
+    def read_dict(self, identifier: str, name: str) -> dict:
+        row = self.connection.execute(SELECT_DICT.format(name + 's'),
+                                      (identifier,)).fetchone()
+        metrics.storage_reads.inc(kind=name)
+        return json.loads(row[0]) if row else {}
+
+    def write_dict(self, identifier: str, name: str, dictionary: dict):
+        data = json.dumps(dictionary)
+        with self.connection as conn:
+            conn.execute(UPSERT_DICT.format(name + 's'), (identifier, data))
+        self.count_write(name, len(data))
+
+    def read_rows(self, identifier: str, key: str) -> list:
+        return list(self.iter_rows(identifier, key))
+
+    def iter_rows(self, identifier: str, key: str):
+        metrics.storage_reads.inc(kind='rows')
+        packed = self.connection.execute(SELECT_PACKED,
+                                         (identifier, key)).fetchall()
+        for data, in packed:
+            for line in zlib.decompress(data).splitlines():
+                yield json.loads(line)
+        for row, in self.connection.execute(SELECT_ROWS, (identifier, key)):
+            yield json.loads(row)
+
+    def count_rows(self, identifier: str, key: str) -> int:
+        args = (identifier, key)
+        return (self.connection.execute(COUNT_ROWS, args).fetchone()[0]
+                + self.connection.execute(COUNT_PACKED, args).fetchone()[0])
+
+    def append_rows(self, identifier: str, key: str, rows: list):
+        values = [(identifier, key, json.dumps(row)) for row in rows]
+        with self.connection as conn:
+            conn.executemany(INSERT_ROW, values)
+        self.count_write('rows', sum(len(v[2]) for v in values))
+
+    def clear_rows(self, identifier: str, key: str):
+        with self.connection as conn:
+            for table in ['result_rows', 'packed_rows']:
+                conn.execute(DELETE_ROWS.format(table), (identifier, key))
+
+    def replace_rows(self, identifier: str, key: str, rows: list) -> int:
+        args = (identifier, key)
+        values = [(identifier, key, json.dumps(row)) for row in rows]
+        with self.connection as conn:
+            before = sum(conn.execute(SIZE_ROWS.format(column, table),
+                                      args).fetchone()[0]
+                         for column, table in [('row', 'result_rows'),
+                                               ('data', 'packed_rows')])
+            for table in ['result_rows', 'packed_rows']:
+                conn.execute(DELETE_ROWS.format(table), args)
+            conn.executemany(INSERT_ROW, values)
+        after = sum(len(v[2]) for v in values)
+        self.count_write('rows', after)
+        return before - after
+
+    def compress_node(self, identifier: str):
+        before = after = 0
+        with self.connection as conn:
+            for key, in conn.execute(SELECT_ROW_KEYS, (identifier,)).fetchall():
+                rows = conn.execute(SELECT_ROWS_WITH_ID,
+                                    (identifier, key)).fetchall()
+                data = zlib.compress(
+                    '\n'.join(row for _, row in rows).encode('utf-8'))
+                conn.execute(INSERT_PACKED, (identifier, key, len(rows), data))
+                conn.execute(DELETE_ROWS_UNTIL, (identifier, key, rows[-1][0]))
+                before += sum(len(row) for _, row in rows)
+                after += len(data)
+        return before, after
+
+    def sync(self):
+        # With synchronous=NORMAL commits reach the WAL without an fsync,
+        # a checkpoint syncs them into the database file
+        self.connection.execute('PRAGMA wal_checkpoint(FULL)')
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
@@ -18,4 +18,33 @@ function popup(text, confirm_func) {
         popup_cancel_btn_click();
         return false;
     });
-}
\ No newline at end of file
+}
+
+// Post a read op, sending the ETag of the response last received for the
+// same request. An unchanged response is answered with 304 Not Modified
+// and served from sessionStorage instead.
+function cached_post(url, data, success) {
+    var key = 'etag:' + url + '?' + $.param(data);
+    var cached = null;
+    try {
+        cached = JSON.parse(sessionStorage.getItem(key));
+    } catch (e) {}
+    $.post({
+        'url': url,
+        'data': data,
+        'headers': cached ? {'If-None-Match': cached.etag} : {},
+        'success': function (body, status, xhr) {
+            if (xhr.status === 304) {
+                body = cached.body;
+            } else if (xhr.getResponseHeader('ETag')) {
+                try {
+                    sessionStorage.setItem(key, JSON.stringify(
+                        {etag: xhr.getResponseHeader('ETag'), body: body}));
+                } catch (e) {
+                    // Storage is full or disabled
+                }
+            }
+            success(body);
+        }
+    });
+}
@@ -3,7 +3,7 @@
  * Date: Sep 30, 2018
  */
 
-// const show_archive = false;
+var _show_archived = false;
 
 $(document).ready(function () {
     retrieve_project_list();
@@ -19,33 +19,16 @@ function update_project_list(projs) {
     $.each(projs, function (i, proj) {
         var name = proj.name;
         var identifier = proj.identifier;
-        var task_num = (typeof proj.tasks === 'undefined')? 0 : proj.tasks.length;
-        var run_num = 0;
-        var fail_num = 0;
-        var done_num = 0;
+        var task_num = proj.child_count;
+        var run_num = proj.status_counts.running || 0;
+        var fail_num = proj.status_counts.failed || 0;
+        var done_num = proj.status_counts.done || 0;
         var archived = proj.archived || false;
 
-        if (task_num > 0) {
-            $.each(proj.tasks, function (ti, task) {
-                switch (task.status) {
-                    case 'running':
-                        run_num += 1;
-                        break;
-                    case 'failed':
-                        fail_num += 1;
-                        break;
-                    case 'done':
-                        done_num += 1;
-                        break;
-                    default:
-                        break;
-                }
-            });
-        }
-
         var proj_li = $('<li></li>')
             .addClass('proj-li');
         if (archived) proj_li.addClass('archived');
+        if (_show_archived) proj_li.addClass('show');
         // Project information
         var proj_info = $('<div></div>').addClass('proj-info');
         var proj_summary = $('<div></div>').addClass('proj-summary');
@@ -80,7 +63,7 @@ function update_project_list(projs) {
         proj_tasks_ops.append(proj_tasks_ops_left, proj_tasks_ops_right);
 
         var proj_tasks_list = $('<ul></ul>').addClass('proj-tasks-list').attr('proj', identifier);
-        $.each(proj.tasks, function (ti, task) {
+        $.each(proj.children, function (ti, task) {
             var task_li = $('<li></li>')
                 .addClass('proj-tasks-item')
                 .attr('status', task.status);
@@ -104,12 +87,10 @@ function update_project_list(projs) {
 }
 
 function retrieve_project_list() {
-    $.post({
-        'url': '/api/list_projects',
-        'data': {info: true},
-        'success': function (data) {
-            update_project_list(data.data);
-        }
+    var data = {children: true};
+    if (!_show_archived) data.archived = false;
+    cached_post('/api/list_tree', data, function (data) {
+        update_project_list(data.data.nodes);
     });
 }
 
@@ -129,7 +110,8 @@ function archive_btn_click() {
 function show_archieved_btn_click() {
     var btn = $(this);
     btn.children('i').toggleClass('fa-circle').toggleClass('fa-check-circle');
-    $('.proj-li').toggleClass('show');
+    _show_archived = !_show_archived;
+    retrieve_project_list();
 }
 
 function proj_title_click() {
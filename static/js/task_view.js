@@ -3,26 +3,24 @@
  * Date: Sep 30, 2018
  */
 var _identifier = decodeURIComponent(window.location.pathname.substring(6));
+var _page_size = 100;
 console.log(_identifier);
 
 $(document).ready(function () {
-    retrieve_subtasks();
-    retrieve_config();
-    retrieve_result();
+    // Results are loaded once the stream is open so that no change made in
+    // between is missed
+    subscribe_changes(function () {
+        retrieve_subtasks();
+        retrieve_config();
+        retrieve_result();
+    });
 })
     .on('click', '#tv-delete-task-button', delete_button_click)
+    .on('click', '.tv-result-more', load_more_button_click)
 ;
 
-function _handle_table_result(key, val) {
-    var li = $('<li class="tv-result-li"></li>');
-    var table_cap = $('<div></div>').addClass('tv-result-cap').text('Table: ' + key);
-    var table = $('<table></table>');
-    var thead = $('<thead><tr></tr></thead>');
-    $.each(val.cols, function (i, col) {
-        thead.append($('<th></th>').text(col));
-    });
-    var tbody = $('<tbody></tbody>');
-    $.each(val.data, function (i, row) {
+function _append_table_rows(tbody, rows) {
+    $.each(rows, function (i, row) {
         var tr = $('<tr></tr>');
         $.each(row, function (j, v) {
             if (typeof v === 'number' && !Number.isInteger(v)) {
@@ -32,140 +30,302 @@ function _handle_table_result(key, val) {
         });
         tbody.append(tr);
     });
+}
+
+function _load_table_rows(li) {
+    var tbody = li.find('tbody');
+    var offset = tbody.children('tr').length;
+    cached_post('/api/get_task_result',
+                {identifier: _identifier, key: li.attr('key'),
+                 offset: offset, limit: _page_size},
+                function (data) {
+        var rst = data.data;
+        var total = Math.max(rst.total, li.data('total'));
+        _append_table_rows(tbody, rst.value.data);
+        _set_table_total(li, total);
+        li.find('.tv-result-more').toggle(
+            rst.offset + rst.value.data.length < total);
+    });
+}
+
+function _set_table_total(li, total) {
+    li.data('total', total);
+    li.find('.tv-result-cap')
+        .text('Table: ' + li.attr('key') + ' (' + total + ' rows)');
+}
+
+function _handle_table_result(key, val, total) {
+    var li = $('<li class="tv-result-li tv-result-table"></li>').attr('key', key);
+    var table_cap = $('<div></div>').addClass('tv-result-cap');
+    var table = $('<table></table>');
+    var thead = $('<thead><tr></tr></thead>');
+    $.each(val.cols, function (i, col) {
+        thead.append($('<th></th>').text(col));
+    });
+    var tbody = $('<tbody></tbody>');
+    var more_btn = $('<button class="trans gray tv-result-more">Load more</button>').hide();
 
     table.append(thead, tbody);
-    li.append(table_cap, table);
+    li.append(table_cap, table, more_btn);
+    _set_table_total(li, total);
     $('ul#tv-result-list').append(li);
+    if (total > 0) _load_table_rows(li);
+}
+
+function _handle_table_rows(li, rows, seq) {
+    // Rows are numbered from 0, so the event carries rows first..seq
+    var tbody = li.find('tbody');
+    var loaded = tbody.children('tr').length;
+    var first = seq - rows.length + 1;
+    _set_table_total(li, Math.max(li.data('total'), seq + 1));
+    if (first <= loaded && !li.find('.tv-result-more').is(':visible')) {
+        _append_table_rows(tbody, rows.slice(loaded - first));
+    } else if (seq >= loaded) {
+        li.find('.tv-result-more').show();
+    }
+}
+
+function load_more_button_click() {
+    _load_table_rows($(this).closest('li'));
+}
+
+function _file_cell(value) {
+    // Values of artifacts are 'sha256:<hex>', other values are plain paths
+    var td = $('<td></td>');
+    if (typeof value === 'string' && value.startsWith('sha256:')) {
+        td.append($('<a></a>')
+            .attr('href', '/artifacts/' + value.substring(7))
+            .text(value.substring(0, 19)));
+    } else {
+        td.text(value);
+    }
+    return td;
+}
+
+function _primitive_result_row(rst) {
+    var tr = $('<tr></tr>').attr('key', rst.key);
+    tr.append($('<td width="200"></td>').text(rst.key).addClass('text-left'));
+    switch (rst.type) {
+        case 'int':
+            tr.append($('<td></td>')
+                .text(rst.value)
+                .addClass('monospace')
+                .addClass('text-left')
+            );
+            break;
+        case 'file':
+            tr.append(_file_cell(rst.value)
+                .addClass('monospace')
+                .addClass('text-left')
+            );
+            break;
+        case 'float':
+            tr.append($('<td></td>')
+                .text(Number.parseFloat(rst.value).toPrecision(4))
+                .addClass('monospace')
+                .addClass('text-left')
+            );
+            break;
+        case 'list':
+            // TODO: implement handler
+            break;
+        default:
+            break;
+    }
+    return tr;
 }
 
 function _handle_primitive_result(rsts) {
-    var li = $('<li class="tv-result-li"></li>');
+    var li = $('<li class="tv-result-li" id="tv-result-primitives"></li>');
     var table = $('<table></table>');
     var tbody = $('<tbody></tbody>');
     $.each(rsts, function (i, rst) {
-        var tr = $('<tr></tr>');
-        tr.append($('<td width="200"></td>').text(rst.key).addClass('text-left'));
-        switch (rst.type) {
-            case 'int': case 'file':
-                tr.append($('<td></td>')
-                    .text(rst.value)
-                    .addClass('monospace')
-                    .addClass('text-left')
-                );
-                break;
-            case 'float':
-                tr.append($('<td></td>')
-                    .text(Number.parseFloat(rst.value).toPrecision(4))
-                    .addClass('monospace')
-                    .addClass('text-left')
-                );
-                break;
-            case 'list':
-                // TODO: implement handler
-                break;
-            default:
-                break;
-        }
-        tbody.append(tr);
+        tbody.append(_primitive_result_row(rst));
     });
     table.append(tbody);
     li.append(table);
     $('ul#tv-result-list').prepend(li);
 }
 
+function _update_result(key, rst) {
+    _remove_result(key);
+    switch (rst.type) {
+        case 'table':
+            _handle_table_result(key, rst.value, rst.total);
+            break;
+        case 'int': case 'float': case 'str': case 'file': case 'list':
+            var tbody = $('#tv-result-primitives tbody');
+            if (tbody.length === 0) {
+                _handle_primitive_result([]);
+                tbody = $('#tv-result-primitives tbody');
+            }
+            tbody.append(_primitive_result_row(
+                {key: key, value: rst.value, type: rst.type}));
+            break;
+        default:
+            break;
+    }
+}
+
+function _remove_result(key) {
+    $('ul#tv-result-list .tv-result-table').filter(function () {
+        return $(this).attr('key') === key;
+    }).remove();
+    $('#tv-result-primitives tr').filter(function () {
+        return $(this).attr('key') === key;
+    }).remove();
+}
+
 function retrieve_result() {
-    $.post({
-        'url': '/api/get_task_results',
-        'data': {identifier: _identifier},
-        'success': function (data) {
-            var result = data.data;
-            var primitive_vals = [];
-            $.each(result, function (rst_key, rst) {
-                var rst_type = rst.type;
-                var rst_val = rst.value;
-
-                switch (rst_type) {
-                    case 'table':
-                        _handle_table_result(rst_key, rst_val);
-                        break;
-                    case 'int': case 'float': case 'str': case 'file': case 'list':
-                        primitive_vals.push({key: rst_key, value: rst_val, type: rst_type});
-                        break;
-                    default:
-                        break;
-                }
-            });
-            _handle_primitive_result(primitive_vals);
-        }
+    cached_post('/api/get_task_results',
+                {identifier: _identifier, summary: true},
+                function (data) {
+        var result = data.data;
+        var primitive_vals = [];
+        $.each(result, function (rst_key, rst) {
+            var rst_type = rst.type;
+            var rst_val = rst.value;
+
+            switch (rst_type) {
+                case 'table':
+                    _handle_table_result(rst_key, rst_val, rst.total);
+                    break;
+                case 'int': case 'float': case 'str': case 'file': case 'list':
+                    primitive_vals.push({key: rst_key, value: rst_val, type: rst_type});
+                    break;
+                default:
+                    break;
+            }
+        });
+        _handle_primitive_result(primitive_vals);
     });
 }
 
 function _handle_primitive_config(key, value) {
-    var tr = $('<tr></tr>');
+    var tr = $('<tr></tr>').attr('key', key);
     tr.append($('<td width="150"></td>').text(key));
     tr.append($('<td></td>').text(value).addClass('monospace'));
     $('#tv-config-table').append(tr);
 }
 
 function _handle_json_config(key, value) {
-    var tr = $('<tr></tr>');
+    var tr = $('<tr></tr>').attr('key', key);
     tr.append($('<td width="150"></td>').text(key));
     tr.append($('<td></td>').html("<pre>" + JSON.stringify(value, undefined, 4) + "</pre>"));
     $('#tv-config-table').append(tr);
 }
 
+function _remove_config(key) {
+    $('#tv-config-table tr').filter(function () {
+        return $(this).attr('key') === key;
+    }).remove();
+}
+
+function _update_config(key, conf) {
+    _remove_config(key);
+    switch (conf.type) {
+        case 'int': case 'float': case 'str':
+            _handle_primitive_config(key, conf.value);
+            break;
+        case 'file':
+            var tr = $('<tr></tr>').attr('key', key);
+            tr.append($('<td width="150"></td>').text(key));
+            tr.append(_file_cell(conf.value).addClass('monospace'));
+            $('#tv-config-table').append(tr);
+            break;
+        case 'json':
+            _handle_json_config(key, conf.value);
+            break;
+    }
+}
+
 function retrieve_config() {
-    $.post({
-        'url': '/api/get_task_configs',
-        'data': {identifier: _identifier},
-        'success': function (data) {
-            var config = data.data;
-            $.each(config, function (conf_key, conf) {
-                var conf_type = conf.type;
-                var conf_val = conf.value;
-                switch (conf_type) {
-                    case 'int': case 'float': case 'str': case 'file':
-                        _handle_primitive_config(conf_key, conf_val);
-                        break;
-                    case 'json':
-                        _handle_json_config(conf_key, conf_val);
-                        break;
-                }
-            })
-        }
+    cached_post('/api/get_task_configs',
+                {identifier: _identifier},
+                function (data) {
+        var config = data.data;
+        $.each(config, function (conf_key, conf) {
+            _update_config(conf_key, conf);
+        })
     });
 }
 
 function retrieve_subtasks() {
     var subtask_list = $('ul#tv-subtasks-list');
-    $.post({
-        'url': '/api/list_children',
-        'data': {parent: _identifier, info: true},
-        'success': function (data) {
-            var subtasks = data.data;
-            $.each(subtasks, function (i, subtask) {
-                var name = subtask.name;
-                var status = subtask.status;
-                var id = subtask.identifier;
-                var desc = subtask.desc;
-                var task_li = $('<li></li>')
-                    .addClass('tv-subtasks-item')
-                    .attr('status', status);
-                task_li.append($('<a class="tv-subtasks-name"></a>')
-                    .text(name)
-                    .attr('identifier', id)
-                    .attr('href', '/task/' + id)
-                    .attr('target', '_blank')
-                );
-                task_li.append($('<span class="tv-subtasks-desc"></span>')
-                    .text(desc)
-                );
-                subtask_list.append(task_li);
-            })
-        }
+    subtask_list.empty();
+    cached_post('/api/list_children',
+                {parent: _identifier, info: true},
+                function (data) {
+        var subtasks = data.data;
+        $.each(subtasks, function (i, subtask) {
+            var name = subtask.name;
+            var status = subtask.status;
+            var id = subtask.identifier;
+            var desc = subtask.desc;
+            var task_li = $('<li></li>')
+                .addClass('tv-subtasks-item')
+                .attr('status', status);
+            task_li.append($('<a class="tv-subtasks-name"></a>')
+                .text(name)
+                .attr('identifier', id)
+                .attr('href', '/task/' + id)
+                .attr('target', '_blank')
+            );
+            task_li.append($('<span class="tv-subtasks-desc"></span>')
+                .text(desc)
+            );
+            subtask_list.append(task_li);
+        })
     });
 }
 
+function subscribe_changes(on_open) {
+    if (!window.EventSource) {
+        on_open();
+        return;
+    }
+    var source = new EventSource('/stream/' + _identifier);
+    source.onopen = function () {
+        // Also called after reconnecting, when changes may have been missed
+        $('ul#tv-result-list').empty();
+        $('#tv-config-table').empty();
+        on_open();
+    };
+    source.onmessage = function (e) {
+        var event = JSON.parse(e.data);
+        switch (event.event) {
+            case 'rows':
+                var li = $('ul#tv-result-list .tv-result-table').filter(function () {
+                    return $(this).attr('key') === event.key;
+                });
+                if (li.length) _handle_table_rows(li, event.rows, event.seq);
+                break;
+            case 'result':
+                _update_result(event.key, event.entry);
+                break;
+            case 'result_deleted':
+                _remove_result(event.key);
+                break;
+            case 'config':
+                _update_config(event.key, event.entry);
+                break;
+            case 'config_deleted':
+                _remove_config(event.key);
+                break;
+            case 'children':
+                retrieve_subtasks();
+                break;
+            case 'deleted':
+                source.close();
+                window.location.replace('/projects');
+                break;
+            case 'reset':
+                source.onopen();
+                break;
+        }
+    };
+}
+
 function delete_button_click() {
     popup(
         'Are you sure you want to delete this task? The operation can not be undone.',
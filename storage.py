@@ -0,0 +1,345 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+
+import metrics
+from columns import ColumnStore
+from segments import SegmentLog, sync_all
+from utils import read_json, atomic_write_json, gzip_file
+
+
+def new_trash_token() -> str:
+    """Name a trash entry. Tokens sort by the time they were made."""
+    return '{:012x}-{}'.format(int(time.time() * 1000), uuid.uuid4().hex[:8])
+
+
+class Storage(object):
+    """Persistence interface behind Database, Project, Task, Result and
+    Config. Nodes are addressed by identifier, the database by ''.
+    """
+    # Whether columnar results (read_columns() etc.) are supported
+    supports_columns = False
+
+    def read_metadata(self, identifier: str):
+        """Read the metadata of a node.
+        :return: The metadata dict, or None if the node does not exist.
+        """
+        raise NotImplementedError()
+
+    def write_metadata(self, identifier: str, metadata: dict):
+        raise NotImplementedError()
+
+    def create_node(self, identifier: str, metadata: dict):
+        """Create a node along with its metadata."""
+        raise NotImplementedError()
+
+    def delete_node(self, identifier: str):
+        """Delete a node and all of its descendants."""
+        raise NotImplementedError()
+
+    def trash_node(self, identifier: str) -> str:
+        """Move a node and all of its descendants out of the tree at once,
+        into a trash entry that reap_trash() removes later.
+        :return: Token of the trash entry, or None if the node was deleted
+        right away.
+        """
+        self.delete_node(identifier)
+        return None
+
+    def list_trash(self) -> list:
+        """List the trash entries left to remove, oldest first.
+        :return: (token, identifier) pairs. The identifier is None if it can
+        not be told any more.
+        """
+        return []
+
+    def reap_trash(self, token: str):
+        """Remove a trash entry a little at a time. An entry whose removal
+        was interrupted can be reaped again.
+        :return: Iterator of the number of bytes freed by every step. The
+        entry is gone once it is exhausted.
+        """
+        return iter(())
+
+    def read_dict(self, identifier: str, name: str) -> dict:
+        """Read the 'config' or 'result' dict of a node.
+        An empty dict is returned if it has never been written.
+        """
+        raise NotImplementedError()
+
+    def write_dict(self, identifier: str, name: str, dictionary: dict):
+        raise NotImplementedError()
+
+    def read_rows(self, identifier: str, key: str) -> list:
+        raise NotImplementedError()
+
+    def iter_rows(self, identifier: str, key: str):
+        """Iterate over the rows of a key without reading them all at once,
+        if the backend supports it.
+        """
+        return iter(self.read_rows(identifier, key))
+
+    def count_rows(self, identifier: str, key: str) -> int:
+        return len(self.read_rows(identifier, key))
+
+    def append_rows(self, identifier: str, key: str, rows: list):
+        raise NotImplementedError()
+
+    def clear_rows(self, identifier: str, key: str):
+        raise NotImplementedError()
+
+    def compact_rows(self, identifier: str, key: str):
+        """Reorganize the stored rows of a key. Optional."""
+        pass
+
+    def replace_rows(self, identifier: str, key: str, rows: list) -> int:
+        """Replace all rows of a key. Backends should do it atomically.
+        :return: Number of bytes freed, if known.
+        """
+        self.clear_rows(identifier, key)
+        self.append_rows(identifier, key, rows)
+        return 0
+
+    def compress_node(self, identifier: str):
+        """Compress the stored config, result and rows of a node (not of its
+        descendants). They are read back transparently. Optional.
+        :return: (bytes before, bytes after).
+        """
+        return 0, 0
+
+    def read_columns(self, identifier: str, key: str):
+        """Read the rows of a columnar result.
+        :return: A ColumnRows of the rows.
+        """
+        raise NotImplementedError(
+            'Columnar results are not supported by this storage backend')
+
+    def append_columns(self, identifier: str, key: str, rows: list):
+        raise NotImplementedError(
+            'Columnar results are not supported by this storage backend')
+
+    def clear_columns(self, identifier: str, key: str):
+        raise NotImplementedError(
+            'Columnar results are not supported by this storage backend')
+
+    def sync(self):
+        """Make everything written so far durable. Optional."""
+        pass
+
+    def close(self):
+        pass
+
+
+class FileStorage(Storage):
+    """Directory-of-JSON-files storage, with segment logs of rows and
+    column files of columnar results in every node directory.
+    """
+
+    child_dirs = ['projects', 'tasks', 'subtasks']
+    supports_columns = True
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # JSON files replaced since the last sync()
+        self.unsynced = set()
+        self.unsynced_lock = threading.Lock()
+
+    def node_path(self, identifier: str) -> str:
+        path = self.path
+        if identifier:
+            for depth, name in enumerate(identifier.split('/')):
+                path = os.path.join(path, self.child_dirs[min(depth, 2)], name)
+        return path
+
+    def child_dir(self, identifier: str) -> str:
+        depth = identifier.count('/') + 1 if identifier else 0
+        return self.child_dirs[min(depth, 2)]
+
+    def read_metadata(self, identifier: str):
+        path = os.path.join(self.node_path(identifier), 'metadata.json')
+        if os.path.exists(path):
+            metrics.storage_reads.inc(kind='metadata')
+            return read_json(path)
+        return None
+
+    def write_json(self, path: str, obj, kind: str):
+        size = atomic_write_json(path, obj)
+        if kind != 'metadata':
+            try:
+                # Drop the outdated compressed copy
+                os.remove(path + '.gz')
+            except FileNotFoundError:
+                pass
+        metrics.storage_writes.inc(kind=kind)
+        metrics.storage_written_bytes.inc(size, kind=kind)
+        with self.unsynced_lock:
+            self.unsynced.add(path)
+
+    def write_metadata(self, identifier: str, metadata: dict):
+        self.write_json(
+            os.path.join(self.node_path(identifier), 'metadata.json'),
+            metadata, 'metadata')
+
+    def create_node(self, identifier: str, metadata: dict):
+        path = self.node_path(identifier)
+        os.makedirs(path, exist_ok=not identifier)
+        os.makedirs(os.path.join(path, self.child_dir(identifier)),
+                    exist_ok=not identifier)
+        self.write_metadata(identifier, metadata)
+
+    def delete_node(self, identifier: str):
+        shutil.rmtree(self.node_path(identifier))
+
+    @property
+    def trash_path(self) -> str:
+        return os.path.join(self.path, 'trash')
+
+    def trash_node(self, identifier: str) -> str:
+        # The moved directory keeps its metadata.json, which names the node
+        token = new_trash_token()
+        os.makedirs(self.trash_path, exist_ok=True)
+        os.rename(self.node_path(identifier),
+                  os.path.join(self.trash_path, token))
+        return token
+
+    def list_trash(self) -> list:
+        if not os.path.exists(self.trash_path):
+            return []
+        entries = []
+        for token in sorted(os.listdir(self.trash_path)):
+            try:
+                metadata = read_json(os.path.join(self.trash_path, token,
+                                                  'metadata.json'))
+                entries.append((token, metadata.get('identifier')))
+            except (FileNotFoundError, ValueError):
+                entries.append((token, None))
+        return entries
+
+    def reap_trash(self, token: str):
+        path = os.path.join(self.trash_path, token)
+        for root, dirs, files in os.walk(path, topdown=False):
+            if root == path and 'metadata.json' in files:
+                # Removed last so that the entry can be identified until then
+                files.remove('metadata.json')
+                files.append('metadata.json')
+            for name in files:
+                file_path = os.path.join(root, name)
+                try:
+                    size = os.lstat(file_path).st_size
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    continue
+                yield size
+            try:
+                os.rmdir(root)
+            except FileNotFoundError:
+                pass
+
+    def read_dict(self, identifier: str, name: str) -> dict:
+        path = os.path.join(self.node_path(identifier), name + '.json')
+        for path in [path, path + '.gz']:
+            if os.path.exists(path):
+                metrics.storage_reads.inc(kind=name)
+                return read_json(path)
+        return {}
+
+    def write_dict(self, identifier: str, name: str, dictionary: dict):
+        self.write_json(
+            os.path.join(self.node_path(identifier), name + '.json'),
+            dictionary, name)
+
+    def get_log(self, identifier: str, key: str) -> SegmentLog:
+        return SegmentLog(
+            os.path.join(self.node_path(identifier), 'results'), key)
+
+    def read_rows(self, identifier: str, key: str) -> list:
+        metrics.storage_reads.inc(kind='rows')
+        return self.get_log(identifier, key).read()
+
+    def iter_rows(self, identifier: str, key: str):
+        metrics.storage_reads.inc(kind='rows')
+        return self.get_log(identifier, key).iter()
+
+    def count_rows(self, identifier: str, key: str) -> int:
+        return self.get_log(identifier, key).count()
+
+    def append_rows(self, identifier: str, key: str, rows: list):
+        size = self.get_log(identifier, key).append(rows)
+        metrics.storage_writes.inc(kind='rows')
+        metrics.storage_written_bytes.inc(size, kind='rows')
+
+    def clear_rows(self, identifier: str, key: str):
+        self.get_log(identifier, key).clear()
+
+    def compact_rows(self, identifier: str, key: str):
+        self.get_log(identifier, key).compact()
+
+    def replace_rows(self, identifier: str, key: str, rows: list) -> int:
+        freed = self.get_log(identifier, key).replace(rows)
+        metrics.storage_writes.inc(kind='rows')
+        return freed
+
+    def compress_node(self, identifier: str):
+        path = self.node_path(identifier)
+        log_dir = os.path.join(path, 'results')
+        paths = [os.path.join(path, name + '.json')
+                 for name in ['config', 'result']]
+        if os.path.isdir(log_dir):
+            paths += [os.path.join(log_dir, filename)
+                      for filename in sorted(os.listdir(log_dir))
+                      if filename.endswith('.jsonl')]
+        before = after = 0
+        for path in paths:
+            if os.path.exists(path):
+                sizes = gzip_file(path)
+                before += sizes[0]
+                after += sizes[1]
+        return before, after
+
+    def sync(self):
+        sync_all()
+        with self.unsynced_lock:
+            paths, self.unsynced = self.unsynced, set()
+        for path in paths | {os.path.dirname(p) for p in paths}:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def get_column_store(self, identifier: str, key: str) -> ColumnStore:
+        return ColumnStore(
+            os.path.join(self.node_path(identifier), 'columns'), key)
+
+    def read_columns(self, identifier: str, key: str):
+        metrics.storage_reads.inc(kind='columns')
+        return self.get_column_store(identifier, key).read()
+
+    def append_columns(self, identifier: str, key: str, rows: list):
+        size = self.get_column_store(identifier, key).append(rows)
+        metrics.storage_writes.inc(kind='columns')
+        metrics.storage_written_bytes.inc(size, kind='columns')
+
+    def clear_columns(self, identifier: str, key: str):
+        self.get_column_store(identifier, key).clear()
+
+
+def create_storage(backend: str, path: str) -> Storage:
+    """Create the storage of a database directory.
+    :param backend: 'file' or 'sqlite'.
+    :param path: Path to the database directory.
+    """
+    if backend == 'file':
+        return FileStorage(path)
+    elif backend == 'sqlite':
+        from sqlite_storage import SqliteStorage
+        os.makedirs(path, exist_ok=True)
+        return SqliteStorage(os.path.join(path, 'database.sqlite'))
+    else:
+        raise ValueError('Unknown storage backend: {}'.format(backend))
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def open_db(tmp_path):
+    """Open databases in a temporary directory, closed after the test."""
+    dbs = []
+
+    def open_db(path: str = 'db', **kwargs):
+        db = Database(str(tmp_path / path), **kwargs)
+        dbs.append(db)
+        return db
+
+    yield open_db
+    for db in dbs:
+        db.close()
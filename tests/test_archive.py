@@ -0,0 +1,102 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+import archive
+from archive import export_tree, import_tree
+
+
+def exported(db, identifier: str) -> io.BytesIO:
+    f = io.BytesIO()
+    export_tree(db, identifier, f, 'none')
+    f.seek(0)
+    return f
+
+
+def rewrite_manifest(archive: io.BytesIO, change) -> io.BytesIO:
+    """Copy an uncompressed archive with a changed manifest."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='r') as src, \
+            tarfile.open(fileobj=out, mode='w') as dst:
+        for member in src.getmembers():
+            data = src.extractfile(member).read()
+            if member.name == 'manifest.json':
+                manifest = json.loads(data)
+                change(manifest)
+                data = json.dumps(manifest).encode('utf-8')
+                member.size = len(data)
+            dst.addfile(member, io.BytesIO(data))
+    out.seek(0)
+    return out
+
+
+@pytest.fixture
+def db(open_db):
+    db = open_db()
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    db.create_task('pp/tt', 'ss')
+    with db.writing('pp'):
+        # As left by a deletion not yet reaped
+        db.get_child('pp').add_tombstone('token', 'gone')
+    db.insert_task_result('pp/tt/ss', 'a', '1', 'int')
+    return db
+
+
+def test_import_copies_the_tree_without_tombstones(db):
+    assert db.get_child('pp').metadata.get('tombstones')
+    assert import_tree(db, exported(db, 'pp'), name='copy') == 'copy'
+    assert db.has_project('copy')
+    assert 'tombstones' not in db.storage.read_metadata('copy')
+    assert db.storage.read_dict('copy/tt/ss', 'result')['a']['value'] == 1
+    assert db.index.query('copy')['nodes'][0]['identifier'] == 'copy/tt'
+
+
+@pytest.mark.parametrize('path', ['/../tt', '/xx/ss', '/tt/s'])
+def test_import_rejects_invalid_paths(db, path):
+    def change(manifest):
+        manifest['nodes'][2]['path'] = path
+
+    archive = rewrite_manifest(exported(db, 'pp'), change)
+    with pytest.raises(ValueError):
+        import_tree(db, archive, name='copy')
+    assert not db.has_project('copy')
+    assert db.storage.read_metadata('copy') is None
+
+
+def test_import_rolls_back_failed_index_updates(db, monkeypatch):
+    archive = exported(db, 'pp/tt')
+    update = db.index.update
+
+    def failing_update(identifier, metadata):
+        if identifier.endswith('/ss'):
+            raise KeyError(identifier)
+        update(identifier, metadata)
+
+    monkeypatch.setattr(db.index, 'update', failing_update)
+    with pytest.raises(KeyError):
+        import_tree(db, archive, 'pp', 'copy')
+    assert not db.get_child('pp').has_child('copy')
+    assert db.storage.read_metadata('pp/copy') is None
+    assert 'pp/copy' not in db.index.nodes
+
+
+def test_snapshot_is_taken_again_when_the_tree_changes(db, monkeypatch):
+    monkeypatch.setattr(archive, 'SNAPSHOT_GROUP', 1)
+    read = db.locks.read
+    groups = []
+
+    def read_and_create(*identifiers):
+        groups.append(identifiers)
+        if identifiers == ('pp/tt/ss',) and not db.get_child(
+                'pp/tt').has_child('new'):
+            db.create_task('pp/tt', 'new')
+        return read(*identifiers)
+
+    monkeypatch.setattr(db.locks, 'read', read_and_create)
+    nodes = archive.snapshot(db, 'pp')
+    assert [node.identifier for node in nodes] == ['pp', 'pp/tt', 'pp/tt/ss',
+                                                   'pp/tt/new']
+    assert max(len(group) for group in groups) == 1
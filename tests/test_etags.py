@@ -0,0 +1,28 @@
+import json
+
+
+def test_list_projects_info_changes_with_task_metadata(open_db):
+    db = open_db()
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    args = {'info': 'true'}
+    etag = db.etag('list_projects', args)
+    plain = db.etag('list_projects', {})
+    db.update_child_metadata('pp/tt', json.dumps({'status': 'done'}))
+    assert db.etag('list_projects', args) != etag
+    assert db.etag('list_projects', {}) == plain
+    ok, projects = db.api('list_projects', args)
+    assert ok
+    assert projects[0]['tasks'][0]['status'] == 'done'
+
+
+def test_etags_change_with_results(open_db):
+    db = open_db()
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    args = {'identifier': 'pp/tt'}
+    etag = db.etag('get_task_results', args)
+    assert db.etag('get_task_results', args) == etag
+    db.insert_task_result('pp/tt', 'a', '1', 'int')
+    assert db.etag('get_task_results', args) != etag
+    assert db.etag('get_task_results', {'identifier': 'pp/other'}) != etag
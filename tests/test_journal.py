@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import journal
+
+
+@pytest.fixture
+def dbs(open_db):
+    """Two databases sharing a directory, as two worker processes do."""
+    return (open_db(file_locks=True, journal=True),
+            open_db(file_locks=True, journal=True))
+
+
+def test_changes_are_seen_by_the_other_database(dbs):
+    db1, db2 = dbs
+    db1.create_project('pp')
+    assert db2.api('list_projects', {}) == (True, ['pp'])
+    db2.create_task('pp', 'tt')
+    db2.insert_task_result('pp/tt', 'a', '1', 'int')
+    ok, results = db1.api('get_task_results', {'identifier': 'pp/tt'})
+    assert ok and results['a']['value'] == 1
+    assert db1.index.query('pp')['total'] == 1
+    assert db1.search_tasks(parent='pp')['total'] == 1
+
+
+def test_etags_change_with_writes_of_the_other_database(dbs):
+    db1, db2 = dbs
+    db1.create_project('pp')
+    db1.create_task('pp', 'tt')
+    args = {'identifier': 'pp/tt'}
+    etag = db1.etag('get_task_results', args)
+    assert db2.api('insert_task_result', dict(
+        args, key='a', value='1', val_type='int'))[0]
+    assert db1.etag('get_task_results', args) != etag
+    tree = db1.etag('list_projects', {'info': 'true'})
+    assert db2.api('update_child_metadata', dict(
+        args, metadata=json.dumps({'status': 'done'})))[0]
+    assert db1.etag('list_projects', {'info': 'true'}) != tree
+
+
+def test_missed_records_reload_everything(dbs, monkeypatch, caplog):
+    db1, db2 = dbs
+    monkeypatch.setattr(journal, 'SEGMENT_SIZE', 1)
+    db1.create_project('pp')
+    # Every append rotates, so db2 falls behind by more than two segments
+    for name in ['t1', 't2', 't3']:
+        db1.create_task('pp', name)
+    assert db2.api('list_children', {'parent': 'pp'}) == (
+        True, ['t1', 't2', 't3'])
+    assert 'Changes of other processes were missed' in caplog.text
+    assert db2.index.query('pp')['total'] == 3
+
+
+def test_etags_are_shared_by_the_databases(dbs):
+    db1, db2 = dbs
+    db1.create_project('pp')
+    db1.create_task('pp', 'tt')
+    args = {'identifier': 'pp/tt'}
+    assert db2.etag('get_task_results', args) == \
+        db1.etag('get_task_results', args)
+    db2.insert_task_result('pp/tt', 'a', '1', 'int')
+    etag = db2.etag('get_task_results', args)
+    assert db1.etag('get_task_results', args) == etag
+    db1.delete_task('pp/tt')
+    db1.create_task('pp', 'tt')
+    assert db1.etag('get_task_results', args) != etag
+    assert db2.etag('get_task_results', args) == \
+        db1.etag('get_task_results', args)
@@ -0,0 +1,14 @@
+from segments import SegmentLog
+
+
+def test_partial_row_is_skipped_and_cut_off(tmp_path):
+    log = SegmentLog(str(tmp_path), 'key')
+    log.append([[1], [2]])
+    path = log.segments()[-1][2]
+    with open(path, 'ab') as f:
+        # As left by a crash during an append
+        f.write(b'[3, 4')
+    assert log.read() == [[1], [2]]
+    log.append([[5]])
+    assert log.read() == [[1], [2], [5]]
+    assert log.count() == 3
@@ -0,0 +1,26 @@
+from database import Database
+
+
+def test_index_is_rebuilt_after_a_crash(tmp_path, open_db):
+    path = str(tmp_path / 'db')
+    db = Database(path)
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    # Crash after a metadata write, before the index was updated
+    metadata = dict(db.storage.read_metadata('pp/tt'), status='done')
+    db.storage.write_metadata('pp/tt', metadata)
+    db.storage.close()
+    db = open_db(path)
+    assert db.index.query('pp')['nodes'][0]['status'] == 'done'
+
+
+def test_index_is_loaded_after_a_clean_close(tmp_path, open_db, caplog):
+    path = str(tmp_path / 'db')
+    db = Database(path)
+    db.create_project('pp')
+    db.close()
+    caplog.clear()
+    with caplog.at_level('INFO'):
+        db = open_db(path)
+    assert 'Building tree index' not in caplog.text
+    assert db.index.query('')['total'] == 1
@@ -0,0 +1,17 @@
+import gzip
+
+import pytest
+
+from wire import decompress
+
+
+def test_decompress_rejects_bodies_over_the_limit():
+    body = gzip.compress(b'x' * 1000)
+    assert decompress(body, 'gzip', 1000) == b'x' * 1000
+    with pytest.raises(ValueError):
+        decompress(body, 'gzip', 999)
+
+
+def test_decompress_rejects_truncated_bodies():
+    with pytest.raises(ValueError):
+        decompress(gzip.compress(b'x' * 1000)[:-8], 'gzip')
@@ -0,0 +1,52 @@
+class InterleavingLocks(object):
+    """Run a function before the first write lock is taken."""
+
+    def __init__(self, locks, before):
+        self.locks = locks
+        self.before = before
+
+    def write(self, *identifiers):
+        if self.before is not None:
+            before, self.before = self.before, None
+            before()
+        return self.locks.write(*identifiers)
+
+
+def test_write_buffered_during_flush_is_written(open_db):
+    db = open_db(write_behind=True, flush_interval=60, durability='fsync')
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    node = db.get_child('pp/tt')
+    with db.locks.write('pp/tt'):
+        db.buffer(node)
+        node.result.insert('a', '1', 'int')
+
+    def write_meanwhile():
+        with db.locks.write('pp/tt'):
+            db.buffer(node)
+            node.result.insert('b', '2', 'int')
+
+    wb = db.write_behind
+    wb.locks = InterleavingLocks(wb.locks, write_meanwhile)
+    wb.flush()
+    assert wb.flushed >= 1
+    stored = db.storage.read_dict('pp/tt', 'result')
+    assert stored['a']['value'] == 1
+    assert stored['b']['value'] == 2
+
+
+def test_buffered_node_is_found_while_flushing(open_db):
+    db = open_db(write_behind=True, flush_interval=60)
+    db.create_project('pp')
+    db.create_task('pp', 'tt')
+    node = db.get_child('pp/tt')
+    with db.locks.write('pp/tt'):
+        db.buffer(node)
+        node.result.insert('a', '1', 'int')
+    wb = db.write_behind
+    seen = []
+    wb.locks = InterleavingLocks(wb.locks,
+                                 lambda: seen.append(wb.get('pp/tt')))
+    wb.flush()
+    assert seen == [node]
+    assert db.storage.read_dict('pp/tt', 'result')['a']['value'] == 1
@@ -0,0 +1,241 @@
+import os
+import json
+import threading
+
+from utils import read_json, atomic_write_json
+
+# Metadata fields kept in the summary of a node
+SUMMARY_KEYS = ['name', 'identifier', 'status', 'archived', 'create_time',
+                'desc']
+# Metadata keys of the child lists of the database, projects and tasks
+CHILD_KEYS = ['projects', 'tasks', 'subtasks']
+# Number of logged updates after which the snapshot is rewritten
+SNAPSHOT_EVERY = 1000
+
+
+class TreeIndex(object):
+    """Summaries of all projects and tasks, so that listing the tree never
+    opens the metadata of the nodes. Stored as a snapshot plus a log of
+    updates, and rebuilt if it does not match the database.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: Directory to store the index in. If None, the index
+        is only kept in memory.
+        """
+        self.path = path
+        # identifier -> summary, with the ordered names of the children and
+        # the number of children per status
+        self.nodes = {'': self.new_node({})}
+        self.logged = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def new_node(summary: dict) -> dict:
+        return dict(summary, children=[], status_counts={})
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.path, 'tree_index.json')
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.path, 'tree_index.log')
+
+    @property
+    def open_path(self) -> str:
+        return os.path.join(self.path, 'tree_index.open')
+
+    def mark_open(self):
+        """Record that the stored index is in use until close()."""
+        if self.path is not None:
+            open(self.open_path, 'w').close()
+
+    def load(self, projects: list) -> bool:
+        """Load the stored index.
+        :param projects: Project names of the database, used to check that
+        the index is up to date.
+        :return: False if there is no usable index.
+        """
+        if self.path is None or not os.path.exists(self.snapshot_path):
+            return False
+        if os.path.exists(self.open_path):
+            # Not closed: a crash between a metadata write and the update of
+            # the index may have left it stale
+            return False
+        try:
+            with self.lock:
+                self.nodes = read_json(self.snapshot_path)
+                self.logged = 0
+                if os.path.exists(self.log_path):
+                    with open(self.log_path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            self.apply(*json.loads(line))
+                            self.logged += 1
+        except (ValueError, KeyError, TypeError):
+            return False
+        if self.nodes[''].get('children') != projects:
+            return False
+        self.mark_open()
+        return True
+
+    def detach(self):
+        """Keep the index in memory only from now on, and remove the stored
+        one, which would go stale.
+        """
+        if self.path is None:
+            return
+        for path in [self.snapshot_path, self.log_path, self.open_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.path = None
+
+    def build(self, read_metadata):
+        """Rebuild the index by walking the whole tree.
+        :param read_metadata: Function that reads the metadata of a node.
+        """
+        with self.lock:
+            self.nodes = {'': self.new_node({})}
+            stack = [('', read_metadata(''))]
+            while stack:
+                identifier, metadata = stack.pop()
+                depth = identifier.count('/') + 1 if identifier else 0
+                names = metadata.get(CHILD_KEYS[min(depth, 2)], [])
+                for name in reversed(names):
+                    child = '{}/{}'.format(identifier, name) if identifier \
+                        else name
+                    child_metadata = read_metadata(child)
+                    if child_metadata is not None:
+                        stack.append((child, child_metadata))
+                if identifier:
+                    self.apply('update', identifier,
+                               self.summarize(metadata))
+            self.snapshot()
+            self.mark_open()
+
+    def close(self):
+        """Write the snapshot, after which the stored index can be loaded
+        without a rebuild.
+        """
+        if self.path is None:
+            return
+        self.snapshot()
+        try:
+            os.remove(self.open_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def summarize(metadata: dict) -> dict:
+        return {k: metadata[k] for k in SUMMARY_KEYS if k in metadata}
+
+    @staticmethod
+    def parent_of(identifier: str) -> str:
+        return identifier.rpartition('/')[0]
+
+    def apply(self, op: str, identifier: str, summary: dict = None):
+        parent = self.nodes[self.parent_of(identifier)]
+        name = identifier.rpartition('/')[2]
+        node = self.nodes.get(identifier)
+        if node is not None:
+            counts = parent['status_counts']
+            status = node.get('status')
+            if status is not None:
+                counts[status] -= 1
+                if not counts[status]:
+                    del counts[status]
+        if op == 'update':
+            if node is None:
+                node = self.nodes[identifier] = self.new_node({})
+                parent['children'].append(name)
+            children, counts = node['children'], node['status_counts']
+            node.clear()
+            node.update(summary, children=children, status_counts=counts)
+            status = node.get('status')
+            if status is not None:
+                parent['status_counts'][status] = \
+                    parent['status_counts'].get(status, 0) + 1
+        elif op == 'remove' and node is not None:
+            parent['children'].remove(name)
+            prefix = identifier + '/'
+            for key in [k for k in self.nodes
+                        if k == identifier or k.startswith(prefix)]:
+                del self.nodes[key]
+
+    def write(self, op: str, identifier: str, summary: dict = None):
+        with self.lock:
+            self.apply(op, identifier, summary)
+            if self.path is None:
+                return
+            if self.logged + 1 >= SNAPSHOT_EVERY:
+                self.snapshot()
+            else:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps([op, identifier, summary]) + '\n')
+                self.logged += 1
+
+    def snapshot(self):
+        if self.path is None:
+            return
+        with self.lock:
+            atomic_write_json(self.snapshot_path, self.nodes)
+            # Replaying updates already in the snapshot is harmless, so a
+            # crash before the log is truncated leaves a valid index
+            open(self.log_path, 'w').close()
+            self.logged = 0
+
+    def update(self, identifier: str, metadata: dict):
+        """Add or update the summary of a node."""
+        self.write('update', identifier, self.summarize(metadata))
+
+    def remove(self, identifier: str):
+        """Remove a node and its descendants."""
+        self.write('remove', identifier)
+
+    def export(self, identifier: str) -> dict:
+        node = self.nodes[identifier]
+        summary = {k: v for k, v in node.items() if k != 'children'}
+        summary['child_count'] = len(node['children'])
+        summary['status_counts'] = dict(node['status_counts'])
+        return summary
+
+    def query(self, parent: str = '', archived: bool = None,
+              status: str = None, offset: int = 0, limit: int = None,
+              children: bool = False) -> dict:
+        """List the children of a node.
+        :param parent: Parent identifier, '' for the projects.
+        :param archived: Only list archived (True) or unarchived (False)
+        nodes.
+        :param status: Only list nodes with this status.
+        :param offset: Number of matching nodes to skip.
+        :param limit: Maximum number of nodes to return.
+        :param children: Also list the children of every node.
+        :return: {'nodes': [...], 'total': number of matching nodes,
+        'offset': offset}
+        """
+        with self.lock:
+            if parent not in self.nodes:
+                raise ValueError('Node {} does not exist'.format(parent))
+            prefix = parent + '/' if parent else ''
+            matches = []
+            for name in self.nodes[parent]['children']:
+                node = self.nodes[prefix + name]
+                if (archived is not None
+                        and bool(node.get('archived', False)) != archived):
+                    continue
+                if status is not None and node.get('status') != status:
+                    continue
+                matches.append(prefix + name)
+            end = None if limit is None else offset + limit
+            nodes = []
+            for identifier in matches[offset:end]:
+                summary = self.export(identifier)
+                if children:
+                    summary['children'] = [
+                        self.export('{}/{}'.format(identifier, name))
+                        for name in self.nodes[identifier]['children']]
+                nodes.append(summary)
+            return {'nodes': nodes, 'total': len(matches), 'offset': offset}
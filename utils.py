@@ -1,7 +1,67 @@
+import os
+import gzip
+import json
 import time
+import shutil
+import tempfile
 
 def format_time(timestamp: int):
     if timestamp is None:
         return ''
     else:
-        return time.strftime('%b %d, %Y %H:%M:%S %Z', time.localtime(timestamp))
\ No newline at end of file
+        return time.strftime('%b %d, %Y %H:%M:%S %Z', time.localtime(timestamp))
+
+
+def read_json(path: str):
+    """Read a JSON file, which is gzip-compressed if its name ends with
+    .gz.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def gzip_file(path: str, level: int = 6):
+    """Replace a file by a gzip-compressed copy named path + '.gz'. The copy
+    is synced and moved into place before the file is removed, so one of
+    them is complete at any time.
+    :return: (size before, size after) in bytes.
+    """
+    tmp_path = path + '.gz.tmp'
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level,
+                           mtime=0) as dst:
+            shutil.copyfileobj(src, dst)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path + '.gz')
+    before = os.path.getsize(path)
+    os.remove(path)
+    return before, os.path.getsize(path + '.gz')
+
+
+def atomic_write_json(path: str, obj, fsync: bool = False):
+    """Write an object as JSON to a temporary file and move it into place,
+    so that readers never see a partially written file.
+    :param path: Path to the JSON file.
+    :param obj: Object to write.
+    :param fsync: Flush the file to disk before replacing.
+    :return: Number of bytes written.
+    """
+    data = json.dumps(obj).encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.' + os.path.basename(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(data)
@@ -0,0 +1,114 @@
+import os
+import zlib
+import json
+import itertools
+import threading
+
+# Parts of a node with their own versions: its metadata, the list and
+# metadata of its children, its config and its result. The version of the
+# 'tree' part of the database changes with the metadata of any node.
+PARTS = ('metadata', 'children', 'config', 'result')
+
+
+def parent_of(identifier: str) -> str:
+    return identifier.rsplit('/', 1)[0] if '/' in identifier else ''
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Check if an If-None-Match header matches an entity tag."""
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+
+class Versions(object):
+    """In-memory version counters of the parts of nodes, from which the
+    entity tags of API responses are derived.
+
+    Processes sharing a database through the journal share its epoch, and
+    use the journal positions of the changes as versions, so that they tag
+    the same content alike. Parts not changed since the floor, the position
+    the process started reading the journal at, are at the floor.
+    """
+
+    def __init__(self, epoch: str = None, floor: int = None):
+        """
+        :param epoch: Epoch of the journal, a random one by default, so that
+        tags from before a restart never match.
+        :param floor: Journal position, to use journal positions as versions.
+        """
+        self.epoch = epoch or os.urandom(4).hex()
+        self.floor = floor
+        self.counter = itertools.count(1)
+        self.versions = {}
+        # Nodes deleted by this process, forgotten once their deletion has
+        # a journal position
+        self.discarded = set()
+        self.lock = threading.Lock()
+
+    def get(self, identifier: str, part: str) -> int:
+        version = self.versions.get((identifier, part))
+        if version is None:
+            if self.floor is not None:
+                return self.floor
+            with self.lock:
+                version = self.versions.setdefault((identifier, part),
+                                                   next(self.counter))
+        return version
+
+    def bump(self, identifier: str, parts=PARTS, version: int = None):
+        """Give parts of a node new versions. Changes of the metadata of a
+        node also change the children of its parent and the tree. Must be
+        called after the change is made, so that a response is never tagged
+        with a version newer than its content.
+        :param version: Journal position of the change.
+        """
+        keys = [(identifier, part) for part in parts]
+        if 'metadata' in parts:
+            keys.append(('', 'tree'))
+            if identifier:
+                keys.append((parent_of(identifier), 'children'))
+        with self.lock:
+            for key in keys:
+                self.versions[key] = (next(self.counter) if version is None
+                                      else version)
+            if identifier in self.discarded:
+                self.discarded.remove(identifier)
+                self.forget(identifier, version)
+
+    def discard(self, identifier: str, version: int = None):
+        """Forget the versions of a deleted node and its descendants, so
+        that a node created under the same name starts with new ones.
+        :param version: Journal position of the deletion. If it is not known
+        yet, the node is forgotten by the bump() of the deletion.
+        """
+        with self.lock:
+            if self.floor is not None and version is None:
+                self.discarded.add(identifier)
+            else:
+                self.forget(identifier, version)
+
+    def forget(self, identifier: str, version: int = None):
+        """Drop the versions of a node and its descendants, and raise the
+        floor past the deletion. Must be called with the lock held.
+        """
+        prefix = identifier + '/'
+        for key in [k for k in self.versions
+                    if k[0] == identifier or k[0].startswith(prefix)]:
+            del self.versions[key]
+        if self.floor is not None and version is not None:
+            self.floor = max(self.floor, version)
+
+    def etag(self, keys, args) -> str:
+        """Get the entity tag of a response.
+        :param keys: (identifier, part) pairs the response depends on.
+        :param args: Arguments of the request, which are hashed into the
+        tag.
+        """
+        return '{}-{}-{:08x}'.format(
+            self.epoch, '.'.join(str(self.get(*key)) for key in keys),
+            zlib.crc32(json.dumps(args).encode('utf-8')))
@@ -0,0 +1,209 @@
+"""Encodings of API requests and responses: JSON (with orjson if it is
+installed) or MessagePack, compressed with zstd or gzip as negotiated.
+Request bodies may be forms, or typed objects of op arguments in JSON or
+MessagePack.
+"""
+import gzip
+import zlib
+import json
+from urllib.parse import parse_qsl
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+FORM = 'application/x-www-form-urlencoded'
+# Content types of bodies holding objects of arguments
+TYPED = {JSON: JSON, MSGPACK: MSGPACK, 'application/x-msgpack': MSGPACK}
+# Responses smaller than this many bytes are not compressed
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+# Bodies larger than this many bytes once decompressed are rejected
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+
+def require_msgpack():
+    if msgpack is None:
+        raise RuntimeError('MessagePack requires the msgpack module')
+
+
+def codings() -> list:
+    """List the supported content codings, preferred first."""
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def parse_accept(header: str) -> dict:
+    """Parse an Accept or Accept-Encoding header.
+    :return: {value: quality}
+    """
+    values = {}
+    for item in (header or '').split(','):
+        value, _, params = item.partition(';')
+        value = value.strip().lower()
+        if not value:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, q = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(q)
+                except ValueError:
+                    quality = 0.0
+        values[value] = quality
+    return values
+
+
+def negotiate(accept: str, accept_encoding: str) -> tuple:
+    """Choose the format and content coding of a response.
+    :return: (content type, content coding or None)
+    """
+    types = parse_accept(accept)
+    content_type = JSON
+    if msgpack is not None:
+        quality = max(types.get(MSGPACK, 0),
+                      types.get('application/x-msgpack', 0))
+        if quality > 0 and quality >= types.get(JSON, 0):
+            content_type = MSGPACK
+    encodings = parse_accept(accept_encoding)
+    for coding in codings():
+        if encodings.get(coding, encodings.get('*', 0)) > 0:
+            return content_type, coding
+    return content_type, None
+
+
+def representation_tag(etag: str, content_type: str, coding: str) -> str:
+    """Get the entity tag of a representation of a response, which differs
+    between formats and codings.
+    """
+    if content_type != JSON:
+        etag += '-msgpack'
+    if coding is not None:
+        etag += '-' + coding
+    return etag
+
+
+def dumps(obj, content_type: str = JSON) -> bytes:
+    if content_type == MSGPACK:
+        require_msgpack()
+        return msgpack.packb(obj, use_bin_type=True)
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g., integers of more than 64 bits
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+
+def loads(body: bytes, content_type: str = JSON):
+    if content_type == MSGPACK:
+        require_msgpack()
+        return msgpack.unpackb(body, raw=False)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL, mtime=0)
+    if coding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError('Unsupported content coding: {}'.format(coding))
+
+
+def gunzip(body: bytes, max_size: int) -> bytes:
+    data = b''
+    # A gzip body may hold several members
+    while body:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data += decompressor.decompress(body, max_size + 1 - len(data))
+        except zlib.error as e:
+            raise ValueError('Invalid gzip body: {}'.format(e))
+        if len(data) > max_size:
+            break
+        if not decompressor.eof:
+            raise ValueError('Truncated gzip body')
+        body = decompressor.unused_data
+    return data
+
+
+def unzstd(body: bytes, max_size: int) -> bytes:
+    # Frames written in streaming mode do not record their size, and the
+    # size recorded by others is not trusted
+    data = bytearray()
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+            while len(data) <= max_size:
+                chunk = reader.read(max_size + 1 - len(data))
+                if not chunk:
+                    break
+                data += chunk
+    except zstandard.ZstdError as e:
+        raise ValueError('Invalid zstd body: {}'.format(e))
+    return bytes(data)
+
+
+def decompress(body: bytes, coding: str,
+               max_size: int = MAX_DECOMPRESSED_SIZE) -> bytes:
+    """Decompress a body, without holding more than max_size bytes of its
+    content.
+    :raise ValueError: If the content is larger, or the body is invalid.
+    """
+    coding = coding.strip().lower()
+    if coding in {'', 'identity'}:
+        return body
+    if coding == 'gzip':
+        data = gunzip(body, max_size)
+    elif coding == 'zstd' and zstandard is not None:
+        data = unzstd(body, max_size)
+    else:
+        raise ValueError('Unsupported content coding: {}'.format(coding))
+    if len(data) > max_size:
+        raise ValueError('Body is larger than {} bytes once '
+                         'decompressed'.format(max_size))
+    return data
+
+
+def encode_response(obj, content_type: str = JSON, coding: str = None):
+    """Encode a response, compressed if it is large enough.
+    :return: (body, content coding applied or None)
+    """
+    body = dumps(obj, content_type)
+    if coding is None or len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+    return compress(body, coding), coding
+
+
+def decode_body(body: bytes, content_type: str, coding: str = None) -> dict:
+    """Decode the arguments of a request body. Bodies of other types than
+    forms and typed objects are ignored.
+    """
+    if coding:
+        body = decompress(body, coding)
+    content_type = (content_type or '').partition(';')[0].strip().lower()
+    if content_type in TYPED:
+        args = loads(body, TYPED[content_type])
+        if type(args) is not dict:
+            raise ValueError('The request body must be an object of '
+                             'arguments')
+        return args
+    if content_type == FORM:
+        return dict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+    return {}
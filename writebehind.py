@@ -0,0 +1,152 @@
+import logging
+import threading
+from collections import deque
+from contextlib import ExitStack
+
+logger = logging.getLogger()
+
+DURABILITY_LEVELS = {'buffer', 'fsync'}
+
+
+class WriteBehind(object):
+    """Buffer the result and config writes of tasks in memory and write
+    them to the storage in groups from a background thread. With durability
+    'fsync' writers wait until their group is synced to disk.
+    """
+
+    def __init__(self, storage, locks, interval: float = 0.05,
+                 max_writes: int = 1000, durability: str = 'buffer'):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError('Unknown durability level: {}'.format(durability))
+        self.storage = storage
+        self.locks = locks
+        self.interval = interval
+        self.max_writes = max_writes
+        self.durability = durability
+        # identifier -> (node, ExitStack of its open batch blocks)
+        self.nodes = {}
+        # Nodes taken out of nodes by the running flush
+        self.flushing = {}
+        self.buffered = 0
+        # Writes are numbered; every write up to flushed has been written
+        self.written = 0
+        self.flushed = 0
+        # (last write number, error message) of recent failed flushes
+        self.failures = deque(maxlen=1024)
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='write-behind',
+                                       daemon=True)
+        self.thread.start()
+
+    def get(self, identifier: str):
+        """Get a node with buffered writes, which must be used instead of a
+        fresh copy from the storage.
+        """
+        entry = self.nodes.get(identifier) or self.flushing.get(identifier)
+        return entry[0] if entry is not None else None
+
+    def buffer(self, node, writes: int = 1) -> int:
+        """Buffer the writes about to be made to a node. Must be called with
+        the write lock of the node held.
+        :return: Number of the last write, to pass to wait().
+        """
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError('Write-behind buffer is closed')
+            if node.identifier not in self.nodes:
+                stack = ExitStack()
+                stack.enter_context(node.result.batch())
+                stack.enter_context(node.config.batch())
+                self.nodes[node.identifier] = (node, stack)
+            self.written += writes
+            self.buffered += writes
+            if self.buffered >= self.max_writes:
+                self.condition.notify_all()
+            return self.written
+
+    def discard(self, identifier: str):
+        """Drop the buffered writes of a deleted node and its descendants.
+        Must be called with the write lock of the node held.
+        """
+        prefix = identifier + '/'
+        with self.condition:
+            for nodes in [self.nodes, self.flushing]:
+                for key in [k for k in nodes
+                            if k == identifier or k.startswith(prefix)]:
+                    node, stack = nodes.pop(key)
+                    # Close the batch blocks with nothing left to write
+                    node.result.pending = {}
+                    node.result.dirty = False
+                    node.config.dirty = False
+                    stack.close()
+
+    def wait(self, ticket: int):
+        """Wait until a write is durable, if the durability level asks for
+        it.
+        """
+        if self.durability == 'buffer':
+            return
+        with self.condition:
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.flushed >= ticket)
+            for last, error in self.failures:
+                if last >= ticket:
+                    raise IOError('Failed to flush buffered writes: '
+                                  '{}'.format(error))
+
+    def flush(self):
+        """Write all buffered writes now."""
+        with self.condition:
+            nodes = self.flushing = self.nodes
+            self.nodes = {}
+            self.buffered = 0
+            last = self.written
+        error = None
+        for identifier, (node, stack) in list(nodes.items()):
+            try:
+                with self.locks.write(identifier):
+                    # Skip nodes deleted in the meantime
+                    if identifier in self.flushing:
+                        stack.close()
+                        # A write buffered since the flush started opened
+                        # another batch block, which is still open
+                        node.result.flush()
+                        node.config.flush()
+                        with self.condition:
+                            self.flushing.pop(identifier, None)
+            except Exception as e:
+                logger.exception('Failed to flush {}'.format(identifier))
+                error = str(e)
+        if nodes and self.durability == 'fsync':
+            try:
+                self.storage.sync()
+            except Exception as e:
+                logger.exception('Failed to sync the storage')
+                error = str(e)
+        with self.condition:
+            self.flushing = {}
+            # Waiters of the writes up to last are told of any failure
+            if error is not None:
+                self.failures.append((last, error))
+            self.flushed = max(self.flushed, last)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and self.buffered < self.max_writes:
+                    self.condition.wait(self.interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def close(self):
+        """Flush the buffered writes and stop the flusher."""
+        with self.condition:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()